@@ -0,0 +1,174 @@
+"""
+Vectorized analytics engine for PhanMemKeToan application
+
+Các cột cần thiết của hóa đơn/đơn hàng trong khoảng ngày được đọc một lần vào
+mảng NumPy: ngày thành số nguyên (ordinal - ngày bắt đầu), tiền thành float64,
+chuỗi (khách hàng, nhóm SP, hình thức TT) thành mã số nguyên. Mỗi phép gom nhóm
+sau đó chỉ là một lần np.bincount thay vì vòng lặp Python trên từng đối tượng.
+"""
+from datetime import date, timedelta
+import numpy as np
+from sqlalchemy import select, func, case, literal, union_all
+from sqlalchemy.orm import Session
+from .models import Invoice, Order, OrderItem, Product
+from .sales_rollup import PAID_STATUS, is_cancelled_expr
+
+DIMENSIONS = ('day', 'customer', 'product_group', 'payment_method')
+
+UNKNOWN_LABEL = 'Chưa phân loại'
+
+
+def _table(rows, width: int) -> np.ndarray:
+    """Các tuple kết quả truy vấn -> mảng object 2 chiều (mỗi cột là một trường)"""
+    rows = list(rows)
+    return np.array(rows, dtype=object).reshape(len(rows), width)
+
+
+def _days(column: np.ndarray, origin: date) -> np.ndarray:
+    """Cột date -> số ngày kể từ origin (int64)"""
+    # Số ngày khác nhau ít hơn nhiều so với số dòng: chỉ gọi toordinal() một lần cho mỗi ngày
+    start = origin.toordinal()
+    cache = {}
+    return np.fromiter(
+        (cache[d] if d in cache else cache.setdefault(d, d.toordinal() - start) for d in column),
+        dtype=np.int64, count=len(column)
+    )
+
+
+def _floats(column: np.ndarray) -> np.ndarray:
+    column = column.copy()
+    column[np.equal(column, None)] = 0
+    return column.astype(np.float64)
+
+
+def _encode(column: np.ndarray):
+    """Mã hóa chuỗi thành (danh sách nhãn, mảng mã int) để gom nhóm bằng bincount"""
+    index = {}
+    codes = np.fromiter((index.setdefault(v or '', len(index)) for v in column), dtype=np.int64, count=len(column))
+    return list(index), codes
+
+
+class AnalyticsEngine:
+    """
+    invoice_rows: các tuple (ngay_hd, nguoi_mua, tong_tien, trang_thai)
+    order_rows: các tuple (ngay_tao, nhom_sp, hinh_thuc_tt, so_luong, tong_tien, dem_don, dem_don_nhom)
+    của đơn không bị hủy. Đơn nhiều dòng (order_items) có một tuple cho mỗi dòng; dem_don
+    = 1 ở dòng đầu tiên của đơn, dem_don_nhom = 1 ở dòng đầu tiên của đơn trong mỗi nhóm
+    SP, để số đơn hàng không bị đếm lặp.
+    """
+
+    def __init__(self, start_date: date, end_date: date, invoice_rows=(), order_rows=()):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.days = (end_date - start_date).days + 1
+
+        invoices = _table(invoice_rows, 4)
+        self.invoice_day = _days(invoices[:, 0], start_date)
+        self.customers, self.invoice_customer = _encode(invoices[:, 1])
+        self.invoice_amount = _floats(invoices[:, 2])
+        self.invoice_paid = np.equal(invoices[:, 3], PAID_STATUS).astype(bool)
+
+        orders = _table(order_rows, 7)
+        self.order_day = _days(orders[:, 0], start_date)
+        self.product_groups, self.order_group = _encode(orders[:, 1])
+        self.payment_methods, self.order_method = _encode(orders[:, 2])
+        self.order_quantity = _floats(orders[:, 3])
+        self.order_amount = _floats(orders[:, 4])
+        self.order_count = _floats(orders[:, 5])
+        self.order_group_count = _floats(orders[:, 6])
+
+    @classmethod
+    def from_db(cls, db: Session, start_date: date, end_date: date):
+        """
+        Đọc các cột cần thiết trong khoảng ngày (hai câu truy vấn, không tạo đối tượng ORM).
+        Đơn hàng nhiều dòng được đọc theo từng dòng order_items với nhóm của sản phẩm
+        trong dòng, như bảng tổng hợp doanh thu (sales_rollup).
+        """
+        invoice_rows = (
+            db.query(Invoice.ngay_hd, Invoice.nguoi_mua, Invoice.tong_tien, Invoice.trang_thai)
+            .filter(Invoice.ngay_hd.between(start_date, end_date))
+            .all()
+        )
+        in_range = (Order.ngay_tao.between(start_date, end_date), ~is_cancelled_expr(Order.trang_thai))
+        has_items = select(OrderItem.id).where(OrderItem.order_id == Order.id).exists()
+        single = (
+            select(Order.ngay_tao, Product.nhom_sp, Order.hinh_thuc_tt, Order.so_luong, Order.tong_tien,
+                   literal(1), literal(1))
+            .select_from(Order)
+            .outerjoin(Product, Product.ma_sp == Order.sp_banggia)
+            .where(*in_range, ~has_items)
+        )
+        line_number = func.row_number().over(partition_by=OrderItem.order_id, order_by=OrderItem.id)
+        group_line_number = func.row_number().over(
+            partition_by=(OrderItem.order_id, Product.nhom_sp), order_by=OrderItem.id
+        )
+        lines = (
+            select(Order.ngay_tao, Product.nhom_sp, Order.hinh_thuc_tt, OrderItem.so_luong, OrderItem.total_price,
+                   case((line_number == 1, 1), else_=0), case((group_line_number == 1, 1), else_=0))
+            .select_from(OrderItem)
+            .join(Order, Order.id == OrderItem.order_id)
+            .join(Product, Product.id == OrderItem.product_id)
+            .where(*in_range)
+        )
+        order_rows = db.execute(union_all(single, lines)).all()
+        return cls(start_date, end_date, invoice_rows, order_rows)
+
+    @staticmethod
+    def _sum(codes, weights, size):
+        return np.bincount(codes, weights=weights, minlength=size)
+
+    def _invoice_groups(self, codes, size):
+        return {
+            'revenue': self._sum(codes, self.invoice_amount, size),
+            'paid_revenue': self._sum(codes, np.where(self.invoice_paid, self.invoice_amount, 0.0), size),
+            'invoice_count': np.bincount(codes, minlength=size),
+        }
+
+    def _order_groups(self, codes, size, counts=None):
+        return {
+            'order_revenue': self._sum(codes, self.order_amount, size),
+            'quantity': self._sum(codes, self.order_quantity, size),
+            'order_count': self._sum(codes, self.order_count if counts is None else counts, size).astype(np.int64),
+        }
+
+    @staticmethod
+    def _rows(labels, columns):
+        names = list(columns)
+        return [
+            {'key': label, **{name: columns[name][i].item() for name in names}}
+            for i, label in enumerate(labels)
+        ]
+
+    def by_day(self):
+        """Doanh thu hóa đơn (tổng, đã thanh toán) và đơn hàng theo từng ngày trong khoảng"""
+        columns = {**self._invoice_groups(self.invoice_day, self.days), **self._order_groups(self.order_day, self.days)}
+        labels = [(self.start_date + timedelta(days=i)).isoformat() for i in range(self.days)]
+        return self._rows(labels, columns)
+
+    def by_customer(self):
+        """Doanh thu hóa đơn theo người mua, giảm dần"""
+        size = len(self.customers)
+        rows = self._rows(self.customers, self._invoice_groups(self.invoice_customer, size))
+        return sorted(rows, key=lambda row: row['revenue'], reverse=True)
+
+    def by_product_group(self):
+        """Doanh thu đơn hàng theo nhóm sản phẩm, giảm dần"""
+        size = len(self.product_groups)
+        labels = [label or UNKNOWN_LABEL for label in self.product_groups]
+        rows = self._rows(labels, self._order_groups(self.order_group, size, self.order_group_count))
+        return sorted(rows, key=lambda row: row['order_revenue'], reverse=True)
+
+    def by_payment_method(self):
+        """Doanh thu đơn hàng theo hình thức thanh toán (hinh_thuc_tt), giảm dần"""
+        size = len(self.payment_methods)
+        labels = [label or UNKNOWN_LABEL for label in self.payment_methods]
+        rows = self._rows(labels, self._order_groups(self.order_method, size))
+        return sorted(rows, key=lambda row: row['order_revenue'], reverse=True)
+
+    def aggregate(self, dimension: str):
+        return {
+            'day': self.by_day,
+            'customer': self.by_customer,
+            'product_group': self.by_product_group,
+            'payment_method': self.by_payment_method,
+        }[dimension]()
@@ -1,17 +1,31 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from ..database import get_db
-from ..models import Account
+from ..models import Account, Order, Invoice, Payment, Debt
+from .. import sales_rollup, debts
 from ..schemas_fastapi import AccountOut, AccountCreate, AccountUpdate
+from .. import pagination
+from ..pagination import PageParams, page_params
 
 
 router = APIRouter(prefix="/accounts", tags=["accounts"])
 
+ACCOUNT_SORT_FIELDS = {'id': Account.id, 'ten_tk': Account.ten_tk}
 
-@router.get("/", response_model=list[AccountOut])
-def list_accounts(db: Session = Depends(get_db)):
-    rows = db.query(Account).all()
-    return [AccountOut.model_validate(row) for row in rows]
+
+@router.get("/")
+def list_accounts(
+    trang_thai: bool | None = None,
+    page: PageParams = Depends(page_params),
+    db: Session = Depends(get_db)
+):
+    query = pagination.search(db.query(Account), page.q, [Account.ten_tk, Account.tk_no, Account.tk_co, Account.email])
+    if trang_thai is not None:
+        query = query.filter(Account.trang_thai == trang_thai)
+    if page.is_legacy:
+        return [AccountOut.model_validate(row) for row in query.all()]
+    rows, page_info = pagination.paginate(query, page, ACCOUNT_SORT_FIELDS, Account.id)
+    return pagination.page_response([AccountOut.model_validate(row) for row in rows], page_info)
 
 
 @router.get("/{account_id}", response_model=AccountOut)
@@ -67,6 +81,23 @@ def delete_account(account_id: int, db: Session = Depends(get_db)):
     acc = db.query(Account).get(account_id)
     if not acc:
         raise HTTPException(status_code=404, detail="Không tìm thấy khách hàng")
+    
+    # Đơn hàng/hóa đơn của tài khoản quay về khớp khách hàng theo tên: tính lại phần
+    # hóa đơn trong bảng tổng hợp doanh thu (gắn sản phẩm qua đơn hàng đầu tiên)
+    names = {name for (name,) in db.query(Order.thong_tin_kh).filter(Order.account_id == acc.id).distinct()}
+    names |= {name for (name,) in db.query(Invoice.nguoi_mua).filter(Invoice.account_id == acc.id).distinct()}
+    affected = {sales_rollup.customer_key(acc.id, None)} | {sales_rollup.customer_key(None, name) for name in names}
+    sales_rollup.apply_customers(db, affected, -1)
+    db.query(Order).filter(Order.account_id == acc.id).update({Order.account_id: None}, synchronize_session=False)
+    db.query(Invoice).filter(Invoice.account_id == acc.id).update({Invoice.account_id: None}, synchronize_session=False)
+    db.query(Payment).filter(Payment.account_id == acc.id).update({Payment.account_id: None}, synchronize_session=False)
+    sales_rollup.apply_customers(db, affected)
+    
+    # Công nợ của tài khoản chuyển về các dòng theo tên người mua
+    db.query(Debt).filter(Debt.account_id == acc.id).delete(synchronize_session=False)
+    for name in names:
+        debts.recompute(db, None, name)
+    
     db.delete(acc)
     db.commit()
     return {"success": True}
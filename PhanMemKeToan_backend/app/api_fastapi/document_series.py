@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from ..database import get_db
+from ..models import DocumentSeries
+from ..schemas_fastapi import DocumentSeriesOut, DocumentSeriesUpdate
+from .. import document_numbers
+
+
+router = APIRouter(prefix="/document-series", tags=["document_series"])
+
+
+def _get_series(db: Session, ma: str):
+    if ma not in document_numbers.DEFAULTS:
+        raise HTTPException(status_code=404, detail=f"Không có dãy số '{ma}'")
+    document_numbers.ensure_series(db, ma)
+    return db.query(DocumentSeries).get(ma)
+
+
+@router.get("/")
+def list_document_series(db: Session = Depends(get_db)):
+    """Các dãy số chứng từ (hóa đơn, đơn hàng) và số đã cấp cuối cùng"""
+    rows = [DocumentSeriesOut.model_validate(_get_series(db, ma)) for ma in document_numbers.DEFAULTS]
+    db.commit()
+    return rows
+
+
+@router.get("/{ma}/next")
+def peek_document_number(ma: str, db: Session = Depends(get_db)):
+    """Số sẽ được cấp tiếp theo (chỉ để hiển thị, không giữ số)"""
+    _get_series(db, ma)
+    number, formatted = document_numbers.peek(db, ma)
+    db.commit()
+    return {"next_number": number, "so": formatted}
+
+
+@router.put("/{ma}")
+def update_document_series(ma: str, payload: DocumentSeriesUpdate, db: Session = Depends(get_db)):
+    """Đổi tiền tố/độ dài/khối giữ trước hoặc đặt lại số hiện tại của dãy số"""
+    series = _get_series(db, ma)
+    if payload.do_dai is not None and not 1 <= payload.do_dai <= 12:
+        raise HTTPException(status_code=400, detail="Độ dài phần số phải từ 1 đến 12")
+    if payload.khoi is not None and payload.khoi < 1:
+        raise HTTPException(status_code=400, detail="Khối giữ trước phải lớn hơn 0")
+    if payload.so_hien_tai is not None and payload.so_hien_tai < 0:
+        raise HTTPException(status_code=400, detail="Số hiện tại không được âm")
+    if payload.tien_to is not None: series.tien_to = payload.tien_to
+    if payload.do_dai is not None: series.do_dai = payload.do_dai
+    if payload.so_hien_tai is not None: series.so_hien_tai = payload.so_hien_tai
+    if payload.khoi is not None: series.khoi = payload.khoi
+    db.commit()
+    # Worker này bỏ khối đang giữ để dùng cấu hình mới ngay
+    document_numbers.forget_block(ma)
+    return {"success": True}
@@ -0,0 +1,166 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from ..database import SessionLocal, get_db
+from ..models import Invoice, Order, GeneralDiary
+from ..exports import CHUNK_ROWS, CSV_MEDIA_TYPE, XLSX_MEDIA_TYPE, EXPORT_FORMATS, stream_export
+from ..schemas_fastapi import InvoiceSearch
+from .invoices import filter_invoices
+from . import reports
+from datetime import date
+from typing import Optional
+
+
+router = APIRouter(prefix="/exports", tags=["exports"])
+
+INVOICE_HEADERS = ['Số HĐ', 'Ngày HĐ', 'Người mua', 'Tổng tiền', 'Loại HĐ', 'Trạng thái']
+ORDER_HEADERS = [
+    'Mã đơn hàng', 'Ngày tạo', 'Thông tin KH', 'Sản phẩm/Bảng giá', 'Mã CQ thuế',
+    'Số lượng', 'Tổng tiền', 'Hình thức TT', 'Trạng thái'
+]
+GENERAL_DIARY_HEADERS = [
+    'Ngày nhập', 'Số hiệu', 'Diễn giải', 'TK nợ', 'TK có',
+    'SL nhập', 'SL xuất', 'Số tiền'
+]
+DEBT_HEADERS = ['Khách hàng', 'Tổng công nợ', 'Đã thanh toán', 'Còn nợ', 'Trạng thái']
+REVENUE_HEADERS = ['Kỳ', 'Ngày bắt đầu kỳ', 'Doanh thu', 'Số lượng bán']
+
+
+def _validate_format(fmt: str) -> str:
+    fmt = (fmt or 'csv').strip().lower()
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=422, detail=f"format phải là một trong: {', '.join(EXPORT_FORMATS)}")
+    return fmt
+
+
+def _stream_query(build_query):
+    """
+    Đọc kết quả bằng server-side cursor theo từng lô CHUNK_ROWS dòng.
+    Dùng session riêng vì generator chạy sau khi endpoint đã trả về.
+    """
+    db = SessionLocal()
+    try:
+        query = build_query(db).execution_options(stream_results=True, yield_per=CHUNK_ROWS)
+        for row in query:
+            yield tuple(row)
+    finally:
+        db.close()
+
+
+def _response(fmt: str, name: str, headers, rows):
+    filename = f"{name}_{date.today():%Y%m%d}.{fmt}"
+    return StreamingResponse(
+        stream_export(fmt, headers, rows, sheet_name=name),
+        media_type=XLSX_MEDIA_TYPE if fmt == 'xlsx' else CSV_MEDIA_TYPE,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+
+@router.get("/invoices")
+def export_invoices(
+    format: str = Query('csv', description="csv hoặc xlsx"),
+    fromDate: Optional[date] = None,
+    toDate: Optional[date] = None,
+    invoiceNumber: Optional[str] = None,
+    customerInfo: Optional[str] = None
+):
+    """Xuất hóa đơn (cùng tiêu chí lọc với POST /invoices/search)"""
+    fmt = _validate_format(format)
+    criteria = InvoiceSearch(fromDate=fromDate, toDate=toDate, invoiceNumber=invoiceNumber, customerInfo=customerInfo)
+
+    def build_query(db):
+        query = db.query(
+            Invoice.so_hd, Invoice.ngay_hd, Invoice.nguoi_mua,
+            Invoice.tong_tien, Invoice.loai_hd, Invoice.trang_thai
+        )
+        return filter_invoices(query, criteria).order_by(Invoice.id)
+
+    return _response(fmt, 'invoices', INVOICE_HEADERS, _stream_query(build_query))
+
+
+@router.get("/orders")
+def export_orders(
+    format: str = Query('csv', description="csv hoặc xlsx"),
+    fromDate: Optional[str] = None,
+    toDate: Optional[str] = None,
+    customerInfo: Optional[str] = None,
+    q: Optional[str] = Query(None, description="Tìm theo mã đơn hàng hoặc trạng thái")
+):
+    """Xuất đơn hàng"""
+    fmt = _validate_format(format)
+
+    def build_query(db):
+        query = db.query(
+            Order.ma_don_hang, Order.ngay_tao, Order.thong_tin_kh, Order.sp_banggia,
+            Order.ma_co_quan_thue, Order.so_luong, Order.tong_tien, Order.hinh_thuc_tt,
+            Order.trang_thai
+        )
+        if fromDate and toDate:
+            query = query.filter(Order.ngay_tao.between(fromDate, toDate))
+        if customerInfo:
+            query = query.filter(Order.thong_tin_kh.ilike(f"%{customerInfo}%"))
+        if q:
+            like = f"%{q}%"
+            query = query.filter((Order.ma_don_hang.ilike(like)) | (Order.trang_thai.ilike(like)))
+        return query.order_by(Order.id)
+
+    return _response(fmt, 'orders', ORDER_HEADERS, _stream_query(build_query))
+
+
+@router.get("/general-diary")
+def export_general_diary(
+    format: str = Query('csv', description="csv hoặc xlsx"),
+    fromDate: Optional[str] = None,
+    toDate: Optional[str] = None
+):
+    """Xuất nhật ký chung"""
+    fmt = _validate_format(format)
+
+    def build_query(db):
+        query = db.query(
+            GeneralDiary.ngay_nhap, GeneralDiary.so_hieu, GeneralDiary.dien_giai,
+            GeneralDiary.tk_no, GeneralDiary.tk_co, GeneralDiary.so_luong_nhap,
+            GeneralDiary.so_luong_xuat, GeneralDiary.so_tien
+        )
+        if fromDate and toDate:
+            query = query.filter(GeneralDiary.ngay_nhap.between(fromDate, toDate))
+        return query.order_by(GeneralDiary.ngay_nhap, GeneralDiary.id)
+
+    return _response(fmt, 'general_diary', GENERAL_DIARY_HEADERS, _stream_query(build_query))
+
+
+@router.get("/reports/debt-report")
+def export_debt_report(
+    format: str = Query('csv', description="csv hoặc xlsx"),
+    sort: Optional[str] = Query(None, description="Sắp xếp theo số còn nợ: asc hoặc desc"),
+    db: Session = Depends(get_db)
+):
+    """Xuất báo cáo công nợ theo khách hàng"""
+    fmt = _validate_format(format)
+    if sort is not None and sort not in reports.DEBT_SORT_ORDERS:
+        raise HTTPException(status_code=422, detail=f"sort phải là một trong: {', '.join(reports.DEBT_SORT_ORDERS)}")
+    rows = [
+        (item['ten_khach_hang'], item['tong_cong_no'], item['da_thanh_toan'], item['con_no'], item['trang_thai'])
+        for item in reports._build_debt_report(db, sort=sort)
+    ]
+    return _response(fmt, 'debt_report', DEBT_HEADERS, iter(rows))
+
+
+@router.get("/reports/revenue-by-date")
+def export_revenue_by_date(
+    from_date: str = Query(..., description="Ngày bắt đầu (YYYY-MM-DD)"),
+    to_date: str = Query(..., description="Ngày kết thúc (YYYY-MM-DD)"),
+    granularity: str = Query('day', description="Gom nhóm theo: day, week, month, quarter, year"),
+    format: str = Query('csv', description="csv hoặc xlsx"),
+    db: Session = Depends(get_db)
+):
+    """Xuất báo cáo doanh thu theo kỳ"""
+    fmt = _validate_format(format)
+    granularity = reports._validate_granularity(granularity)
+    start_date, end_date = reports._parse_date_range(from_date, to_date)
+    data, _ = reports._build_revenue_by_date(db, start_date, end_date, granularity)
+    rows = [
+        (column['date'], column['date_key'], column['revenue'], column['quantity_sold'])
+        for column in data['columns']
+    ]
+    return _response(fmt, 'revenue_by_date', REVENUE_HEADERS, iter(rows))
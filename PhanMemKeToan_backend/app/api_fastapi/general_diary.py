@@ -3,9 +3,14 @@ from sqlalchemy.orm import Session
 from ..database import get_db
 from ..models import GeneralDiary
 from .. import crud, schemas_fastapi
+from .. import pagination
+from ..pagination import PageParams, page_params
+from datetime import date
 
 router = APIRouter(prefix="/general-diary", tags=["general-diary"])
 
+GENERAL_DIARY_SORT_FIELDS = {'id': GeneralDiary.id, 'ngay_nhap': GeneralDiary.ngay_nhap}
+
 
 @router.get("/{entry_id}")
 def get_general_diary_entry(entry_id: int, db: Session = Depends(get_db)):
@@ -16,9 +21,24 @@ def get_general_diary_entry(entry_id: int, db: Session = Depends(get_db)):
 
 
 @router.get("/")
-def get_general_diary(db: Session = Depends(get_db)):
-    entries = crud.get_general_diary(db)
-    return {"success": True, "data": entries}
+def get_general_diary(
+    tk_no: str | None = None,
+    tk_co: str | None = None,
+    tu_ngay: date | None = None,
+    den_ngay: date | None = None,
+    page: PageParams = Depends(page_params),
+    db: Session = Depends(get_db)
+):
+    query = pagination.search(db.query(GeneralDiary), page.q, [GeneralDiary.so_hieu, GeneralDiary.dien_giai])
+    if tk_no:
+        query = query.filter(GeneralDiary.tk_no == tk_no)
+    if tk_co:
+        query = query.filter(GeneralDiary.tk_co == tk_co)
+    query = pagination.between(query, GeneralDiary.ngay_nhap, tu_ngay, den_ngay)
+    if page.is_legacy:
+        return {"success": True, "data": query.all()}
+    rows, page_info = pagination.paginate(query, page, GENERAL_DIARY_SORT_FIELDS, GeneralDiary.id)
+    return pagination.page_response([schemas_fastapi.GeneralDiaryOut.model_validate(entry) for entry in rows], page_info)
 
 
 @router.post("/")
@@ -1,120 +1,124 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from ..database import get_db
-from ..models import Invoice, Debt
-from ..schemas_fastapi import InvoiceOut, InvoiceCreate, InvoiceUpdate
-from datetime import datetime
+from ..models import Invoice, PaymentAllocation
+from ..schemas_fastapi import InvoiceOut, InvoiceCreate, InvoiceUpdate, InvoiceSearch
+from .. import sales_rollup, payments, debts, customers, document_numbers
+from .. import pagination
+from ..pagination import PageParams, page_params
+from datetime import date
 
 
 router = APIRouter(prefix="/invoices", tags=["invoices"])
 
-
-@router.get("/", response_model=list[InvoiceOut])
-def list_invoices(db: Session = Depends(get_db)):
-    return db.query(Invoice).all()
+INVOICE_SORT_FIELDS = {'id': Invoice.id, 'ngay_hd': Invoice.ngay_hd, 'so_hd': Invoice.so_hd}
+
+
+@router.get("/")
+def list_invoices(
+    trang_thai: str | None = None,
+    nguoi_mua: str | None = None,
+    account_id: int | None = None,
+    tu_ngay: date | None = None,
+    den_ngay: date | None = None,
+    page: PageParams = Depends(page_params),
+    db: Session = Depends(get_db)
+):
+    query = pagination.search(db.query(Invoice), page.q, [Invoice.so_hd, Invoice.nguoi_mua])
+    if trang_thai:
+        query = query.filter(Invoice.trang_thai == trang_thai)
+    if nguoi_mua:
+        query = query.filter(Invoice.nguoi_mua == nguoi_mua)
+    if account_id is not None:
+        query = query.filter(Invoice.account_id == account_id)
+    query = pagination.between(query, Invoice.ngay_hd, tu_ngay, den_ngay)
+    if page.is_legacy:
+        return [InvoiceOut.model_validate(inv) for inv in query.all()]
+    rows, page_info = pagination.paginate(query, page, INVOICE_SORT_FIELDS, Invoice.id)
+    return pagination.page_response([InvoiceOut.model_validate(inv) for inv in rows], page_info)
 
 
 @router.post("/")
 def create_invoice(payload: InvoiceCreate, db: Session = Depends(get_db)):
+    account_id = customers.account_for(db, payload.account_id, payload.nguoi_mua)
+    so_hd = (payload.so_hd or '').strip()
+    if so_hd and document_numbers.is_series_code(db, document_numbers.INVOICE, so_hd):
+        raise HTTPException(status_code=400, detail=document_numbers.series_code_detail(so_hd))
     try:
+        # Không có số hóa đơn: cấp số tiếp theo của dãy (nguyên tử, không cần kiểm tra trùng)
+        so_hd = so_hd or document_numbers.allocate_one(db, document_numbers.INVOICE)
+        
         # Tạo hóa đơn mới
         inv = Invoice(
-            so_hd=payload.so_hd,
+            so_hd=so_hd,
             ngay_hd=payload.ngay_hd,
             nguoi_mua=payload.nguoi_mua,
+            account_id=account_id,
             tong_tien=payload.tong_tien,
             loai_hd=payload.loai_hd,
             trang_thai=payload.trang_thai,
         )
+        payments.sync_invoice_paid(inv)
         db.add(inv)
+        db.flush()
+        
+        # Cập nhật bảng tổng hợp doanh thu theo ngày và công nợ (cùng transaction)
+        sales_rollup.apply_invoices(db, Invoice.id == inv.id)
+        debts.apply_invoice(db, inv)
         db.commit()
         db.refresh(inv)
         
-        # Cập nhật bảng công nợ
-        update_debt_for_customer(payload.nguoi_mua, db)
-        
-        return {"success": True, "id": inv.id}
+        return {"success": True, "id": inv.id, "so_hd": inv.so_hd}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Lỗi tạo hóa đơn: {str(e)}")
 
 
-def update_debt_for_customer(customer_name: str, db: Session):
-    """Cập nhật bảng công nợ cho khách hàng"""
-    try:
-        # Tìm tất cả hóa đơn của khách hàng này
-        invoices = db.query(Invoice).filter(Invoice.nguoi_mua == customer_name).all()
-        
-        if not invoices:
-            return
-        
-        # Tính tổng công nợ và số tiền đã thanh toán
-        total_debt = sum(float(getattr(invoice, 'tong_tien', 0) or 0) for invoice in invoices)
-        paid_amount = sum(float(getattr(invoice, 'tong_tien', 0) or 0) for invoice in invoices 
-                         if str(getattr(invoice, 'trang_thai', '') or '') == 'Đã thanh toán')
-        remaining_debt = total_debt - paid_amount
-        
-        # Tìm hoặc tạo record trong bảng Debt
-        debt_record = db.query(Debt).filter(Debt.customer_name == customer_name).first()
-        
-        if debt_record:
-            # Cập nhật record hiện có
-            setattr(debt_record, 'total_debt', total_debt)
-            setattr(debt_record, 'paid_amount', paid_amount)
-            setattr(debt_record, 'remaining_debt', remaining_debt)
-            setattr(debt_record, 'status', 'Hết nợ' if remaining_debt <= 0 else 'Còn nợ')
-            if paid_amount > 0:
-                setattr(debt_record, 'last_payment_date', datetime.now())
-        else:
-            # Tạo record mới
-            debt_record = Debt(
-                customer_name=customer_name,
-                total_debt=total_debt,
-                paid_amount=paid_amount,
-                remaining_debt=remaining_debt,
-                status='Hết nợ' if remaining_debt <= 0 else 'Còn nợ',
-                created_at=datetime.now()
-            )
-            db.add(debt_record)
-        
-        db.commit()
-        print(f"✅ Đã cập nhật công nợ cho {customer_name}: Tổng={total_debt:,.0f}, Đã trả={paid_amount:,.0f}, Còn nợ={remaining_debt:,.0f}")
-        
-    except Exception as e:
-        print(f"❌ Lỗi cập nhật công nợ cho {customer_name}: {e}")
-        db.rollback()
-
-
 @router.put("/{invoice_id:int}")
 def update_invoice(invoice_id: int, payload: InvoiceUpdate, db: Session = Depends(get_db)):
     try:
         inv = db.query(Invoice).get(invoice_id)
         if not inv:
             raise HTTPException(status_code=404, detail="Không tìm thấy hóa đơn")
+        if (
+            payload.so_hd is not None and payload.so_hd != inv.so_hd
+            and document_numbers.is_series_code(db, document_numbers.INVOICE, payload.so_hd)
+        ):
+            raise HTTPException(status_code=400, detail=document_numbers.series_code_detail(payload.so_hd))
+        # Khóa hóa đơn của khách hàng: khoản thanh toán đồng thời không phân bổ vào số cũ
+        old_customer = sales_rollup.customer_key(inv.account_id, inv.nguoi_mua)
+        payments.lock_invoices(db, old_customer)
+        db.refresh(inv)
         
-        # Lưu tên khách hàng cũ để cập nhật công nợ
-        old_customer_name = inv.nguoi_mua
+        # Trừ phần đóng góp cũ khỏi bảng tổng hợp doanh thu và công nợ
+        sales_rollup.apply_invoices(db, Invoice.id == inv.id, -1)
+        debts.apply_invoice(db, inv, -1)
         
         # Cập nhật hóa đơn
         if payload.so_hd is not None: setattr(inv, 'so_hd', payload.so_hd)
         if payload.ngay_hd is not None: setattr(inv, 'ngay_hd', payload.ngay_hd)
         if payload.nguoi_mua is not None: setattr(inv, 'nguoi_mua', payload.nguoi_mua)
+        if payload.account_id is not None or payload.nguoi_mua is not None:
+            inv.account_id = customers.account_for(db, payload.account_id, inv.nguoi_mua)
         if payload.tong_tien is not None: setattr(inv, 'tong_tien', payload.tong_tien)
         if payload.loai_hd is not None: setattr(inv, 'loai_hd', payload.loai_hd)
         if payload.trang_thai is not None: setattr(inv, 'trang_thai', payload.trang_thai)
-        
+        new_customer = sales_rollup.customer_key(inv.account_id, inv.nguoi_mua)
+        payments.reconcile_invoice(db, inv, customer_changed=new_customer != old_customer)
+        
+        db.flush()
+        sales_rollup.apply_invoices(db, Invoice.id == inv.id)
+        debts.apply_invoice(db, inv)
+        # Phần phân bổ được trả về khoản thanh toán: phân bổ lại FIFO
+        payments.allocate_surplus(db, old_customer)
+        if new_customer != old_customer:
+            payments.allocate_surplus(db, new_customer)
         db.commit()
         
-        # Cập nhật công nợ cho khách hàng cũ (nếu có thay đổi)
-        if old_customer_name:
-            update_debt_for_customer(old_customer_name, db)
-        
-        # Cập nhật công nợ cho khách hàng mới
-        new_customer_name = payload.nguoi_mua if payload.nguoi_mua is not None else old_customer_name
-        if new_customer_name and new_customer_name != old_customer_name:
-            update_debt_for_customer(new_customer_name, db)
-        
         return {"success": True}
+    except (HTTPException, customers.UnknownAccount):
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Lỗi cập nhật hóa đơn: {str(e)}")
@@ -135,17 +139,20 @@ def delete_invoice(invoice_id: int, db: Session = Depends(get_db)):
         if not inv:
             raise HTTPException(status_code=404, detail="Không tìm thấy hóa đơn")
         
-        # Lưu tên khách hàng để cập nhật công nợ
-        customer_name = inv.nguoi_mua
+        customer = sales_rollup.customer_key(inv.account_id, inv.nguoi_mua)
+        payments.lock_invoices(db, customer)
+        db.refresh(inv)
         
-        # Xóa hóa đơn
+        # Xóa hóa đơn (trừ phần đóng góp khỏi bảng tổng hợp và công nợ trong cùng transaction)
+        sales_rollup.apply_invoices(db, Invoice.id == inv.id, -1)
+        debts.apply_invoice(db, inv, -1)
+        # Phần đã phân bổ vào hóa đơn trở về khoản thanh toán và được phân bổ lại FIFO
+        db.query(PaymentAllocation).filter(PaymentAllocation.invoice_id == inv.id).delete(synchronize_session=False)
         db.delete(inv)
+        db.flush()
+        payments.allocate_surplus(db, customer)
         db.commit()
         
-        # Cập nhật công nợ cho khách hàng
-        if customer_name:
-            update_debt_for_customer(customer_name, db)
-        
         return {"success": True}
     except Exception as e:
         db.rollback()
@@ -154,37 +161,44 @@ def delete_invoice(invoice_id: int, db: Session = Depends(get_db)):
 
 @router.get("/next-number")
 def next_invoice_number(db: Session = Depends(get_db)):
-    last = db.query(Invoice).order_by(Invoice.id.desc()).first()
-    # Avoid treating SQLAlchemy columns as booleans/strings directly
-    if not last:
-        return {"next_number": 1}
-    so_hd_value = getattr(last, "so_hd", None)
-    if not so_hd_value:
-        return {"next_number": 1}
-    import re
-    m = re.search(r'HĐ-(\d+)', str(so_hd_value))
-    if not m:
-        return {"next_number": 1}
-    return {"next_number": int(m.group(1)) + 1}
+    """Số hóa đơn sẽ được cấp tiếp theo (chỉ để hiển thị; số thật được cấp khi tạo hóa đơn)"""
+    number, so_hd = document_numbers.peek(db, document_numbers.INVOICE)
+    db.commit()
+    return {"next_number": number, "so_hd": so_hd}
+
+
+def filter_invoices(q, criteria: InvoiceSearch):
+    """
+    Áp dụng tiêu chí tìm kiếm hóa đơn (dùng chung cho tìm kiếm và xuất file). Tìm gần
+    đúng dùng index trigram (ix_invoices_so_hd_trgm, ix_invoices_nguoi_mua_trgm), khoảng
+    ngày dùng index (ngay_hd, id).
+    """
+    q = pagination.between(q, Invoice.ngay_hd, criteria.fromDate, criteria.toDate)
+    if criteria.invoiceNumber and criteria.invoiceNumber.strip():
+        q = q.filter(Invoice.so_hd.ilike(f"%{criteria.invoiceNumber.strip()}%"))
+    if criteria.customerInfo and criteria.customerInfo.strip():
+        q = q.filter(Invoice.nguoi_mua.ilike(f"%{criteria.customerInfo.strip()}%"))
+    return q
 
 
 @router.post("/search")
-def search_invoices(criteria: dict, db: Session = Depends(get_db)):
-    q = db.query(Invoice)
-    from_date = criteria.get("fromDate")
-    to_date = criteria.get("toDate")
-    invoice_number = criteria.get("invoiceNumber")
-    customer_info = criteria.get("customerInfo")
-
-    if from_date and to_date:
-        q = q.filter(Invoice.ngay_hd.between(from_date, to_date))
-    if invoice_number:
-        like = f"%{invoice_number}%"
-        q = q.filter(Invoice.so_hd.ilike(like))
-    if customer_info:
-        like = f"%{customer_info}%"
-        q = q.filter(Invoice.nguoi_mua.ilike(like))
-
-    rows = q.all()
-    return {"success": True, "data": rows}
-
+def search_invoices(criteria: InvoiceSearch, db: Session = Depends(get_db)):
+    """
+    Tìm hóa đơn theo khoảng ngày, số hóa đơn và người mua. Có limit/after: phân trang
+    keyset kèm tổng số kết quả (ước lượng khi quá nhiều, xem pagination.count).
+    """
+    if criteria.fromDate and criteria.toDate and criteria.fromDate > criteria.toDate:
+        raise HTTPException(status_code=400, detail="Ngày bắt đầu phải nhỏ hơn ngày kết thúc")
+    if criteria.order not in ('asc', 'desc'):
+        raise HTTPException(status_code=400, detail="order phải là asc hoặc desc")
+    if criteria.limit is not None and not 1 <= criteria.limit <= pagination.MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit phải từ 1 đến {pagination.MAX_LIMIT}")
+    q = filter_invoices(db.query(Invoice), criteria)
+    page = PageParams(criteria.limit, criteria.after, criteria.sort, criteria.order, None, None)
+    if page.is_legacy:
+        return {"success": True, "data": q.all()}
+    rows, page_info = pagination.paginate(q, page, INVOICE_SORT_FIELDS, Invoice.id)
+    # Tổng số chỉ cần cho trang đầu; các trang sau client dùng lại
+    if not criteria.after:
+        page_info['total'], page_info['total_is_estimate'] = pagination.count(q)
+    return pagination.page_response([InvoiceOut.model_validate(inv) for inv in rows], page_info)
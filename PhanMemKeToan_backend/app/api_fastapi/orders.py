@@ -1,10 +1,18 @@
+import logging
+
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from ..database import get_db
-from ..models import Order, OrderItem, Product, Account
-from sqlalchemy import or_
-from ..schemas_fastapi import OrderOut, OrderCreate, OrderUpdate
-from fastapi import Body
+from ..config import Config
+from ..models import Order, OrderItem, Product, Account, Price
+from sqlalchemy import or_, and_, insert, func
+from ..schemas_fastapi import OrderOut, OrderCreate, OrderUpdate, OrderBulkCreate, OrderWithItemsCreate, OrderItemsUpdate, OrderItemOut
+from .. import sales_rollup, stock, stock_ledger, catalog, customers, document_numbers
+from datetime import date
+from .. import pagination
+from ..pagination import PageParams, page_params
+
+logger = logging.getLogger(__name__)
 
 
 def is_cancelled(status: str | None) -> bool:
@@ -12,8 +20,103 @@ def is_cancelled(status: str | None) -> bool:
     return s in ('đã hủy', 'da huy', 'hủy', 'huy', 'canceled', 'cancelled')
 
 
+def stock_usage(is_product: bool, ma_sp: str | None, quantity, status: str | None) -> dict:
+    """Lượng kho mà một đơn hàng giữ {ma_sp: số lượng}: chỉ sản phẩm và đơn không bị hủy"""
+    if is_product and ma_sp and quantity and not is_cancelled(status):
+        return {ma_sp: int(quantity)}
+    return {}
+
+
+def is_product_entry(entry) -> bool:
+    return entry is not None and entry.kind == catalog.PRODUCT
+
+
+def order_total(payload_total, quantity, entry):
+    """
+    Tổng tiền theo đơn giá chuẩn của mã trong catalog: giá chung của sản phẩm hoặc của
+    bảng giá (hành động); mã không có giá thì dùng đơn giá suy ra từ tổng tiền trên payload
+    """
+    if entry is None or not quantity:
+        return payload_total or 0
+    if entry.unit_price is not None:
+        unit_price = float(entry.unit_price or 0)
+    else:
+        unit_price = float(payload_total or 0) / max(int(quantity or 1), 1)
+    return unit_price * int(quantity or 0)
+
+
+def apply_stock_changes(db: Session, changes: dict, order_id: int | None):
+    """
+    Trừ/hoàn kho trong transaction hiện tại và ghi sổ kho với chứng từ là đơn hàng order_id
+    (None: bên gọi tự ghi sổ); không đủ hàng -> rollback và trả lỗi 400
+    """
+    source = (stock_ledger.SOURCE_ORDER, order_id) if order_id is not None else None
+    try:
+        stock.apply_changes(db, changes, source)
+    except stock.InsufficientStock as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def price_lines(db: Session, lines):
+    """
+    Định giá các dòng của đơn hàng nhiều dòng bằng một lần tra catalog (chỉ nhận sản
+    phẩm có tồn kho). Trả về (danh sách dòng, tổng số lượng theo ma_sp); dòng lỗi -> 400.
+    """
+    if not lines:
+        raise HTTPException(status_code=400, detail="Đơn hàng phải có ít nhất một dòng sản phẩm")
+    codes = [(line.ma_sp or '').strip() for line in lines]
+    entries = catalog.catalog_cache.lookup(db, codes)
+    items = []
+    demand = {}
+    errors = []
+    for index, (line, code) in enumerate(zip(lines, codes)):
+        entry = entries.get(code)
+        if not is_product_entry(entry):
+            errors.append({'index': index, 'ma_sp': code, 'detail': f"'{code}' không phải sản phẩm có tồn kho"})
+            continue
+        if line.so_luong is None or line.so_luong <= 0:
+            errors.append({'index': index, 'ma_sp': code, 'detail': "Số lượng phải lớn hơn 0"})
+            continue
+        unit_price = float(entry.unit_price if entry.unit_price is not None else (line.don_gia or 0))
+        items.append({
+            'product_id': entry.product_id,
+            'so_luong': int(line.so_luong),
+            'don_gia': unit_price,
+            'total_price': unit_price * int(line.so_luong),
+        })
+        demand[code] = demand.get(code, 0) + int(line.so_luong)
+    if errors:
+        raise HTTPException(status_code=400, detail={'message': f"{len(errors)} dòng không hợp lệ", 'errors': errors})
+    return items, demand
+
+
+def has_items(db: Session, order_id: int) -> bool:
+    return db.query(OrderItem.id).filter(OrderItem.order_id == order_id).first() is not None
+
+
+def item_usage(db: Session, order_id: int, status: str | None) -> dict:
+    """Lượng kho mà các dòng của đơn hàng nhiều dòng giữ {ma_sp: số lượng}"""
+    if is_cancelled(status):
+        return {}
+    rows = (
+        db.query(Product.ma_sp, func.sum(OrderItem.so_luong))
+        .join(OrderItem, OrderItem.product_id == Product.id)
+        .filter(OrderItem.order_id == order_id)
+        .group_by(Product.ma_sp)
+    )
+    return {ma_sp: int(quantity) for ma_sp, quantity in rows if quantity}
+
+
+def insert_items(db: Session, order_id: int, items):
+    """Chèn các dòng đơn hàng bằng một câu INSERT (executemany)"""
+    db.execute(insert(OrderItem), [dict(item, order_id=order_id) for item in items])
+
+
 router = APIRouter(prefix="/orders", tags=["orders"])
 
+ORDER_SORT_FIELDS = {'id': Order.id, 'ngay_tao': Order.ngay_tao, 'ma_don_hang': Order.ma_don_hang}
+
 
 @router.get("/check-duplicate")
 def check_duplicate(ma_don_hang: str = Query(..., description="Mã đơn hàng cần kiểm tra"), db: Session = Depends(get_db)):
@@ -24,22 +127,45 @@ def check_duplicate(ma_don_hang: str = Query(..., description="Mã đơn hàng c
     return {"exists": exists}
 
 
-@router.get("/", response_model=list[OrderOut])
-def list_orders(db: Session = Depends(get_db)):
-    return db.query(Order).all()
-
-
-@router.get("/{order_id}", response_model=OrderOut)
-def get_order(order_id: int, db: Session = Depends(get_db)):
-    o = db.query(Order).get(order_id)
-    if not o:
-        raise HTTPException(status_code=404, detail="Không tìm thấy đơn hàng")
-    return o
+@router.get("/")
+def list_orders(
+    trang_thai: str | None = None,
+    thong_tin_kh: str | None = None,
+    account_id: int | None = None,
+    tu_ngay: date | None = None,
+    den_ngay: date | None = None,
+    page: PageParams = Depends(page_params),
+    db: Session = Depends(get_db)
+):
+    query = pagination.search(db.query(Order), page.q, [Order.ma_don_hang, Order.thong_tin_kh, Order.sp_banggia])
+    if trang_thai:
+        query = query.filter(Order.trang_thai == trang_thai)
+    if thong_tin_kh:
+        query = query.filter(Order.thong_tin_kh == thong_tin_kh)
+    if account_id is not None:
+        query = query.filter(Order.account_id == account_id)
+    query = pagination.between(query, Order.ngay_tao, tu_ngay, den_ngay)
+    if page.is_legacy:
+        return [OrderOut.model_validate(o) for o in query.all()]
+    rows, page_info = pagination.paginate(query, page, ORDER_SORT_FIELDS, Order.id)
+    return pagination.page_response([OrderOut.model_validate(o) for o in rows], page_info)
 
 
 @router.get("/search")
-def search_orders(customer_id: int | None = None, q: str | None = None, db: Session = Depends(get_db)):
-    query = db.query(Order)
+def search_orders(
+    customer_id: int | None = None,
+    q: str | None = None,
+    limit: int | None = Query(None, ge=1, le=1000, description="Số đơn hàng mỗi trang (không truyền: trả về tất cả)"),
+    cursor: int | None = Query(None, description="next_cursor của trang trước (id đơn hàng cuối cùng)"),
+    db: Session = Depends(get_db)
+):
+    # Loại SP suy ra ngay trong câu truy vấn: outer join products và bảng giá "Hành động"
+    is_product = and_(Product.id.isnot(None), Price.id.is_(None))
+    query = (
+        db.query(Order.id, Order.ma_don_hang, Order.tong_tien, Order.trang_thai, Order.sp_banggia, is_product.label('is_product'))
+        .outerjoin(Product, Product.ma_sp == Order.sp_banggia)
+        .outerjoin(Price, and_(Price.ma_sp == Order.sp_banggia, Price.loai_sp == catalog.ACTION_PRICE_TYPE))
+    )
     if customer_id is not None:
         # Map id -> thông tin tài khoản và lọc linh hoạt theo thong_tin_kh
         acc = None
@@ -52,6 +178,8 @@ def search_orders(customer_id: int | None = None, q: str | None = None, db: Sess
             tk_no = (acc.tk_no or '').strip()
             tk_co = (acc.tk_co or '').strip()
             composite = f"{tk_no} - {tk_co} - {name}".strip()
+            # Đơn hàng đã gắn tài khoản: tra theo account_id (index); đơn cũ chưa gắn được
+            # tài khoản vẫn lọc theo ILIKE '%...%' (index trigram ix_orders_thong_tin_kh_trgm)
             patterns = [
                 Order.thong_tin_kh.ilike(f"%{name}%") if name else None,
                 Order.thong_tin_kh.ilike(f"%{composite}%") if composite else None,
@@ -59,21 +187,26 @@ def search_orders(customer_id: int | None = None, q: str | None = None, db: Sess
                 Order.thong_tin_kh.ilike(f"%{tk_co}%") if tk_co else None,
             ]
             patterns = [p for p in patterns if p is not None]
-            if patterns:
-                query = query.filter(or_(*patterns))
+            unlinked = and_(Order.account_id.is_(None), or_(*patterns)) if patterns else None
+            query = query.filter(or_(Order.account_id == acc.id, unlinked) if unlinked is not None else Order.account_id == acc.id)
     if q:
         ql = f"%{q}%"
         query = query.filter((Order.ma_don_hang.ilike(ql)) | (Order.trang_thai.ilike(ql)))
     # Chỉ trả về đơn hàng Hoàn thành
     query = query.filter(Order.trang_thai.ilike('%Hoàn thành%'))
-    results = query.order_by(Order.id.desc()).all()
+    if cursor is not None:
+        query = query.filter(Order.id < cursor)
+    query = query.order_by(Order.id.desc())
+    results = query.limit(limit + 1).all() if limit is not None else query.all()
+    has_more = limit is not None and len(results) > limit
+    if has_more:
+        results = results[:limit]
     out = []
     for o in results:
-        # xác định loại SP dựa trên sp_banggia và bảng products
+        # xác định loại SP dựa trên sp_banggia (sản phẩm hoặc bảng giá/hành động)
         loai = 'Khác'
-        if getattr(o, 'sp_banggia', None):
-            p = db.query(Product).filter(Product.ma_sp == getattr(o, 'sp_banggia', '')).first()
-            loai = 'Sản phẩm' if p is not None else 'Hành động (Bảng giá)'
+        if o.sp_banggia:
+            loai = 'Sản phẩm' if o.is_product else 'Hành động (Bảng giá)'
         out.append({
             'id': o.id,
             'ma_don_hang': o.ma_don_hang,
@@ -82,93 +215,62 @@ def search_orders(customer_id: int | None = None, q: str | None = None, db: Sess
             'sp_banggia': o.sp_banggia,
             'loai_suy_luan': loai,
         })
-    return out
+    if limit is None:
+        return out
+    return {
+        'success': True,
+        'data': out,
+        'pagination': {'limit': limit, 'next_cursor': out[-1]['id'] if has_more else None}
+    }
+
+
+@router.get("/{order_id}", response_model=OrderOut)
+def get_order(order_id: int, db: Session = Depends(get_db)):
+    o = db.query(Order).get(order_id)
+    if not o:
+        raise HTTPException(status_code=404, detail="Không tìm thấy đơn hàng")
+    return o
 
 
 @router.post("/")
 def create_order(payload: OrderCreate, db: Session = Depends(get_db)):
-    print(f"=== DEBUG CREATE ORDER ===")
-    print(f"sp_banggia: {payload.sp_banggia}")
-    print(f"so_luong: {payload.so_luong}")
-    
-    # Tìm sản phẩm và bảng giá dựa trên sp_banggia
-    product = None
-    price_item = None
-    is_product = False
-    is_action = False
-    
-    if payload.sp_banggia:
-        # Tìm trong bảng prices trước để xác định có phải hành động không
-        from ..models import Price
-        price_item = db.query(Price).filter(Price.ma_sp == payload.sp_banggia).first()
-        print(f"Price item found: {price_item}")
-        
-        if price_item and getattr(price_item, 'loai_sp', '') == 'Hành động':
-            # Nếu tìm thấy trong prices và là hành động
-            is_action = True
-            print(f"✅ {payload.sp_banggia} là HÀNH ĐỘNG (từ bảng prices) - KHÔNG kiểm tra tồn kho")
-        else:
-            # Tìm trong bảng products
-            product = db.query(Product).filter(Product.ma_sp == payload.sp_banggia).first()
-            print(f"Product found: {product}")
-            
-            if product:
-                is_product = True
-                print(f"✅ {payload.sp_banggia} là SẢN PHẨM - sẽ kiểm tra tồn kho")
-            else:
-                # Nếu không tìm thấy ở đâu cả, coi như là hành động
-                is_action = True
-                print(f"✅ {payload.sp_banggia} là HÀNH ĐỘNG (không tìm thấy) - KHÔNG kiểm tra tồn kho")
+    # Phân loại sp_banggia qua catalog: bảng giá "Hành động" trước, sau đó tới sản phẩm;
+    # không tìm thấy ở đâu cả thì coi như là hành động
+    entry = catalog.catalog_cache.get(db, payload.sp_banggia) if payload.sp_banggia else None
+    is_product = is_product_entry(entry)
+    logger.debug("create_order %s x%s: catalog entry %s", payload.sp_banggia, payload.so_luong, entry)
     
     # Tính tổng tiền theo đơn giá chuẩn
-    computed_total = payload.tong_tien or 0
-    if payload.so_luong:
-        if is_product and product:
-            unit_price = float(getattr(product, 'gia_chung', 0) or 0)
-            computed_total = unit_price * int(payload.so_luong or 0)
-        elif is_action:
-            # Với hành động, sử dụng giá từ price_item hoặc payload
-            if price_item:
-                unit_price = float(getattr(price_item, 'gia_chung', 0) or 0)
-            else:
-                # Nếu không có price_item, sử dụng giá từ payload
-                unit_price = float(payload.tong_tien or 0) / max(int(payload.so_luong or 1), 1)
-            computed_total = unit_price * int(payload.so_luong or 0)
-    
-    # Kiểm tra mã đơn hàng đã tồn tại chưa
-    existing_order = db.query(Order).filter(Order.ma_don_hang == payload.ma_don_hang).first()
-    if existing_order:
-        print(f"❌ LỖI: Mã đơn hàng {payload.ma_don_hang} đã tồn tại!")
-        raise HTTPException(
-            status_code=400,
-            detail=f"Mã đơn hàng '{payload.ma_don_hang}' đã tồn tại! Vui lòng chọn mã khác."
-        )
+    computed_total = order_total(payload.tong_tien, payload.so_luong, entry)
     
-    # CHỈ kiểm tra và trừ kho nếu là SẢN PHẨM (không phải hành động)
-    print(f"=== INVENTORY CHECK ===")
-    print(f"is_product: {is_product}")
-    print(f"product: {product}")
-    print(f"so_luong: {payload.so_luong}")
-    print(f"trang_thai: {payload.trang_thai}")
-    print(f"is_cancelled: {is_cancelled(payload.trang_thai)}")
-    
-    if is_product and product and payload.so_luong and not is_cancelled(payload.trang_thai):
-        current_qty = int(getattr(product, 'so_luong', 0) or 0)
-        print(f"🔍 Kiểm tra tồn kho: Hiện có {current_qty}, cần {payload.so_luong}")
-        if current_qty < payload.so_luong:
-            print(f"❌ LỖI: Số lượng không đủ!")
+    # Kiểm tra mã đơn hàng đã tồn tại chưa; không nhập mã thì cấp mã tiếp theo của dãy số
+    code = (payload.ma_don_hang or '').strip()
+    if code:
+        existing_order = db.query(Order).filter(Order.ma_don_hang == code).first()
+        if existing_order:
             raise HTTPException(
-                status_code=400, 
-                detail=f"Số lượng sản phẩm {payload.sp_banggia} không đủ! Hiện có: {current_qty}, yêu cầu: {payload.so_luong}"
+                status_code=400,
+                detail=f"Mã đơn hàng '{code}' đã tồn tại! Vui lòng chọn mã khác."
             )
-        print(f"✅ Số lượng đủ, tiếp tục tạo đơn hàng")
+        if document_numbers.is_series_code(db, document_numbers.ORDER, code):
+            raise HTTPException(status_code=400, detail=document_numbers.series_code_detail(code))
     else:
-        print(f"⏭️ Bỏ qua kiểm tra tồn kho (không phải sản phẩm hoặc đơn bị hủy)")
+        code = document_numbers.allocate_one(db, document_numbers.ORDER)
+    
+    # CHỈ kiểm tra và trừ kho nếu là SẢN PHẨM (không phải hành động)
+    usage = stock_usage(is_product, payload.sp_banggia, payload.so_luong, payload.trang_thai)
+    
+    # Đơn hàng đầu tiên của khách hàng sẽ gắn sản phẩm cho các hóa đơn của khách đó
+    account_id = customers.account_for(db, payload.account_id, payload.thong_tin_kh)
+    customer = sales_rollup.customer_key(account_id, payload.thong_tin_kh)
+    attribution = sales_rollup.attribution_customers(db, None, None, customer)
+    sales_rollup.apply_customers(db, attribution, -1)
     
     # Tạo đơn hàng
     o = Order(
-        ma_don_hang=payload.ma_don_hang,
+        ma_don_hang=code,
         thong_tin_kh=payload.thong_tin_kh,
+        account_id=account_id,
         sp_banggia=payload.sp_banggia,
         ngay_tao=payload.ngay_tao,
         ma_co_quan_thue=payload.ma_co_quan_thue,
@@ -178,22 +280,191 @@ def create_order(payload: OrderCreate, db: Session = Depends(get_db)):
         trang_thai=payload.trang_thai,
     )
     db.add(o)
+    db.flush()
+    
+    # Trừ kho bằng UPDATE có điều kiện (so_luong >= số lượng) trong cùng transaction với đơn hàng:
+    # kiểm tra và trừ là nguyên tử nên các đơn đồng thời không thể bán vượt tồn kho
+    apply_stock_changes(db, usage, o.id)
+    
+    # Cập nhật bảng tổng hợp doanh thu theo ngày (cùng transaction)
+    sales_rollup.apply_orders(db, Order.id == o.id)
+    sales_rollup.apply_customers(db, attribution)
     db.commit()
     db.refresh(o)
+    return {"success": True, "id": o.id, "ma_don_hang": o.ma_don_hang}
+
+
+@router.post("/bulk")
+def create_orders_bulk(payload: OrderBulkCreate, db: Session = Depends(get_db)):
+    """
+    Nhập nhiều đơn hàng trong một transaction: mã SP được phân loại qua catalog (các mã
+    chưa có trong cache được tra chung một câu truy vấn), đơn hàng được chèn bằng bulk insert và mỗi sản phẩm chỉ
+    trừ kho một lần theo tổng số lượng. allow_partial=True: các dòng lỗi được báo lại,
+    các dòng hợp lệ vẫn được lưu; ngược lại có lỗi thì không lưu dòng nào. Dòng không có
+    mã đơn hàng được cấp mã từ dãy số đơn hàng.
+    """
+    rows = payload.orders
+    if not rows:
+        raise HTTPException(status_code=400, detail="Danh sách đơn hàng trống")
+    if len(rows) > Config.ORDER_BULK_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {Config.ORDER_BULK_MAX_ROWS} đơn hàng mỗi lần nhập")
     
-    # CHỈ trừ số lượng sản phẩm nếu là SẢN PHẨM và đơn không bị hủy
-    if is_product and product and payload.so_luong and not is_cancelled(payload.trang_thai):
-        new_qty = max(int(getattr(product, 'so_luong', 0) or 0) - int(payload.so_luong or 0), 0)
-        setattr(product, 'so_luong', new_qty)
-        setattr(product, 'trang_thai', 'Còn hàng' if new_qty > 0 else 'Hết hàng')
-        db.commit()
+    errors = {}
+    codes = [(row.ma_don_hang or '').strip() for row in rows]
+    sp_codes = {row.sp_banggia for row in rows if row.sp_banggia}
+    existing_codes = {c for (c,) in db.query(Order.ma_don_hang).filter(Order.ma_don_hang.in_(set(codes) - {''}))}
+    series_codes = document_numbers.series_pattern(db, document_numbers.ORDER)
+    resolved_accounts = customers.resolve(db, {row.thong_tin_kh for row in rows if row.account_id is None})
+    requested_accounts = {row.account_id for row in rows if row.account_id is not None}
+    known_accounts = {
+        account_id for (account_id,) in db.query(Account.id).filter(Account.id.in_(requested_accounts))
+    } if requested_accounts else set()
+    entries = catalog.catalog_cache.lookup(db, sp_codes)
+    product_codes = [code for code, entry in entries.items() if is_product_entry(entry)]
+    # Khóa các dòng sản phẩm (theo thứ tự ma_sp) để số tồn kho đọc được không đổi tới khi commit
+    available_stock = dict(
+        db.query(Product.ma_sp, Product.so_luong)
+        .filter(Product.ma_sp.in_(product_codes))
+        .order_by(Product.ma_sp)
+        .with_for_update()
+    ) if product_codes else {}
+    # Sản phẩm bán chạy: tồn kho là tổng các shard (có thể đổi trước khi trừ kho,
+    # apply_stock_changes vẫn kiểm tra lại khi trừ)
+    available_stock.update(stock.available(db, [code for code in product_codes if code in available_stock]))
     
-    print(f"=== ORDER CREATED SUCCESSFULLY ===")
-    print(f"Order ID: {o.id}")
-    print(f"Final is_product: {is_product}")
-    print(f"Final is_action: {is_action}")
+    seen = set()
+    values = []
+    usages = []
+    demand = {}
+    for index, (row, code) in enumerate(zip(rows, codes)):
+        if code in existing_codes:
+            errors[index] = f"Mã đơn hàng '{code}' đã tồn tại!"
+        elif code in seen:
+            errors[index] = f"Mã đơn hàng '{code}' bị trùng trong danh sách nhập"
+        elif code and series_codes.fullmatch(code):
+            errors[index] = document_numbers.series_code_detail(code)
+        elif row.ngay_tao is None:
+            errors[index] = "Ngày tạo không được để trống"
+        elif row.account_id is not None and row.account_id not in known_accounts:
+            errors[index] = f"Không tìm thấy khách hàng (account_id={row.account_id})"
+        if index in errors:
+            continue
+        if code:
+            seen.add(code)
+        
+        # Phân loại như create_order: hành động (bảng giá) hoặc sản phẩm (có trong products)
+        entry = entries.get(row.sp_banggia)
+        
+        # Kiểm tra tồn kho theo thứ tự dòng: các dòng sau dùng phần tồn kho còn lại
+        usage = stock_usage(is_product_entry(entry), row.sp_banggia, row.so_luong, row.trang_thai)
+        for ma_sp, quantity in usage.items():
+            available = int(available_stock.get(ma_sp) or 0) - demand.get(ma_sp, 0)
+            if available < quantity:
+                errors[index] = f"Số lượng sản phẩm {ma_sp} không đủ! Hiện có: {available}, yêu cầu: {quantity}"
+        if index in errors:
+            continue
+        for ma_sp, quantity in usage.items():
+            demand[ma_sp] = demand.get(ma_sp, 0) + quantity
+        
+        values.append({
+            'ma_don_hang': code,
+            'thong_tin_kh': row.thong_tin_kh,
+            'account_id': row.account_id if row.account_id is not None else resolved_accounts.get(row.thong_tin_kh),
+            'sp_banggia': row.sp_banggia,
+            'ngay_tao': row.ngay_tao,
+            'ma_co_quan_thue': row.ma_co_quan_thue,
+            'so_luong': row.so_luong,
+            'tong_tien': order_total(row.tong_tien, row.so_luong, entry),
+            'hinh_thuc_tt': row.hinh_thuc_tt,
+            'trang_thai': row.trang_thai,
+        })
+        usages.append(usage)
+    
+    error_list = [
+        {'index': index, 'ma_don_hang': codes[index], 'detail': detail}
+        for index, detail in sorted(errors.items())
+    ]
+    if error_list and not payload.allow_partial:
+        db.rollback()
+        raise HTTPException(status_code=400, detail={'message': f"{len(error_list)} đơn hàng không hợp lệ", 'errors': error_list})
+    if not values:
+        db.rollback()
+        return {"success": False, "created": 0, "ids": [], "errors": error_list}
+    
+    # Các dòng không có mã: cấp mã liên tiếp của dãy số đơn hàng bằng một lần cấp
+    unnamed = [v for v in values if not v['ma_don_hang']]
+    for value, code in zip(unnamed, document_numbers.allocate(db, document_numbers.ORDER, len(unnamed))):
+        value['ma_don_hang'] = code
+    
+    # Khách hàng chưa có đơn hàng: đơn đầu tiên trong lô sẽ gắn sản phẩm cho hóa đơn của họ
+    attribution = sales_rollup.customers_without_orders(
+        db, {sales_rollup.customer_key(v['account_id'], v['thong_tin_kh']) for v in values}
+    )
+    sales_rollup.apply_customers(db, attribution, -1)
+    
+    apply_stock_changes(db, demand, None)
+    ids = [order_id for (order_id,) in db.execute(insert(Order).returning(Order.id, sort_by_parameter_order=True), values)]
+    # Sổ kho: mỗi đơn hàng một movement cho sản phẩm của nó
+    stock_ledger.record(db, [
+        (entries[ma_sp].product_id, -quantity, stock_ledger.SOURCE_ORDER, order_id)
+        for order_id, usage in zip(ids, usages)
+        for ma_sp, quantity in usage.items()
+    ])
+    
+    created_codes = [v['ma_don_hang'] for v in values]
+    sales_rollup.apply_orders(db, Order.ma_don_hang.in_(created_codes))
+    sales_rollup.apply_customers(db, attribution)
+    db.commit()
+    return {"success": True, "created": len(ids), "ids": ids, "errors": error_list}
+
+
+@router.post("/with-items")
+def create_order_with_items(payload: OrderWithItemsCreate, db: Session = Depends(get_db)):
+    """
+    Tạo đơn hàng nhiều dòng sản phẩm: định giá mọi dòng bằng một lần tra catalog, trừ kho
+    mọi sản phẩm bằng một câu UPDATE và chèn các dòng order_items bằng một câu INSERT.
+    Đơn hàng lưu tổng số lượng/tổng tiền; sp_banggia để trống (sản phẩm nằm trong các dòng).
+    """
+    code = (payload.ma_don_hang or '').strip()
+    if payload.ngay_tao is None:
+        raise HTTPException(status_code=400, detail="Ngày tạo không được để trống")
+    if code and db.query(Order.id).filter(Order.ma_don_hang == code).first():
+        raise HTTPException(
+            status_code=400,
+            detail=f"Mã đơn hàng '{code}' đã tồn tại! Vui lòng chọn mã khác."
+        )
+    if code and document_numbers.is_series_code(db, document_numbers.ORDER, code):
+        raise HTTPException(status_code=400, detail=document_numbers.series_code_detail(code))
+    
+    items, demand = price_lines(db, payload.items)
+    code = code or document_numbers.allocate_one(db, document_numbers.ORDER)
     
-    return {"success": True, "id": o.id}
+    account_id = customers.account_for(db, payload.account_id, payload.thong_tin_kh)
+    customer = sales_rollup.customer_key(account_id, payload.thong_tin_kh)
+    attribution = sales_rollup.attribution_customers(db, None, None, customer)
+    sales_rollup.apply_customers(db, attribution, -1)
+    
+    o = Order(
+        ma_don_hang=code,
+        thong_tin_kh=payload.thong_tin_kh,
+        account_id=account_id,
+        sp_banggia=None,
+        ngay_tao=payload.ngay_tao,
+        ma_co_quan_thue=payload.ma_co_quan_thue,
+        so_luong=sum(item['so_luong'] for item in items),
+        tong_tien=sum(item['total_price'] for item in items),
+        hinh_thuc_tt=payload.hinh_thuc_tt,
+        trang_thai=payload.trang_thai,
+    )
+    db.add(o)
+    db.flush()
+    apply_stock_changes(db, {} if is_cancelled(payload.trang_thai) else demand, o.id)
+    insert_items(db, o.id, items)
+    
+    sales_rollup.apply_orders(db, Order.id == o.id)
+    sales_rollup.apply_customers(db, attribution)
+    db.commit()
+    return {"success": True, "id": o.id, "ma_don_hang": o.ma_don_hang, "so_dong": len(items), "tong_tien": o.tong_tien}
 
 
 @router.put("/{order_id}")
@@ -201,6 +472,11 @@ def update_order(order_id: int, payload: OrderUpdate, db: Session = Depends(get_
     o = db.query(Order).get(order_id)
     if not o:
         raise HTTPException(status_code=404, detail="Không tìm thấy đơn hàng")
+    if (
+        payload.ma_don_hang is not None and payload.ma_don_hang != o.ma_don_hang
+        and document_numbers.is_series_code(db, document_numbers.ORDER, payload.ma_don_hang)
+    ):
+        raise HTTPException(status_code=400, detail=document_numbers.series_code_detail(payload.ma_don_hang))
     
     # Trạng thái cũ/mới
     old_status = o.trang_thai
@@ -210,70 +486,50 @@ def update_order(order_id: int, payload: OrderUpdate, db: Session = Depends(get_
     old_quantity = o.so_luong or 0
     old_sp_banggia = o.sp_banggia
     
-    # Phân biệt sản phẩm cũ và mới
-    old_product = None
-    new_product = None
-    old_price_item = None
-    new_price_item = None
-    old_is_product = False
-    new_is_product = False
-    old_is_action = False
-    new_is_action = False
-    
-    # Kiểm tra loại cũ
-    if old_sp_banggia:
-        from ..models import Price
-        old_price_item = db.query(Price).filter(Price.ma_sp == old_sp_banggia).first()
-        
-        if old_price_item and getattr(old_price_item, 'loai_sp', '') == 'Hành động':
-            old_is_action = True
-        else:
-            old_product = db.query(Product).filter(Product.ma_sp == old_sp_banggia).first()
-            if old_product:
-                old_is_product = True
-            else:
-                old_is_action = True
-    
-    # Kiểm tra loại mới
+    # Phân loại sản phẩm cũ và mới qua catalog (hành động hoặc sản phẩm)
+    old_entry = catalog.catalog_cache.get(db, old_sp_banggia) if old_sp_banggia else None
     if payload.sp_banggia is not None:
-        if payload.sp_banggia:
-            from ..models import Price
-            new_price_item = db.query(Price).filter(Price.ma_sp == payload.sp_banggia).first()
-            
-            if new_price_item and getattr(new_price_item, 'loai_sp', '') == 'Hành động':
-                new_is_action = True
-            else:
-                new_product = db.query(Product).filter(Product.ma_sp == payload.sp_banggia).first()
-                if new_product:
-                    new_is_product = True
-                else:
-                    new_is_action = True
+        new_entry = catalog.catalog_cache.get(db, payload.sp_banggia) if payload.sp_banggia else None
     else:
         # Giữ nguyên loại cũ
-        new_product = old_product
-        new_price_item = old_price_item
-        new_is_product = old_is_product
-        new_is_action = old_is_action
+        new_entry = old_entry
     
     # Số lượng mới
     new_quantity = payload.so_luong if payload.so_luong is not None else old_quantity
+    new_sp_banggia = payload.sp_banggia if payload.sp_banggia is not None else old_sp_banggia
     
-    # CHỈ kiểm tra kho nếu là SẢN PHẨM và đơn mới không bị hủy
-    if new_is_product and new_product and new_quantity is not None and not is_cancelled(new_status):
-        current_qty = int(getattr(new_product, 'so_luong', 0) or 0)
-        if old_is_product and old_product and getattr(new_product, 'id', None) == getattr(old_product, 'id', None):
-            # Cùng sản phẩm, tính chênh lệch
-            quantity_diff = int(new_quantity or 0) - int(old_quantity or 0)
-            if quantity_diff > 0 and current_qty < quantity_diff:
-                raise HTTPException(status_code=400, detail=f"Số lượng sản phẩm không đủ. Hiện có: {current_qty}, cần thêm: {quantity_diff}")
-        else:
-            # Sản phẩm khác hoặc từ hành động chuyển sang sản phẩm
-            if current_qty < int(new_quantity or 0):
-                raise HTTPException(status_code=400, detail=f"Số lượng sản phẩm không đủ. Hiện có: {current_qty}, yêu cầu: {new_quantity}")
+    # Điều chỉnh kho theo chênh lệch giữa lượng đơn giữ trước và sau khi sửa (trạng thái/sản phẩm/số lượng),
+    # CHỈ CHO SẢN PHẨM; phần tăng thêm được trừ có điều kiện nên không bán vượt tồn kho
+    multi_line = has_items(db, o.id)
+    if multi_line:
+        # Đơn hàng nhiều dòng: sản phẩm/số lượng sửa qua PUT /{order_id}/items, ở đây chỉ đổi trạng thái
+        if payload.sp_banggia is not None or payload.so_luong is not None:
+            raise HTTPException(status_code=400, detail="Đơn hàng nhiều dòng: sửa sản phẩm/số lượng qua /api/orders/{id}/items")
+        old_usage = item_usage(db, o.id, old_status)
+        new_usage = item_usage(db, o.id, new_status)
+    else:
+        old_usage = stock_usage(is_product_entry(old_entry), old_sp_banggia, old_quantity, old_status)
+        new_usage = stock_usage(is_product_entry(new_entry), new_sp_banggia, new_quantity, new_status)
+    apply_stock_changes(db, stock.net_changes(old_usage, new_usage), o.id)
+    
+    # Trừ phần đóng góp cũ khỏi bảng tổng hợp doanh thu
+    if payload.account_id is not None or payload.thong_tin_kh is not None:
+        new_text = payload.thong_tin_kh if payload.thong_tin_kh is not None else o.thong_tin_kh
+        new_account_id = customers.account_for(db, payload.account_id, new_text)
+    else:
+        new_text, new_account_id = o.thong_tin_kh, o.account_id
+    attribution = sales_rollup.attribution_customers(
+        db, o.id,
+        sales_rollup.customer_key(o.account_id, o.thong_tin_kh),
+        sales_rollup.customer_key(new_account_id, new_text)
+    )
+    sales_rollup.apply_orders(db, Order.id == o.id, -1)
+    sales_rollup.apply_customers(db, attribution, -1)
     
     # Cập nhật dữ liệu cơ bản
     if payload.ma_don_hang is not None: o.ma_don_hang = payload.ma_don_hang
     if payload.thong_tin_kh is not None: o.thong_tin_kh = payload.thong_tin_kh
+    o.account_id = new_account_id
     if payload.sp_banggia is not None: o.sp_banggia = payload.sp_banggia
     if payload.ngay_tao is not None: o.ngay_tao = payload.ngay_tao
     if payload.ma_co_quan_thue is not None: o.ma_co_quan_thue = payload.ma_co_quan_thue
@@ -281,69 +537,72 @@ def update_order(order_id: int, payload: OrderUpdate, db: Session = Depends(get_
     if payload.hinh_thuc_tt is not None: o.hinh_thuc_tt = payload.hinh_thuc_tt
     if payload.trang_thai is not None: o.trang_thai = payload.trang_thai
     
-    # Tính lại tổng tiền nếu đơn không bị hủy
-    if new_quantity is not None and not is_cancelled(new_status):
-        if new_is_product and new_product:
-            unit_price = float(getattr(new_product, 'gia_chung', 0) or 0)
-            o.tong_tien = unit_price * int(new_quantity or 0)
-        elif new_is_action:
-            # Với hành động, sử dụng giá từ payload hoặc giá mặc định
-            if new_price_item:
-                unit_price = float(getattr(new_price_item, 'gia_chung', 0) or 0)
-            else:
-                # Nếu không có price_item, sử dụng giá từ payload hoặc giá mặc định
-                unit_price = float(payload.tong_tien or o.tong_tien or 0) / max(int(new_quantity or 1), 1)
-            o.tong_tien = unit_price * int(new_quantity or 0)
-    elif payload.tong_tien is not None:
-        o.tong_tien = payload.tong_tien
+    # Tính lại tổng tiền nếu đơn không bị hủy (đơn nhiều dòng giữ tổng tiền theo các dòng)
+    if not multi_line:
+        if new_quantity is not None and not is_cancelled(new_status):
+            if new_entry is not None:
+                # Mã không có giá trong catalog: dùng giá từ payload hoặc tổng tiền hiện tại
+                o.tong_tien = order_total(payload.tong_tien or o.tong_tien, new_quantity, new_entry) if new_quantity else 0
+        elif payload.tong_tien is not None:
+            o.tong_tien = payload.tong_tien
     
+    db.flush()
+    sales_rollup.apply_orders(db, Order.id == o.id)
+    sales_rollup.apply_customers(db, attribution)
     db.commit()
+    return {"success": True}
+
+
+@router.get("/{order_id}/items")
+def list_order_items(order_id: int, db: Session = Depends(get_db)):
+    if not db.query(Order.id).filter(Order.id == order_id).first():
+        raise HTTPException(status_code=404, detail="Không tìm thấy đơn hàng")
+    rows = (
+        db.query(OrderItem.id, OrderItem.order_id, OrderItem.product_id, Product.ma_sp, Product.ten_sp,
+                 OrderItem.so_luong, OrderItem.don_gia, OrderItem.total_price)
+        .outerjoin(Product, Product.id == OrderItem.product_id)
+        .filter(OrderItem.order_id == order_id)
+        .order_by(OrderItem.id)
+    )
+    return [OrderItemOut.model_validate(row._mapping) for row in rows]
+
+
+@router.put("/{order_id}/items")
+def replace_order_items(order_id: int, payload: OrderItemsUpdate, db: Session = Depends(get_db)):
+    """
+    Thay toàn bộ các dòng của đơn hàng (đơn một sản phẩm cũ cũng được chuyển thành đơn
+    nhiều dòng). Kho chỉ được điều chỉnh theo chênh lệch số lượng từng sản phẩm.
+    """
+    o = db.query(Order).get(order_id)
+    if not o:
+        raise HTTPException(status_code=404, detail="Không tìm thấy đơn hàng")
     
-    # Điều chỉnh kho theo thay đổi trạng thái/sản phẩm/số lượng
-    # 1) Nếu chuyển sang Đã hủy: hoàn trả kho sản phẩm cũ (CHỈ CHO SẢN PHẨM)
-    if is_cancelled(new_status):
-        if old_is_product and old_product:
-            old_qty = int(getattr(old_product, 'so_luong', 0) or 0)
-            setattr(old_product, 'so_luong', old_qty + int(old_quantity or 0))
-            setattr(old_product, 'trang_thai', 'Còn hàng' if (old_qty + int(old_quantity or 0)) > 0 else 'Hết hàng')
-            db.commit()
-        return {"success": True}
-    
-    # 2) Nếu từ Đã hủy chuyển về trạng thái hoạt động: cần trừ kho theo số lượng mới (CHỈ CHO SẢN PHẨM)
-    if is_cancelled(old_status) and not is_cancelled(new_status):
-        if new_is_product and new_product:
-            new_stock = int(getattr(new_product, 'so_luong', 0) or 0)
-            # Trừ toàn bộ số lượng mới
-            new_stock = max(new_stock - int(new_quantity or 0), 0)
-            setattr(new_product, 'so_luong', new_stock)
-            setattr(new_product, 'trang_thai', 'Còn hàng' if new_stock > 0 else 'Hết hàng')
-            db.commit()
-        return {"success": True}
-    
-    # 3) Cả hai đều không bị hủy: xử lý kho (CHỈ CHO SẢN PHẨM)
-    if new_quantity is not None:
-        # Hoàn trả kho cũ nếu là sản phẩm
-        if old_is_product and old_product and (not new_is_product or not new_product or getattr(old_product, 'id', None) != getattr(new_product, 'id', None)):
-            old_qty = int(getattr(old_product, 'so_luong', 0) or 0)
-            setattr(old_product, 'so_luong', old_qty + int(old_quantity or 0))
-            setattr(old_product, 'trang_thai', 'Còn hàng' if (old_qty + int(old_quantity or 0)) > 0 else 'Hết hàng')
-        
-        # Trừ kho mới nếu là sản phẩm
-        if new_is_product and new_product:
-            new_stock = int(getattr(new_product, 'so_luong', 0) or 0)
-            if old_is_product and old_product and getattr(new_product, 'id', None) == getattr(old_product, 'id', None):
-                # Cùng sản phẩm: tính chênh lệch
-                quantity_diff = int(new_quantity or 0) - int(old_quantity or 0)
-                new_stock = max(new_stock - max(quantity_diff, 0), 0)
-            else:
-                # Sản phẩm khác: trừ toàn bộ số lượng mới
-                new_stock = max(new_stock - int(new_quantity or 0), 0)
-            setattr(new_product, 'so_luong', new_stock)
-            setattr(new_product, 'trang_thai', 'Còn hàng' if new_stock > 0 else 'Hết hàng')
-        
-        db.commit()
+    items, demand = price_lines(db, payload.items)
+    if has_items(db, o.id):
+        old_usage = item_usage(db, o.id, o.trang_thai)
+    else:
+        entry = catalog.catalog_cache.get(db, o.sp_banggia) if o.sp_banggia else None
+        old_usage = stock_usage(is_product_entry(entry), o.sp_banggia, o.so_luong, o.trang_thai)
+    new_usage = {} if is_cancelled(o.trang_thai) else demand
+    apply_stock_changes(db, stock.net_changes(old_usage, new_usage), o.id)
     
-    return {"success": True}
+    # Sản phẩm của đơn đầu tiên gắn với hóa đơn của khách hàng nên cũng cần tính lại
+    customer = sales_rollup.customer_key(o.account_id, o.thong_tin_kh)
+    attribution = sales_rollup.attribution_customers(db, o.id, customer, customer)
+    sales_rollup.apply_orders(db, Order.id == o.id, -1)
+    sales_rollup.apply_customers(db, attribution, -1)
+    
+    db.query(OrderItem).filter(OrderItem.order_id == o.id).delete(synchronize_session=False)
+    insert_items(db, o.id, items)
+    o.sp_banggia = None
+    o.so_luong = sum(item['so_luong'] for item in items)
+    o.tong_tien = sum(item['total_price'] for item in items)
+    
+    db.flush()
+    sales_rollup.apply_orders(db, Order.id == o.id)
+    sales_rollup.apply_customers(db, attribution)
+    db.commit()
+    return {"success": True, "so_dong": len(items), "tong_tien": o.tong_tien}
 
 
 @router.delete("/{order_id}")
@@ -352,44 +611,30 @@ def delete_order(order_id: int, db: Session = Depends(get_db)):
     if not o:
         raise HTTPException(status_code=404, detail="Không tìm thấy đơn hàng")
     
-    # CHỈ hoàn trả số lượng sản phẩm trước khi xóa đơn hàng (không hoàn trả cho hành động)
-    if getattr(o, 'sp_banggia', None) and getattr(o, 'so_luong', None):
-        product = db.query(Product).filter(Product.ma_sp == getattr(o, 'sp_banggia', '')).first()
-        if product:
-            # Chỉ hoàn trả nếu đây là sản phẩm (có trong bảng products)
-            current_qty = int(getattr(product, 'so_luong', 0) or 0)
-            order_qty = int(getattr(o, 'so_luong', 0) or 0)
-            setattr(product, 'so_luong', current_qty + order_qty)
-            setattr(product, 'trang_thai', 'Còn hàng' if (current_qty + order_qty) > 0 else 'Hết hàng')
-            db.commit()
+    # CHỈ hoàn trả số lượng sản phẩm (không hoàn trả cho hành động, đơn đã hủy đã được hoàn trả khi hủy)
+    multi_line = has_items(db, o.id)
+    if multi_line:
+        apply_stock_changes(db, stock.net_changes(item_usage(db, o.id, o.trang_thai), {}), o.id)
+    elif getattr(o, 'sp_banggia', None) and getattr(o, 'so_luong', None):
+        # Chỉ hoàn trả nếu đây là sản phẩm (có trong bảng products)
+        entry = catalog.catalog_cache.get(db, o.sp_banggia)
+        usage = stock_usage(is_product_entry(entry), o.sp_banggia, o.so_luong, o.trang_thai)
+        apply_stock_changes(db, stock.net_changes(usage, {}), o.id)
+    
+    # Trừ phần đóng góp của đơn hàng khỏi bảng tổng hợp doanh thu
+    attribution = sales_rollup.attribution_customers(db, o.id, sales_rollup.customer_key(o.account_id, o.thong_tin_kh), None)
+    sales_rollup.apply_orders(db, Order.id == o.id, -1)
+    sales_rollup.apply_customers(db, attribution, -1)
     
+    if multi_line:
+        db.query(OrderItem).filter(OrderItem.order_id == o.id).delete(synchronize_session=False)
     db.delete(o)
+    db.flush()
+    sales_rollup.apply_customers(db, attribution)
     db.commit()
     return {"success": True}
 
 
-@router.post("/items")
-def add_order_item(payload: dict = Body(...), db: Session = Depends(get_db)):
-    # Chấp nhận cả kiểu tên trường cũ từ FE: don_hang/san_pham/thanh_tien
-    order_id = payload.get('order_id') or payload.get('don_hang')
-    product_id = payload.get('product_id') or payload.get('san_pham')
-    so_luong = payload.get('so_luong') or payload.get('quantity') or 1
-    don_gia = payload.get('don_gia') or payload.get('unit_price') or 0
-    total_price = payload.get('total_price') or payload.get('thanh_tien') or 0
-    if not order_id or not product_id:
-        raise HTTPException(status_code=422, detail="Thiếu order_id hoặc product_id")
-    it = OrderItem(
-        order_id=int(order_id),
-        product_id=int(product_id),
-        so_luong=int(so_luong or 1),
-        don_gia=float(don_gia or 0),
-        total_price=float(total_price or 0),
-    )
-    db.add(it)
-    db.commit()
-    db.refresh(it)
-    return {"success": True, "id": it.id}
-
 
 
 
@@ -0,0 +1,81 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from ..database import get_db
+from ..models import Invoice, Payment, PaymentAllocation
+from ..schemas_fastapi import PaymentCreate, PaymentOut, PaymentAllocationOut
+from .. import payments, debts, customers
+from typing import Optional
+
+
+router = APIRouter(prefix="/payments", tags=["payments"])
+
+
+def _payment_detail(db: Session, payment: Payment):
+    allocations = (
+        db.query(PaymentAllocation)
+        .filter(PaymentAllocation.payment_id == payment.id)
+        .order_by(PaymentAllocation.id)
+        .all()
+    )
+    allocated = sum(float(a.so_tien or 0) for a in allocations)
+    return {
+        **PaymentOut.model_validate(payment).model_dump(),
+        'allocations': [PaymentAllocationOut.model_validate(a).model_dump() for a in allocations],
+        'allocated_amount': allocated,
+        'unallocated_amount': float(payment.so_tien or 0) - allocated,
+    }
+
+
+@router.get("/", response_model=list[PaymentOut])
+def list_payments(customer_name: Optional[str] = None, account_id: Optional[int] = None, db: Session = Depends(get_db)):
+    query = db.query(Payment)
+    if customer_name or account_id is not None:
+        key = customers.key_for(db, account_id, customer_name)
+        query = query.filter(customers.matches(key, Payment.account_id, Payment.customer_name))
+    return query.order_by(Payment.id.desc()).all()
+
+
+@router.post("/")
+def create_payment(payload: PaymentCreate, db: Session = Depends(get_db)):
+    """Ghi nhận khoản thanh toán và phân bổ FIFO vào các hóa đơn còn nợ của khách hàng"""
+    if not payload.customer_name:
+        raise HTTPException(status_code=400, detail="Tên khách hàng không được để trống")
+    if not payload.so_tien:
+        raise HTTPException(status_code=400, detail="Số tiền thanh toán phải khác 0")
+    key = customers.key_for(db, payload.account_id, payload.customer_name)
+    has_invoice = db.query(func.count(Invoice.id)).filter(
+        customers.matches(key, Invoice.account_id, Invoice.nguoi_mua)
+    ).scalar()
+    if not has_invoice:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy hóa đơn của khách hàng {payload.customer_name}")
+    try:
+        payment = payments.record_payment(
+            db, payload.customer_name, payload.so_tien,
+            ngay_tt=payload.ngay_tt, ghi_chu=payload.ghi_chu, account_id=key.account_id
+        )
+        db.commit()
+        db.refresh(payment)
+        _, total_debt, paid_amount = debts.customer_totals(db, key)
+        return {
+            'success': True,
+            'data': _payment_detail(db, payment),
+            'debt': {
+                'customer_name': payload.customer_name,
+                'account_id': key.account_id,
+                'total_debt': total_debt,
+                'paid_amount': paid_amount,
+                'remaining_debt': total_debt - paid_amount
+            }
+        }
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Lỗi ghi nhận thanh toán: {str(e)}")
+
+
+@router.get("/{payment_id:int}")
+def get_payment(payment_id: int, db: Session = Depends(get_db)):
+    payment = db.query(Payment).get(payment_id)
+    if not payment:
+        raise HTTPException(status_code=404, detail="Không tìm thấy khoản thanh toán")
+    return {'success': True, 'data': _payment_detail(db, payment)}
@@ -3,28 +3,44 @@ from sqlalchemy.orm import Session
 from ..database import get_db
 from ..models import Price
 from ..schemas_fastapi import PriceCreate, PriceUpdate
+from ..report_cache import mark_dirty
+from .. import catalog
+from .. import pagination
+from ..pagination import PageParams, page_params
 
 
 router = APIRouter(prefix="/prices", tags=["prices"])
 
+PRICE_SORT_FIELDS = {'id': Price.id, 'ma_sp': Price.ma_sp}
+
+
+def _price_dict(price):
+    return {
+        "id": price.id,
+        "ma_sp": price.ma_sp,
+        "ten_sp": price.ten_sp,
+        "loai_sp": price.loai_sp,
+        "gia_von": price.gia_von,
+        "gia_chung": price.gia_chung,
+        "created_at": price.created_at,
+        "updated_at": price.updated_at
+    }
+
 
 @router.get("/")
-def get_prices(db: Session = Depends(get_db)):
-    """Lấy danh sách tất cả bảng giá"""
-    prices = db.query(Price).all()
-    result = []
-    for price in prices:
-        result.append({
-            "id": price.id,
-            "ma_sp": price.ma_sp,
-            "ten_sp": price.ten_sp,
-            "loai_sp": price.loai_sp,
-            "gia_von": price.gia_von,
-            "gia_chung": price.gia_chung,
-            "created_at": price.created_at,
-            "updated_at": price.updated_at
-        })
-    return {"success": True, "prices": result}
+def get_prices(
+    loai_sp: str | None = None,
+    page: PageParams = Depends(page_params),
+    db: Session = Depends(get_db)
+):
+    """Lấy danh sách bảng giá (toàn bộ theo dạng cũ, hoặc phân trang theo limit/after)"""
+    query = pagination.search(db.query(Price), page.q, [Price.ma_sp, Price.ten_sp])
+    if loai_sp:
+        query = query.filter(Price.loai_sp == loai_sp)
+    if page.is_legacy:
+        return {"success": True, "prices": [_price_dict(price) for price in query.all()]}
+    rows, page_info = pagination.paginate(query, page, PRICE_SORT_FIELDS, Price.id)
+    return pagination.page_response([_price_dict(price) for price in rows], page_info)
 @router.get("/{price_id}")
 def get_price(price_id: int, db: Session = Depends(get_db)):
     """Lấy chi tiết một bảng giá"""
@@ -67,6 +83,9 @@ def add_price(payload: PriceCreate, db: Session = Depends(get_db)):
     )
     
     db.add(price)
+    # Báo cáo có mã này cần tính lại tên, nhóm "DV"
+    mark_dirty(db, codes=[payload.ma_sp])
+    catalog.mark_dirty(db, codes=[payload.ma_sp])
     db.commit()
     db.refresh(price)
     
@@ -80,6 +99,12 @@ def update_price(price_id: int, payload: PriceUpdate, db: Session = Depends(get_
     if not price:
         raise HTTPException(status_code=404, detail="Không tìm thấy bảng giá")
     
+    if payload.ma_sp is not None or payload.ten_sp is not None:
+        mark_dirty(db, codes=[price.ma_sp, payload.ma_sp])
+    if any(value is not None for value in (payload.ma_sp, payload.loai_sp, payload.gia_chung)):
+        # Đổi mã/loại/giá chung ảnh hưởng tới phân loại và đơn giá của mã trong catalog
+        catalog.mark_dirty(db, codes=[price.ma_sp, payload.ma_sp])
+    
     # Cập nhật các field nếu có
     if payload.ma_sp is not None:
         # Kiểm tra xem mã mới có trùng với bảng giá khác không
@@ -117,6 +142,8 @@ def delete_price(price_id: int, db: Session = Depends(get_db)):
     if not price:
         raise HTTPException(status_code=404, detail="Không tìm thấy bảng giá")
     
+    mark_dirty(db, codes=[price.ma_sp])
+    catalog.mark_dirty(db, codes=[price.ma_sp])
     db.delete(price)
     db.commit()
     return {"success": True}
\ No newline at end of file
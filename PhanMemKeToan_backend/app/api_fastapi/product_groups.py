@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from ..database import get_db
 from ..models import ProductGroup
+from .. import stock_shards
 
 router = APIRouter(prefix="/product-groups", tags=["product_groups"])
 
@@ -13,9 +14,13 @@ def list_product_groups(db: Session = Depends(get_db)):
     from sqlalchemy import func
     
     # Lấy tất cả nhóm sản phẩm và tổng số lượng từ field nhom_sp của bảng products
+    # (sản phẩm bán chạy: tồn kho là tổng các shard)
+    shards = stock_shards.totals_subquery()
     product_groups = db.query(
         Product.nhom_sp,
-        func.sum(Product.so_luong).label('tong_so_luong')
+        func.sum(stock_shards.live_quantity(shards)).label('tong_so_luong')
+    ).outerjoin(
+        shards, shards.c.product_id == Product.id
     ).filter(
         Product.nhom_sp.isnot(None)
     ).group_by(
@@ -1,50 +1,83 @@
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import case
 from sqlalchemy.orm import Session
-from sqlalchemy import text
 from ..database import get_db
 from ..models import Product, ProductGroup, OrderItem
 from ..schemas_fastapi import ProductOut, ProductCreate, ProductUpdate
+from ..report_cache import mark_dirty
+from .. import catalog, stock, stock_ledger, stock_shards
+from .. import pagination
+from ..pagination import PageParams, page_params
 
 
 router = APIRouter(prefix="/products", tags=["products"])
 
+# Tránh lỗi cột thiếu do schema cũ: chỉ select các cột đang tồn tại
+PRODUCT_LIST_COLUMNS = (
+    Product.id, Product.ma_sp, Product.ten_sp, Product.nhom_sp, Product.so_luong,
+    Product.gia_ban, Product.gia_chung, Product.trang_thai, Product.mo_ta,
+)
+
+PRODUCT_SORT_FIELDS = {'id': Product.id, 'ma_sp': Product.ma_sp}
+
+
+def _product_dict(row):
+    # Xử lý nhom_sp để đảm bảo hiển thị đúng
+    nhom_sp = row.get("nhom_sp")
+    if nhom_sp:
+        # Nếu nhom_sp là JSON string, trích xuất ten_nhom
+        if nhom_sp.startswith('{') and nhom_sp.endswith('}'):
+            try:
+                import json
+                nhom_data = json.loads(nhom_sp)
+                nhom_sp = nhom_data.get('ten_nhom', nhom_sp)
+            except:
+                pass  # Giữ nguyên nếu không parse được JSON
+    
+    return {
+        "id": row.get("id"),
+        "ma_sp": row.get("ma_sp"),
+        "ten_sp": row.get("ten_sp"),
+        "nhom_sp": nhom_sp,
+        "so_luong": int(row.get("so_luong") or 0),
+        "gia_ban": float(row.get("gia_ban") or 0.0),
+        "gia_chung": float(row.get("gia_chung") or 0.0),
+        "trang_thai": row.get("trang_thai"),
+        "mo_ta": row.get("mo_ta"),
+    }
+
+
+def _live_stock_query(db: Session):
+    """
+    Danh sách sản phẩm; sản phẩm bán chạy lấy so_luong là tổng các shard và trang_thai
+    theo tổng đó (products.so_luong/trang_thai chỉ đồng bộ khi chia lại)
+    """
+    shards = stock_shards.totals_subquery()
+    so_luong = stock_shards.live_quantity(shards)
+    trang_thai = case((shards.c.product_id.is_(None), Product.trang_thai), else_=stock.stock_status(so_luong))
+    live = {Product.so_luong: so_luong.label('so_luong'), Product.trang_thai: trang_thai.label('trang_thai')}
+    columns = [live.get(column, column) for column in PRODUCT_LIST_COLUMNS]
+    return db.query(*columns).outerjoin(shards, shards.c.product_id == Product.id), trang_thai
+
 
 @router.get("/")
-def list_products(db: Session = Depends(get_db)):
-    # Tránh lỗi cột thiếu do schema cũ: chỉ select các cột đang tồn tại
-    result = db.execute(text(
-        """
-        SELECT id, ma_sp, ten_sp, nhom_sp, so_luong, gia_ban, gia_chung, trang_thai, mo_ta
-        FROM products
-        ORDER BY id ASC
-        """
-    ))
-    products = []
-    for row in result.mappings():
-        # Xử lý nhom_sp để đảm bảo hiển thị đúng
-        nhom_sp = row.get("nhom_sp")
-        if nhom_sp:
-            # Nếu nhom_sp là JSON string, trích xuất ten_nhom
-            if nhom_sp.startswith('{') and nhom_sp.endswith('}'):
-                try:
-                    import json
-                    nhom_data = json.loads(nhom_sp)
-                    nhom_sp = nhom_data.get('ten_nhom', nhom_sp)
-                except:
-                    pass  # Giữ nguyên nếu không parse được JSON
-        
-        products.append({
-            "id": row.get("id"),
-            "ma_sp": row.get("ma_sp"),
-            "ten_sp": row.get("ten_sp"),
-            "nhom_sp": nhom_sp,
-            "so_luong": int(row.get("so_luong") or 0),
-            "gia_ban": float(row.get("gia_ban") or 0.0),
-            "gia_chung": float(row.get("gia_chung") or 0.0),
-            "trang_thai": row.get("trang_thai"),
-            "mo_ta": row.get("mo_ta"),
-        })
-    return {"success": True, "products": products}
+def list_products(
+    nhom_sp: str | None = None,
+    trang_thai: str | None = None,
+    page: PageParams = Depends(page_params),
+    db: Session = Depends(get_db)
+):
+    query, live_status = _live_stock_query(db)
+    query = pagination.search(query, page.q, [Product.ma_sp, Product.ten_sp])
+    if nhom_sp:
+        query = query.filter(Product.nhom_sp == nhom_sp)
+    if trang_thai:
+        query = query.filter(live_status == trang_thai)
+    if page.is_legacy:
+        products = [_product_dict(row._mapping) for row in query.order_by(Product.id.asc())]
+        return {"success": True, "products": products}
+    rows, page_info = pagination.paginate(query, page, PRODUCT_SORT_FIELDS, Product.id)
+    return pagination.page_response([_product_dict(row._mapping) for row in rows], page_info)
 
 
 @router.get("/{product_id}", response_model=ProductOut)
@@ -52,6 +85,12 @@ def get_product(product_id: int, db: Session = Depends(get_db)):
     product = db.query(Product).get(product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Không tìm thấy sản phẩm")
+    if product.so_shard:
+        so_luong = stock_shards.totals(db, [product.id]).get(product.id, product.so_luong or 0)
+        return ProductOut.model_validate(product).model_copy(update={
+            "so_luong": so_luong,
+            "trang_thai": stock.IN_STOCK if so_luong > 0 else stock.OUT_OF_STOCK,
+        })
     return product
 
 
@@ -87,6 +126,12 @@ def create_product(payload: ProductCreate, db: Session = Depends(get_db)):
         mo_ta=payload.mo_ta,
     )
     db.add(p)
+    db.flush()
+    # Số lượng ban đầu là movement đầu tiên của sản phẩm trong sổ kho
+    stock_ledger.record(db, [(p.id, p.so_luong or 0, stock_ledger.SOURCE_PRODUCT, p.id)])
+    # Báo cáo có mã này (chưa phân loại/bảng giá) cần tính lại tên, nhóm
+    mark_dirty(db, codes=[payload.ma_sp])
+    catalog.mark_dirty(db, codes=[payload.ma_sp])
     db.commit()
     db.refresh(p)
     return {"success": True, "id": p.id}
@@ -97,6 +142,12 @@ def update_product(product_id: int, payload: ProductUpdate, db: Session = Depend
     p = db.query(Product).get(product_id)
     if not p:
         raise HTTPException(status_code=404, detail="Không tìm thấy sản phẩm")
+    if any(value is not None for value in (payload.ma_sp, payload.ten_sp, payload.nhom_sp)):
+        # Đổi mã/tên/nhóm ảnh hưởng tới các báo cáo tham chiếu sản phẩm này
+        mark_dirty(db, codes=[p.ma_sp, payload.ma_sp])
+    if payload.ma_sp is not None or payload.gia_chung is not None:
+        # Đổi mã/giá chung ảnh hưởng tới phân loại và đơn giá của mã trong catalog
+        catalog.mark_dirty(db, codes=[p.ma_sp, payload.ma_sp])
     if payload.nhom_sp is not None:
         # Xử lý nhom_sp để đảm bảo lưu dưới dạng tên nhóm đơn giản
         nhom_sp = payload.nhom_sp
@@ -116,6 +167,8 @@ def update_product(product_id: int, payload: ProductUpdate, db: Session = Depend
     if payload.ten_sp is not None:
         p.ten_sp = payload.ten_sp
     if payload.so_luong is not None:
+        # Sửa tay số lượng: ghi phần chênh lệch vào sổ kho
+        stock.set_quantity(db, p.id, payload.so_luong, (stock_ledger.SOURCE_PRODUCT, p.id))
         p.so_luong = payload.so_luong
     if payload.gia_ban is not None:
         p.gia_ban = payload.gia_ban
@@ -140,6 +193,8 @@ def delete_product(product_id: int, db: Session = Depends(get_db)):
         db.query(OrderItem).filter(OrderItem.product_id == product_id).delete()
     except Exception:
         pass
+    mark_dirty(db, codes=[p.ma_sp])
+    catalog.mark_dirty(db, codes=[p.ma_sp])
     db.delete(p)
     db.commit()
     return {"success": True}
@@ -1,342 +1,762 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_
+from sqlalchemy import func, and_, or_, case, cast, Date
 from ..database import get_db
-from ..models import Order, Product, Invoice, Report, Debt, Price
-from ..schemas_fastapi import ReportOut, ReportCreate, ReportUpdate, DebtOut, DebtUpdate
-from datetime import datetime, timedelta
+from ..models import Order, Product, Invoice, Report, Debt, Price, DailySalesSummary, Account
+from ..schemas_fastapi import ReportOut, ReportCreate, ReportUpdate, ReportJobCreate, DebtOut, DebtUpdate
+from .. import sales_rollup
+from ..report_cache import report_cache
+from ..catalog import catalog_cache
+from .. import report_jobs
+from .. import analytics
+from .. import payments, debts, customers
+from .. import stock_shards
+from datetime import date, datetime, timedelta
 from typing import List, Dict, Any, Optional
 import json
 from decimal import Decimal
 
 router = APIRouter(prefix="/reports", tags=["reports"])
 
+GRANULARITIES = ('day', 'week', 'month', 'quarter', 'year')
+
+
+def _validate_granularity(granularity: str) -> str:
+    value = (granularity or 'day').strip().lower()
+    if value not in GRANULARITIES:
+        raise HTTPException(
+            status_code=422,
+            detail=f"granularity không hợp lệ. Chọn một trong: {', '.join(GRANULARITIES)}"
+        )
+    return value
+
+
+def _bucket_expr(column, granularity: str):
+    """Biểu thức SQL gom ngày vào đầu kỳ (date_trunc) theo granularity"""
+    if granularity == 'day':
+        return column
+    return cast(func.date_trunc(granularity, column), Date)
+
+
+def _bucket_start(d: date, granularity: str) -> date:
+    if granularity == 'week':
+        return d - timedelta(days=d.weekday())
+    if granularity == 'month':
+        return d.replace(day=1)
+    if granularity == 'quarter':
+        return d.replace(month=(d.month - 1) // 3 * 3 + 1, day=1)
+    if granularity == 'year':
+        return d.replace(month=1, day=1)
+    return d
+
+
+def _next_bucket(d: date, granularity: str) -> date:
+    if granularity == 'week':
+        return d + timedelta(days=7)
+    if granularity in ('month', 'quarter'):
+        months = 1 if granularity == 'month' else 3
+        month_index = d.month - 1 + months
+        return d.replace(year=d.year + month_index // 12, month=month_index % 12 + 1, day=1)
+    if granularity == 'year':
+        return d.replace(year=d.year + 1, month=1, day=1)
+    return d + timedelta(days=1)
+
+
+def _bucket_range(start_date: date, end_date: date, granularity: str) -> List[date]:
+    """Danh sách đầu kỳ từ start_date đến end_date"""
+    buckets = []
+    current = _bucket_start(start_date, granularity)
+    while current <= end_date:
+        buckets.append(current)
+        current = _next_bucket(current, granularity)
+    return buckets
+
+
+def _bucket_label(d: date, granularity: str) -> str:
+    if granularity == 'week':
+        return f"Tuần {d.strftime('%d/%m/%Y')}"
+    if granularity == 'month':
+        return d.strftime("%m/%Y")
+    if granularity == 'quarter':
+        return f"Q{(d.month - 1) // 3 + 1}/{d.year}"
+    if granularity == 'year':
+        return str(d.year)
+    return d.strftime("%d/%m/%Y")
+
+
+
+def _parse_date_range(from_date: str, to_date: str):
+    # Validate date format
+    try:
+        start_date = datetime.strptime(from_date, "%Y-%m-%d").date()
+        end_date = datetime.strptime(to_date, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(
+            status_code=422, 
+            detail="Định dạng ngày không hợp lệ. Sử dụng định dạng YYYY-MM-DD"
+        )
+    
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="Ngày bắt đầu phải nhỏ hơn ngày kết thúc")
+    return start_date, end_date
+
+
+def _total_remaining(db: Session) -> float:
+    # Ensure numeric scalar, avoid Column types leaking
+    # Sản phẩm bán chạy: tồn kho là tổng các shard (products.so_luong có thể chậm hơn)
+    shards = stock_shards.totals_subquery()
+    return float(
+        db.query(func.coalesce(func.sum(stock_shards.live_quantity(shards)), 0))
+        .select_from(Product)
+        .outerjoin(shards, shards.c.product_id == Product.id)
+        .scalar() or 0
+    )
+
+
+def _build_revenue_by_date(db: Session, start_date: date, end_date: date, granularity: str):
+    """
+    Tính báo cáo doanh thu theo kỳ (chưa gồm tồn kho hiện tại).
+    Trả về (data, các mã sản phẩm xuất hiện trong báo cáo).
+    """
+    from_date, to_date = start_date.isoformat(), end_date.isoformat()
+    buckets = _bucket_range(start_date, end_date, granularity)
+    
+    # Đọc từ bảng tổng hợp theo ngày (daily_sales_summary): chi phí tỉ lệ với
+    # số ngày x số sản phẩm thay vì số hóa đơn.
+    in_range = DailySalesSummary.ngay.between(start_date, end_date)
+    bucket = _bucket_expr(DailySalesSummary.ngay, granularity)
+    
+    # Truy vấn 1: doanh thu và số lượng đã bán theo kỳ (gom nhóm trong database)
+    daily_rows = (
+        db.query(
+            bucket,
+            func.coalesce(func.sum(DailySalesSummary.doanh_thu), 0),
+            func.coalesce(func.sum(DailySalesSummary.so_luong), 0),
+        )
+        .filter(in_range)
+        .group_by(bucket)
+        .all()
+    )
+    daily_map = {
+        ngay: (float(revenue or 0), int(quantity or 0))
+        for ngay, revenue, quantity in daily_rows
+    }
+    
+    # Tạo dữ liệu cho biểu đồ (theo kỳ)
+    chart_columns = []
+    for bucket_date in buckets:
+        day_revenue, day_quantity_sold = daily_map.get(bucket_date, (0.0, 0))
+        chart_columns.append({
+            'date': _bucket_label(bucket_date, granularity),
+            'date_key': bucket_date.strftime("%Y-%m-%d"),
+            'revenue': day_revenue,
+            'quantity_sold': day_quantity_sold,
+        })
+    
+    # Truy vấn 2: dữ liệu bảng sản phẩm (hóa đơn → đơn hàng → sản phẩm/bảng giá)
+    product_rows = (
+        db.query(
+            DailySalesSummary.ma_sp,
+            Product.id,
+            Product.ten_sp,
+            Product.nhom_sp,
+            Price.ten_sp,
+            func.coalesce(func.sum(DailySalesSummary.doanh_thu), 0),
+            func.coalesce(func.sum(DailySalesSummary.so_luong), 0),
+        )
+        .outerjoin(Product, Product.ma_sp == DailySalesSummary.ma_sp)
+        .outerjoin(Price, Price.ma_sp == DailySalesSummary.ma_sp)
+        .filter(in_range, DailySalesSummary.ma_sp != '')
+        .group_by(DailySalesSummary.ma_sp, Product.id, Product.ten_sp, Product.nhom_sp, Price.ten_sp)
+        .having(func.sum(DailySalesSummary.so_hoa_don) > 0)
+        .order_by(DailySalesSummary.ma_sp)
+        .all()
+    )
+    
+    product_columns = []
+    codes = []
+    for sp_code, product_id, product_name, product_group, price_name, revenue, quantity in product_rows:
+        if product_id is not None:
+            # Sản phẩm có trong bảng products - lấy thông tin từ products
+            ten_san_pham = product_name or 'Chưa có tên'
+            nhom_san_pham = product_group if product_group and product_group.strip() else 'Chưa phân loại'
+        elif price_name is not None:
+            # Có trong bảng prices - nhóm "DV" chỉ dành cho prices
+            ten_san_pham = price_name
+            nhom_san_pham = 'DV'
+        else:
+            # Không có trong cả products và prices - mặc định
+            ten_san_pham = sp_code
+            nhom_san_pham = 'Chưa phân loại'
+        
+        codes.append(sp_code)
+        product_columns.append({
+            'ten_san_pham': ten_san_pham,
+            'nhom_san_pham': nhom_san_pham,
+            'tu_ngay': from_date,
+            'den_ngay': to_date,
+            'doanh_thu': float(revenue or 0),
+            'so_luong_ban': int(quantity or 0)
+        })
+    
+    data = {
+        'columns': chart_columns,  # Dữ liệu cho biểu đồ
+        'product_data': product_columns,  # Dữ liệu cho bảng sản phẩm
+        'summary': {
+            'total_revenue': sum(revenue for revenue, _ in daily_map.values()),
+            'total_quantity_sold': sum(quantity for _, quantity in daily_map.values()),
+            'granularity': granularity,
+            'date_range': {
+                'from_date': from_date,
+                'to_date': to_date,
+                'total_days': (end_date - start_date).days + 1
+            }
+        }
+    }
+    return data, codes
+
+
+def _with_remaining(data: Dict[str, Any], total_remaining: float) -> Dict[str, Any]:
+    """Gắn tồn kho hiện tại vào báo cáo (bản sao, không sửa kết quả trong cache)"""
+    return {
+        'columns': [{**column, 'quantity_remaining': total_remaining} for column in data['columns']],
+        'product_data': data['product_data'],
+        'summary': {**data['summary'], 'total_quantity_remaining': total_remaining},
+    }
 
 
 @router.get("/revenue-by-date")
 def get_revenue_by_date(
     from_date: str = Query(..., description="Ngày bắt đầu (YYYY-MM-DD)"),
     to_date: str = Query(..., description="Ngày kết thúc (YYYY-MM-DD)"),
+    granularity: str = Query('day', description="Gom nhóm theo: day, week, month, quarter, year"),
     db: Session = Depends(get_db)
 ):
     """
-    Lấy báo cáo doanh thu theo ngày từ from_date đến to_date
+    Lấy báo cáo doanh thu theo ngày (hoặc tuần/tháng/quý/năm) từ from_date đến to_date
     """
     try:
-        # Validate date format
-        try:
-            start_date = datetime.strptime(from_date, "%Y-%m-%d").date()
-            end_date = datetime.strptime(to_date, "%Y-%m-%d").date()
-        except ValueError:
-            raise HTTPException(
-                status_code=422, 
-                detail="Định dạng ngày không hợp lệ. Sử dụng định dạng YYYY-MM-DD"
-            )
-        
-        if (end_date - start_date).days > 31:
-            raise HTTPException(status_code=400, detail="Khoảng thời gian tối đa là 31 ngày")
-        
-        if start_date > end_date:
-            raise HTTPException(status_code=400, detail="Ngày bắt đầu phải nhỏ hơn ngày kết thúc")
-        
-        date_range = []
-        current_date = start_date
-        while current_date <= end_date:
-            date_range.append(current_date)
-            current_date += timedelta(days=1)
-        
-        # Lấy tất cả hóa đơn trong khoảng thời gian (không filter theo trạng thái)
-        invoices = db.query(Invoice).filter(
-            Invoice.ngay_hd.between(start_date, end_date)
-        ).all()
+        granularity = _validate_granularity(granularity)
+        start_date, end_date = _parse_date_range(from_date, to_date)
         
-        # Debug: In ra số lượng hóa đơn tìm được
-        print(f"🔍 Found {len(invoices)} invoices between {start_date} and {end_date}")
+        key = report_cache.make_key('revenue-by-date', from_date=start_date, to_date=end_date, granularity=granularity)
+        data = report_cache.get(key)
+        if data is None:
+            generation = report_cache.generation
+            data, codes = _build_revenue_by_date(db, start_date, end_date, granularity)
+            report_cache.put(key, data, start_date, end_date, codes, generation)
         
-        # Tính tổng doanh thu từ tất cả hóa đơn
-        total_revenue = sum(float(getattr(invoice, 'tong_tien', 0) or 0) for invoice in invoices)
-        
-        # Tính số lượng đã bán từ tất cả đơn hàng (không filter theo trạng thái)
-        total_quantity_sold = 0
-        orders_from_paid_invoices = []
-        
-        for invoice in invoices:
-            # Tìm đơn hàng theo tên khách hàng
-            order = db.query(Order).filter(
-                Order.thong_tin_kh == invoice.nguoi_mua
-                # Bỏ filter Order.trang_thai == 'Hoàn thành' để lấy tất cả
-            ).first()
-            if order:
-                so_luong_val = int(getattr(order, 'so_luong', 0) or 0)
-                total_quantity_sold += so_luong_val
-                orders_from_paid_invoices.append(order)
-                print(f"📋 Found order for customer {invoice.nguoi_mua}: quantity {so_luong_val}")
-            else:
-                print(f"❌ No order found for customer {invoice.nguoi_mua}")
-        
-        print(f"📊 Total quantity sold: {total_quantity_sold}")
-        print(f"📋 Total orders found: {len(orders_from_paid_invoices)}")
-        
-        # Lấy tổng số lượng còn lại từ sản phẩm
-        # Ensure numeric scalar, avoid Column types leaking
-        total_remaining = float(db.query(func.coalesce(func.sum(Product.so_luong), 0)).scalar() or 0)
-        
-        # Tạo dữ liệu cho biểu đồ (theo ngày)
-        chart_columns = []
-        for date in date_range:
-            date_key = date.strftime("%Y-%m-%d")
-            
-            # Tính doanh thu theo ngày
-            day_revenue = sum(float(getattr(invoice, 'tong_tien', 0) or 0) for invoice in invoices 
-                            if invoice.ngay_hd.strftime("%Y-%m-%d") == date_key)
-            
-            # Tính số lượng đã bán theo ngày (từ tất cả hóa đơn)
-            day_quantity_sold = 0
-            for invoice in invoices:
-                if invoice.ngay_hd.strftime("%Y-%m-%d") == date_key:
-                    order = db.query(Order).filter(
-                        Order.thong_tin_kh == invoice.nguoi_mua
-                        # Bỏ filter Order.trang_thai == 'Hoàn thành'
-                    ).first()
-                    if order:
-                        day_quantity_sold += int(getattr(order, 'so_luong', 0) or 0)
-            
-            chart_columns.append({
-                'date': date.strftime("%d/%m/%Y"),
-                'date_key': date_key,
-                'revenue': day_revenue,
-                'quantity_sold': day_quantity_sold,
-                'quantity_remaining': total_remaining
-            })
+        # Tồn kho hiện tại không phụ thuộc khoảng ngày nên luôn đọc mới (1 truy vấn)
+        return {
+            'success': True,
+            'data': _with_remaining(data, _total_remaining(db))
+        }
         
-        # Tạo dữ liệu cho bảng sản phẩm
-        # Lấy thông tin sản phẩm từ hóa đơn → đơn hàng → sản phẩm
-        product_columns = []
-        product_revenue_map = {}  # Map để tính doanh thu theo sản phẩm
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
+
+def _build_revenue_by_product(db: Session, start_date: date, end_date: date, granularity: str):
+    """
+    Tính báo cáo doanh thu theo sản phẩm. Trả về (data, các mã sản phẩm xuất hiện trong báo cáo)
+    
+    Cách gắn doanh thu cho sản phẩm:
+    - total_revenue: tổng tiền các đơn hàng không bị hủy của sản phẩm, theo ngày tạo đơn
+    - paid_revenue: tổng tiền hóa đơn đã thanh toán, gắn với sản phẩm qua đơn hàng
+      đầu tiên của khách hàng (người mua), theo ngày hóa đơn
+    Cả hai lấy từ bảng tổng hợp daily_sales_summary trong một câu join với products,
+    nên số câu truy vấn không đổi và chỉ đọc các sản phẩm có phát sinh.
+    """
+    in_range = DailySalesSummary.ngay.between(start_date, end_date)
+    
+    order_count = func.coalesce(func.sum(DailySalesSummary.so_don_hang), 0)
+    paid_revenue = func.coalesce(func.sum(DailySalesSummary.doanh_thu_da_tt), 0)
+    product_rows = (
+        db.query(
+            DailySalesSummary.ma_sp,
+            Product.ten_sp,
+            Product.nhom_sp,
+            func.coalesce(func.sum(DailySalesSummary.so_luong_don_hang), 0).label('quantity'),
+            func.coalesce(func.sum(DailySalesSummary.doanh_thu_don_hang), 0).label('order_revenue'),
+            paid_revenue.label('paid_revenue'),
+        )
+        .join(Product, Product.ma_sp == DailySalesSummary.ma_sp)
+        .filter(in_range)
+        .group_by(DailySalesSummary.ma_sp, Product.ten_sp, Product.nhom_sp)
+        .having(or_(order_count > 0, paid_revenue != 0))
+        .order_by(DailySalesSummary.ma_sp)
+        .all()
+    )
+    
+    # Convert to list format
+    product_list = []
+    codes = []
+    for i, row in enumerate(product_rows, 1):
+        codes.append(row.ma_sp)
+        product_list.append({
+            'stt': i,
+            'ma_sp': row.ma_sp,
+            'ten_sp': row.ten_sp,
+            'nhom_sp': row.nhom_sp or 'Chưa phân loại',
+            'total_quantity': int(row.quantity or 0),
+            'total_revenue': float(row.order_revenue or 0),
+            'paid_revenue': float(row.paid_revenue or 0)
+        })
+    
+    # Calculate chart data (revenue per bucket, grouped in the database)
+    bucket = _bucket_expr(DailySalesSummary.ngay, granularity)
+    revenue_data = dict(
+        db.query(
+            bucket,
+            func.coalesce(func.sum(DailySalesSummary.doanh_thu_da_tt), 0),
+        )
+        .filter(in_range)
+        .group_by(bucket)
+        .all()
+    )
+    
+    buckets = _bucket_range(start_date, end_date, granularity)
+    chart_data = {
+        'labels': [_bucket_label(bucket_date, granularity) for bucket_date in buckets],
+        'revenue': [float(revenue_data.get(bucket_date, 0) or 0) for bucket_date in buckets]
+    }
+    
+    data = {
+        'products': product_list,
+        'chart_data': chart_data,
+        'summary': {
+            'total_revenue': sum(item['total_revenue'] for item in product_list),
+            'total_paid_revenue': sum(item['paid_revenue'] for item in product_list),
+            'total_quantity': sum(item['total_quantity'] for item in product_list),
+            'granularity': granularity,
+            'date_range': {
+                'from_date': start_date.isoformat(),
+                'to_date': end_date.isoformat(),
+                'total_days': (end_date - start_date).days + 1
+            }
+        }
+    }
+    return data, codes
+
+
+@router.get("/revenue-by-product")
+def get_revenue_by_product(
+    from_date: str,
+    to_date: str,
+    granularity: str = Query('day', description="Gom nhóm biểu đồ theo: day, week, month, quarter, year"),
+    db: Session = Depends(get_db)
+):
+    """
+    Lấy báo cáo doanh thu theo sản phẩm từ from_date đến to_date
+    """
+    try:
+        granularity = _validate_granularity(granularity)
         
-        print(f"🔍 Processing {len(invoices)} invoices for product data...")
+        # Parse dates
+        start_date = datetime.strptime(from_date, "%Y-%m-%d").date()
+        end_date = datetime.strptime(to_date, "%Y-%m-%d").date()
         
-        # Duyệt qua từng hóa đơn
-        for invoice in invoices:
-            # Tìm đơn hàng theo tên khách hàng
-            order = db.query(Order).filter(
-                Order.thong_tin_kh == invoice.nguoi_mua
-                # Bỏ filter Order.trang_thai == 'Hoàn thành'
-            ).first()
-            
-            if order:
-                sp_code = getattr(order, 'sp_banggia', None)
-                if sp_code:  # Nếu đơn hàng có mã sản phẩm
-                    # Tìm sản phẩm theo mã
-                    product = db.query(Product).filter(
-                        Product.ma_sp == sp_code
-                    ).first()
-                    
-                    if product:
-                        # Sản phẩm có trong bảng products - lấy thông tin từ products
-                        product_key = f"{getattr(product, 'ma_sp', '')}-{getattr(product, 'ten_sp', '')}"
-                        if product_key not in product_revenue_map:
-                            # Lấy nhóm SP từ bảng products (không phải "DV")
-                            nhom_sp = getattr(product, 'nhom_sp', None)
-                            if not nhom_sp or nhom_sp.strip() == '':
-                                nhom_sp = 'Chưa phân loại'  # Mặc định cho sản phẩm không có nhóm
-                            
-                            product_revenue_map[product_key] = {
-                                'ten_san_pham': getattr(product, 'ten_sp', None) or 'Chưa có tên',
-                                'nhom_san_pham': nhom_sp,
-                                'doanh_thu': 0,
-                                'so_luong_ban': 0
-                            }
-                            
-                            print(f"📦 Product found in products table: {sp_code} -> Group: {nhom_sp}, Name: {getattr(product, 'ten_sp', None)}")
-                        
-                        # Cộng dồn doanh thu và số lượng cho sản phẩm này
-                        product_revenue_map[product_key]['doanh_thu'] += float(getattr(invoice, 'tong_tien', 0) or 0)
-                        product_revenue_map[product_key]['so_luong_ban'] += int(getattr(order, 'so_luong', 0) or 0)
-                    else:
-                        # Sản phẩm KHÔNG có trong bảng products - kiểm tra bảng prices
-                        # Tìm trong bảng prices để lấy tên sản phẩm và nhóm "DV"
-                        price_item = db.query(Price).filter(Price.ma_sp == sp_code).first()
-                        
-                        if price_item:
-                            # Có trong bảng prices - sử dụng thông tin từ prices
-                            product_key = f"{sp_code}-{getattr(price_item, 'ten_sp', sp_code)}"
-                            if product_key not in product_revenue_map:
-                                product_revenue_map[product_key] = {
-                                    'ten_san_pham': getattr(price_item, 'ten_sp', sp_code),  # Lấy tên SP từ prices
-                                    'nhom_san_pham': 'DV',  # Nhóm "DV" chỉ dành cho prices
-                                    'doanh_thu': 0,
-                                    'so_luong_ban': 0
-                                }
-                                
-                                print(f"📦 Product found in prices table: {sp_code} -> Group: DV, Name: {getattr(price_item, 'ten_sp', sp_code)}")
-                        else:
-                            # Không có trong cả products và prices - mặc định
-                            product_key = f"{sp_code}-{sp_code}"
-                            if product_key not in product_revenue_map:
-                                product_revenue_map[product_key] = {
-                                    'ten_san_pham': sp_code,  # Sử dụng mã SP làm tên
-                                    'nhom_san_pham': 'Chưa phân loại',  # Không phải "DV"
-                                    'doanh_thu': 0,
-                                    'so_luong_ban': 0
-                                }
-                                
-                                print(f"📦 Product NOT found anywhere: {sp_code} -> Default Group: Chưa phân loại")
-                        
-                        product_revenue_map[product_key]['doanh_thu'] += float(getattr(invoice, 'tong_tien', 0) or 0)
-                        product_revenue_map[product_key]['so_luong_ban'] += int(getattr(order, 'so_luong', 0) or 0)
+        if start_date > end_date:
+            raise HTTPException(status_code=400, detail="Ngày bắt đầu phải nhỏ hơn ngày kết thúc")
         
-        # Chuyển map thành list để trả về
-        print(f"📊 Final product data summary:")
-        for product_data in product_revenue_map.values():
-            print(f"  - {product_data['ten_san_pham']} ({product_data['nhom_san_pham']}): {product_data['so_luong_ban']} sản phẩm, {product_data['doanh_thu']:,.0f} VND")
-            
-            product_columns.append({
-                'ten_san_pham': product_data['ten_san_pham'],
-                'nhom_san_pham': product_data['nhom_san_pham'],
-                'tu_ngay': from_date,
-                'den_ngay': to_date,
-                'doanh_thu': product_data['doanh_thu'],
-                'so_luong_ban': product_data['so_luong_ban']
-            })
+        key = report_cache.make_key('revenue-by-product', from_date=start_date, to_date=end_date, granularity=granularity)
+        data = report_cache.get(key)
+        if data is None:
+            generation = report_cache.generation
+            data, codes = _build_revenue_by_product(db, start_date, end_date, granularity)
+            report_cache.put(key, data, start_date, end_date, codes, generation)
         
         return {
             'success': True,
-            'data': {
-                'columns': chart_columns,  # Dữ liệu cho biểu đồ
-                'product_data': product_columns,  # Dữ liệu cho bảng sản phẩm
-                'summary': {
-                    'total_revenue': total_revenue,
-                    'total_quantity_sold': total_quantity_sold,
-                    'total_quantity_remaining': total_remaining,
-                    'date_range': {
-                        'from_date': from_date,
-                        'to_date': to_date,
-                        'total_days': len(date_range)
-                    }
-                }
-            }
+            'data': data
         }
         
     except HTTPException:
         raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Định dạng ngày không hợp lệ: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
+
+@router.get("/analytics")
+def get_analytics(
+    from_date: str = Query(..., description="Ngày bắt đầu (YYYY-MM-DD)"),
+    to_date: str = Query(..., description="Ngày kết thúc (YYYY-MM-DD)"),
+    dimensions: str = Query('day', description="Danh sách phân tích, cách nhau bởi dấu phẩy: day, customer, product_group, payment_method"),
+    db: Session = Depends(get_db)
+):
+    """
+    Phân tích doanh thu ad-hoc: đọc dữ liệu trong khoảng ngày một lần vào mảng NumPy
+    rồi gom nhóm theo từng chiều được yêu cầu
+    """
+    requested = [d.strip().lower() for d in dimensions.split(',') if d.strip()]
+    invalid = [d for d in requested if d not in analytics.DIMENSIONS]
+    if not requested or invalid:
+        raise HTTPException(
+            status_code=422,
+            detail=f"dimensions phải thuộc: {', '.join(analytics.DIMENSIONS)}"
+        )
+    start_date, end_date = _parse_date_range(from_date, to_date)
+    
+    try:
+        frame = analytics.AnalyticsEngine.from_db(db, start_date, end_date)
+        return {
+            'success': True,
+            'data': {dimension: frame.aggregate(dimension) for dimension in requested},
+            'summary': {
+                'from_date': start_date.isoformat(),
+                'to_date': end_date.isoformat(),
+                'invoice_count': int(frame.invoice_amount.size),
+                'order_count': int(frame.order_amount.size),
+            }
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
+
+@router.get("/cache-stats")
+def get_report_cache_stats():
+    """Thống kê cache kết quả báo cáo và cache catalog (hit/miss) để điều chỉnh REPORT_CACHE_SIZE/CATALOG_CACHE_SIZE"""
+    return {'success': True, 'data': report_cache.stats(), 'catalog': catalog_cache.stats()}
+
+@router.post("/rollup/rebuild")
+def rebuild_sales_rollup(db: Session = Depends(get_db)):
+    """Tính lại toàn bộ bảng tổng hợp doanh thu theo ngày từ hóa đơn/đơn hàng"""
+    try:
+        sales_rollup.rebuild(db)
+        db.commit()
+        rows = db.query(func.count()).select_from(DailySalesSummary).scalar()
+        return {'success': True, 'rows': rows}
     except Exception as e:
+        db.rollback()
         raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
 
+@router.post("/debts/rebuild")
+def rebuild_debts(db: Session = Depends(get_db)):
+    """Tính lại toàn bộ bảng công nợ (debts) từ hóa đơn (dùng để sửa dữ liệu)"""
+    try:
+        rows = debts.recompute_all(db)
+        db.commit()
+        return {'success': True, 'rows': rows}
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
+
+REPORT_JOB_TYPES = ('revenue', 'debt')
+
+
+def build_report_job(db: Session, report: Report, params: Dict[str, Any]):
+    """Tính dữ liệu cho job báo cáo (chạy trên worker, ngoài luồng request)"""
+    start_date = report.tu_ngay
+    end_date = report.den_ngay
+    if report.loai_bao_cao == 'debt':
+        debt_data = _build_debt_report(db, start_date, end_date)
+        summary = {'tong_doanh_thu': sum(item['tong_cong_no'] for item in debt_data)}
+        return debt_data, summary
+    
+    data, _ = _build_revenue_by_date(db, start_date, end_date, params.get('granularity', 'day'))
+    total_remaining = _total_remaining(db)
+    data = _with_remaining(data, total_remaining)
+    summary = {
+        'tong_doanh_thu': data['summary']['total_revenue'],
+        'tong_so_luong_ban': data['summary']['total_quantity_sold'],
+        'tong_so_luong_con_lai': int(total_remaining),
+    }
+    return data, summary
+
+
+@router.post("/jobs", status_code=202)
+def create_report_job(payload: ReportJobCreate, db: Session = Depends(get_db)):
+    """Tạo job tính báo cáo doanh thu/công nợ chạy nền; kết quả lưu vào Report.du_lieu"""
+    loai = (payload.loai_bao_cao or '').strip().lower()
+    if loai not in REPORT_JOB_TYPES:
+        raise HTTPException(status_code=422, detail=f"loai_bao_cao phải là một trong: {', '.join(REPORT_JOB_TYPES)}")
+    if payload.tu_ngay > payload.den_ngay:
+        raise HTTPException(status_code=400, detail="Ngày bắt đầu phải nhỏ hơn ngày kết thúc")
+    granularity = _validate_granularity(payload.granularity or 'day')
+    
+    report = Report(
+        ten_bao_cao=payload.ten_bao_cao or f"Báo cáo {loai} {payload.tu_ngay} - {payload.den_ngay}",
+        loai_bao_cao=loai,
+        tu_ngay=payload.tu_ngay,
+        den_ngay=payload.den_ngay,
+        du_lieu=json.dumps({'params': {'granularity': granularity}}),
+        trang_thai=report_jobs.JOB_PENDING
+    )
+    db.add(report)
+    db.commit()
+    db.refresh(report)
+    
+    report_jobs.submit(report.id, build_report_job)
+    return {'success': True, 'id': report.id, 'trang_thai': report.trang_thai}
+
+
+@router.get("/jobs/{job_id}")
+def get_report_job(job_id: int, db: Session = Depends(get_db)):
+    """Trạng thái job báo cáo; kèm kết quả khi trang_thai='completed'"""
+    report = db.query(Report).get(job_id)
+    if not report:
+        raise HTTPException(status_code=404, detail="Không tìm thấy báo cáo")
+    
+    stored = json.loads(report.du_lieu or '{}') if report.du_lieu else {}
+    data = {
+        'id': report.id,
+        'ten_bao_cao': report.ten_bao_cao,
+        'loai_bao_cao': report.loai_bao_cao,
+        'tu_ngay': report.tu_ngay,
+        'den_ngay': report.den_ngay,
+        'trang_thai': report.trang_thai,
+        'ngay_tao': report.ngay_tao,
+    }
+    if report.trang_thai == report_jobs.JOB_COMPLETED:
+        data['result'] = stored.get('result')
+        data['tong_doanh_thu'] = report.tong_doanh_thu
+        data['tong_so_luong_ban'] = report.tong_so_luong_ban
+        data['tong_so_luong_con_lai'] = report.tong_so_luong_con_lai
+    elif report.trang_thai == report_jobs.JOB_FAILED:
+        data['error'] = stored.get('error')
+    return {'success': True, 'data': data}
+
 @router.get("/", response_model=List[ReportOut])
 def list_reports(db: Session = Depends(get_db)):
     return db.query(Report).all()
 
+DEBT_SORT_ORDERS = ('asc', 'desc')
+
+
+def _customer_label():
+    """Tên hiển thị của nhóm khách hàng: ten_tk của tài khoản, hoặc nguoi_mua (cần outer join accounts)"""
+    return func.coalesce(func.max(Account.ten_tk), func.min(Invoice.nguoi_mua))
+
+
+def _build_debt_report(
+    db: Session,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    sort: Optional[str] = None,
+    limit: Optional[int] = None,
+    offset: int = 0
+):
+    """
+    Tổng hợp công nợ theo khách hàng bằng một câu GROUP BY trên invoices: theo
+    account_id, hoặc nguoi_mua với hóa đơn chưa gắn tài khoản (có thể giới hạn theo
+    ngày hóa đơn, sắp xếp/phân trang theo số còn nợ). Có end_date: số đã thanh toán
+    tính tại ngày đó (bỏ các khoản thanh toán sau end_date).
+    """
+    later = payments.allocations_after(end_date) if end_date else None
+    paid = payments.paid_as_of(later) if later is not None else func.coalesce(Invoice.da_thanh_toan, 0)
+    total_debt = func.coalesce(func.sum(Invoice.tong_tien), 0)
+    paid_total = func.coalesce(func.sum(paid), 0)
+    remaining = total_debt - paid_total
+    group = customers.group_columns(Invoice.account_id, Invoice.nguoi_mua)
+    customer = _customer_label()
+    query = db.query(
+        customer.label('customer'),
+        Invoice.account_id,
+        total_debt.label('total_debt'),
+        paid_total.label('paid_amount'),
+        remaining.label('remaining_debt'),
+    ).outerjoin(Account, Account.id == Invoice.account_id)
+    if later is not None:
+        query = query.outerjoin(later, later.c.invoice_id == Invoice.id)
+    if start_date:
+        query = query.filter(Invoice.ngay_hd >= start_date)
+    if end_date:
+        query = query.filter(Invoice.ngay_hd <= end_date)
+    query = query.group_by(*group)
+    
+    if sort:
+        # Tên khách hàng và khóa nhóm làm khóa phụ để thứ tự ổn định giữa các trang
+        query = query.order_by(remaining.desc() if sort == 'desc' else remaining.asc(), customer, *group)
+    else:
+        query = query.order_by(customer, *group)
+    if offset:
+        query = query.offset(offset)
+    if limit is not None:
+        query = query.limit(limit)
+    
+    debt_data = []
+    for row in query:
+        remaining_debt = float(row.remaining_debt or 0)
+        debt_data.append({
+            'ten_khach_hang': row.customer,
+            'account_id': row.account_id,
+            'tong_cong_no': float(row.total_debt or 0),
+            'da_thanh_toan': float(row.paid_amount or 0),
+            'con_no': remaining_debt,
+            'trang_thai': 'Còn nợ' if remaining_debt > 0 else 'Hết nợ'
+        })
+    return debt_data
+
+
 @router.get("/debt-report")
-def get_debt_report(db: Session = Depends(get_db)):
+def get_debt_report(
+    sort: Optional[str] = Query(None, description="Sắp xếp theo số còn nợ: asc hoặc desc"),
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Số khách hàng mỗi trang"),
+    offset: int = Query(0, ge=0, description="Bỏ qua bao nhiêu khách hàng"),
+    db: Session = Depends(get_db)
+):
     """Lấy báo cáo công nợ"""
+    if sort is not None and sort not in DEBT_SORT_ORDERS:
+        raise HTTPException(status_code=422, detail=f"sort phải là một trong: {', '.join(DEBT_SORT_ORDERS)}")
     try:
-        # Lấy tất cả hóa đơn
-        invoices = db.query(Invoice).all()
-        
-        # Nhóm theo khách hàng
-        customer_debt = {}
-        for invoice in invoices:
-            customer = getattr(invoice, 'nguoi_mua', None)
-            if customer not in customer_debt:
-                customer_debt[customer] = {
-                    'total_debt': 0,
-                    'paid_amount': 0,
-                    'remaining_debt': 0
-                }
-            
-            # Tổng công nợ = tổng tất cả hóa đơn
-            customer_debt[customer]['total_debt'] += float(getattr(invoice, 'tong_tien', 0) or 0)
-            
-            # Đã thanh toán = tổng hóa đơn đã thanh toán
-            status_value = str(getattr(invoice, 'trang_thai', '') or '')
-            if status_value == 'Đã thanh toán':
-                customer_debt[customer]['paid_amount'] += float(getattr(invoice, 'tong_tien', 0) or 0)
-        
-        # Tính số tiền còn nợ
-        for customer in customer_debt:
-            customer_debt[customer]['remaining_debt'] = (
-                customer_debt[customer]['total_debt'] - 
-                customer_debt[customer]['paid_amount']
-            )
-        
-        # Chuyển thành list
-        debt_data = []
-        for customer, data in customer_debt.items():
-            debt_data.append({
-                'ten_khach_hang': customer,
-                'tong_cong_no': data['total_debt'],
-                'da_thanh_toan': data['paid_amount'],
-                'con_no': data['remaining_debt'],
-                'trang_thai': 'Còn nợ' if data['remaining_debt'] > 0 else 'Hết nợ'
-            })
+        result = {
+            'success': True,
+            'data': _build_debt_report(db, sort=sort, limit=limit, offset=offset)
+        }
+        if limit is not None:
+            groups = db.query(*customers.group_columns(Invoice.account_id, Invoice.nguoi_mua)).distinct().subquery()
+            total = db.query(func.count()).select_from(groups).scalar() or 0
+            result['pagination'] = {'total': total, 'limit': limit, 'offset': offset}
+        return result
         
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
+
+AGING_BUCKETS = (
+    ('0_30', 0, 30),
+    ('31_60', 31, 60),
+    ('61_90', 61, 90),
+    ('over_90', 91, None),
+)
+
+
+def _build_debt_aging(
+    db: Session,
+    as_of: date,
+    limit: int,
+    offset: int = 0,
+    customer: Optional[str] = None,
+    account_id: Optional[int] = None
+):
+    """
+    Phân tích tuổi nợ theo khách hàng tại ngày as_of: số còn nợ của từng hóa đơn tại
+    ngày đó (tong_tien - số đã thanh toán đến as_of, payments.paid_as_of) được chia vào
+    các nhóm 0-30/31-60/61-90/trên 90 ngày tính từ ngày hóa đơn. Một câu GROUP BY khách hàng duy nhất (account_id, hoặc
+    nguoi_mua với hóa đơn chưa gắn tài khoản); tổng số khách hàng và tổng từng nhóm
+    lấy bằng window function trên chính kết quả đã gom nhóm. Lọc khách hàng theo đúng
+    tên (nguoi_mua) hoặc account_id để dùng được index (nguoi_mua/account_id, ngay_hd).
+    """
+    later = payments.allocations_after(as_of)
+    outstanding = Invoice.tong_tien - payments.paid_as_of(later)
+    # So sánh ngày hóa đơn với các mốc as_of - N ngày thay vì tính tuổi cho từng dòng
+    bucket_sums = []
+    for key, min_age, max_age in AGING_BUCKETS:
+        conditions = [Invoice.ngay_hd <= as_of - timedelta(days=min_age)]
+        if max_age is not None:
+            conditions.append(Invoice.ngay_hd >= as_of - timedelta(days=max_age))
+        bucket_sums.append(
+            func.coalesce(func.sum(case((and_(*conditions), outstanding), else_=0)), 0).label(key)
+        )
+    total_outstanding = func.coalesce(func.sum(outstanding), 0)
+    
+    group = customers.group_columns(Invoice.account_id, Invoice.nguoi_mua)
+    customer_label = _customer_label()
+    query = db.query(
+        customer_label.label('customer'),
+        Invoice.account_id,
+        *bucket_sums,
+        total_outstanding.label('total'),
+        func.min(Invoice.ngay_hd).label('oldest_invoice'),
+        func.count(Invoice.id).label('invoice_count'),
+        func.count().over().label('customer_count'),
+        *[func.sum(column).over().label(f'sum_{column.key}') for column in bucket_sums],
+        func.sum(total_outstanding).over().label('sum_total'),
+    ).outerjoin(Account, Account.id == Invoice.account_id).outerjoin(
+        later, later.c.invoice_id == Invoice.id
+    ).filter(Invoice.ngay_hd <= as_of, outstanding > 0)
+    if customer:
+        query = query.filter(Invoice.nguoi_mua == customer)
+    if account_id is not None:
+        query = query.filter(Invoice.account_id == account_id)
+    rows = (
+        query.group_by(*group)
+        .order_by(total_outstanding.desc(), customer_label, *group)
+        .offset(offset)
+        .limit(limit)
+        .all()
+    )
+    
+    data = []
+    for row in rows:
+        data.append({
+            'customer_name': row.customer,
+            'account_id': row.account_id,
+            'buckets': {key: float(getattr(row, key) or 0) for key, _, _ in AGING_BUCKETS},
+            'total_outstanding': float(row.total or 0),
+            'oldest_invoice_date': row.oldest_invoice,
+            'invoice_count': int(row.invoice_count or 0),
+        })
+    first = rows[0] if rows else None
+    summary = {
+        'as_of': as_of.isoformat(),
+        'buckets': {key: float(getattr(first, f'sum_{key}') or 0) if first else 0.0 for key, _, _ in AGING_BUCKETS},
+        'total_outstanding': float(first.sum_total or 0) if first else 0.0,
+    }
+    pagination = {
+        'total': int(first.customer_count) if first else 0,
+        'limit': limit,
+        'offset': offset,
+    }
+    return data, summary, pagination
+
+
+@router.get("/debt-aging")
+def get_debt_aging(
+    as_of: Optional[str] = Query(None, description="Ngày tính tuổi nợ (YYYY-MM-DD), mặc định hôm nay"),
+    customer: Optional[str] = Query(None, description="Lọc theo tên khách hàng (nguoi_mua, khớp chính xác)"),
+    account_id: Optional[int] = Query(None, description="Lọc theo tài khoản khách hàng"),
+    limit: int = Query(50, ge=1, le=1000, description="Số khách hàng mỗi trang"),
+    offset: int = Query(0, ge=0, description="Bỏ qua bao nhiêu khách hàng"),
+    db: Session = Depends(get_db)
+):
+    """Báo cáo tuổi nợ theo khách hàng (0-30, 31-60, 61-90, trên 90 ngày)"""
+    try:
+        as_of_date = datetime.strptime(as_of, "%Y-%m-%d").date() if as_of else date.today()
+    except ValueError:
+        raise HTTPException(
+            status_code=422, 
+            detail="Định dạng ngày không hợp lệ. Sử dụng định dạng YYYY-MM-DD"
+        )
+    try:
+        data, summary, pagination = _build_debt_aging(db, as_of_date, limit, offset, customer, account_id)
         return {
             'success': True,
-            'data': debt_data
+            'data': data,
+            'summary': summary,
+            'pagination': pagination
         }
-        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
 
+
 @router.get("/debt-by-date")
 def get_debt_by_date(
     from_date: str = Query(..., description="Ngày bắt đầu (YYYY-MM-DD)"),
     to_date: str = Query(..., description="Ngày kết thúc (YYYY-MM-DD)"),
     db: Session = Depends(get_db)
 ):
-    """Lấy báo cáo công nợ theo ngày"""
+    """
+    Công nợ theo khách hàng của các hóa đơn lập từ from_date đến hết to_date; số đã
+    thanh toán tính tại ngày to_date
+    """
+    start_date, end_date = _parse_date_range(from_date, to_date)
     try:
-        # Validate date format
-        try:
-            start_date = datetime.strptime(from_date, "%Y-%m-%d").date()
-            end_date = datetime.strptime(to_date, "%Y-%m-%d").date()
-        except ValueError:
-            raise HTTPException(
-                status_code=422, 
-                detail="Định dạng ngày không hợp lệ. Sử dụng định dạng YYYY-MM-DD"
-            )
-        
-        if start_date > end_date:
-            raise HTTPException(status_code=400, detail="Ngày bắt đầu phải nhỏ hơn ngày kết thúc")
-        
-        # Lấy dữ liệu từ bảng debts (đã được cập nhật bởi API payment-status)
-        from ..models import Debt
-        debt_records = db.query(Debt).all()
-        
-        print(f"🔍 Found {len(debt_records)} debt records in database")
-        
-        # Chuyển thành list với format phù hợp với frontend
-        debt_data = []
-        for debt_record in debt_records:
-            debt_data.append({
-                'customer_name': debt_record.customer_name,
-                'total_debt': float(getattr(debt_record, 'total_debt', 0) or 0),
-                'paid_amount': float(getattr(debt_record, 'paid_amount', 0) or 0),
-                'remaining_debt': float(getattr(debt_record, 'remaining_debt', 0) or 0),
-                'status': str(getattr(debt_record, 'status', '') or 'Còn nợ')
-            })
-        
-        print(f"📊 Debt report summary: {len(debt_data)} customers")
-        for item in debt_data:
-            print(f"  - {item['customer_name']}: Total={item['total_debt']:,.0f}, Paid={item['paid_amount']:,.0f}, Remaining={item['remaining_debt']:,.0f}")
-            
-        # Debug: In ra chi tiết từng record trong bảng debts
-        print(f"🔍 Detailed debt records:")
-        for debt_record in debt_records:
-            print(f"  Customer: {debt_record.customer_name}")
-            print(f"    - Total Debt: {getattr(debt_record, 'total_debt', 0):,.0f}")
-            print(f"    - Paid Amount: {getattr(debt_record, 'paid_amount', 0):,.0f}")
-            print(f"    - Remaining Debt: {getattr(debt_record, 'remaining_debt', 0):,.0f}")
-            print(f"    - Status: {getattr(debt_record, 'status', 'N/A')}")
-        
+        debt_data = [
+            {
+                'customer_name': item['ten_khach_hang'],
+                'total_debt': item['tong_cong_no'],
+                'paid_amount': item['da_thanh_toan'],
+                'remaining_debt': item['con_no'],
+                'status': item['trang_thai']
+            }
+            for item in _build_debt_report(db, start_date=start_date, end_date=end_date)
+        ]
         return {
             'success': True,
             'data': debt_data
         }
         
-    except HTTPException:
-        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
 
@@ -345,144 +765,52 @@ def update_payment_status(
     payload: dict,
     db: Session = Depends(get_db)
 ):
-    """Cập nhật trạng thái thanh toán cho khách hàng"""
+    """
+    Cập nhật số tiền khách hàng đã thanh toán (paid_amount là tổng lũy kế).
+    Phần tăng thêm so với số đã nhận (đã phân bổ vào hóa đơn + phần thanh toán
+    vượt công nợ chưa phân bổ) được ghi thành một khoản thanh toán và phân bổ FIFO
+    vào hóa đơn; gửi lại cùng paid_amount không ghi thêm gì. Điều chỉnh giảm đi
+    qua POST /api/payments với số tiền âm.
+    """
     try:
-        print("🚀 API /payment-status được gọi")
         customer_name = payload.get('customer_name')
         paid_amount = float(payload.get('paid_amount', 0))
         
-        print(f"📋 Input: customer_name={customer_name}, paid_amount={paid_amount}")
-        
         if not customer_name:
             raise HTTPException(status_code=400, detail="Tên khách hàng không được để trống")
+        key = customers.key_for(db, payload.get('account_id'), customer_name)
         
-        # Tìm tất cả hóa đơn của khách hàng này
-        invoices = db.query(Invoice).filter(Invoice.nguoi_mua == customer_name).all()
-        
-        print(f"🔍 Tìm thấy {len(invoices)} hóa đơn cho {customer_name}")
-        
-        if not invoices:
+        # Khóa hóa đơn của khách hàng trước khi đọc số đã nhận (hai lần gọi đồng thời chạy lần lượt)
+        payments.lock_invoices(db, key)
+        count, total_debt, current_paid = debts.customer_totals(db, key)
+        if count == 0:
             raise HTTPException(status_code=404, detail=f"Không tìm thấy hóa đơn của khách hàng {customer_name}")
         
-        # Tính tổng công nợ hiện tại
-        total_debt = sum(float(getattr(invoice, 'tong_tien', 0) or 0) for invoice in invoices)
-        current_paid = sum(float(getattr(invoice, 'tong_tien', 0) or 0) for invoice in invoices 
-                          if str(getattr(invoice, 'trang_thai', '') or '') == 'Đã thanh toán')
-        
-        print(f"🔍 Cập nhật thanh toán cho {customer_name}:")
-        print(f"   - Tổng công nợ: {total_debt:,.0f} VND")
-        print(f"   - Đã thanh toán hiện tại: {current_paid:,.0f} VND")
-        print(f"   - Số tiền thanh toán mới: {paid_amount:,.0f} VND")
-        
-        # Đầu tiên, đánh dấu tất cả hóa đơn là "Chưa thanh toán"
-        for invoice in invoices:
-            setattr(invoice, 'trang_thai', 'Chưa thanh toán')
-        
-        # Sau đó, đánh dấu các hóa đơn là "Đã thanh toán" theo thứ tự cho đến khi đủ số tiền
-        remaining_to_pay = paid_amount
+        delta = paid_amount - current_paid - payments.unallocated_total(db, key)
         
-        for invoice in invoices:
-            invoice_amount = float(getattr(invoice, 'tong_tien', 0) or 0)
-            
-            print(f"   - Xử lý hóa đơn: {invoice_amount:,.0f} VND, Còn lại: {remaining_to_pay:,.0f} VND")
-            
-            if remaining_to_pay >= invoice_amount:
-                # Đánh dấu hóa đơn này là "Đã thanh toán"
-                setattr(invoice, 'trang_thai', 'Đã thanh toán')
-                remaining_to_pay -= invoice_amount
-                print(f"     ✅ Đánh dấu 'Đã thanh toán'")
-            else:
-                # Số tiền còn lại không đủ để thanh toán hóa đơn này
-                # Đánh dấu hóa đơn này là "Đã thanh toán một phần"
-                setattr(invoice, 'trang_thai', f'Đã thanh toán {remaining_to_pay:,.0f} VND')
-                remaining_to_pay = 0
-                print(f"     ✅ Đánh dấu 'Đã thanh toán một phần: {remaining_to_pay:,.0f} VND'")
-                break
-        
-        print("💾 Đang commit database...")
-        db.commit()
-        print("✅ Đã commit database")
-        
-        # Debug: Kiểm tra trạng thái sau khi commit
-        print(f"🔍 Kiểm tra trạng thái sau khi commit:")
-        for invoice in invoices:
-            invoice_amount = float(getattr(invoice, 'tong_tien', 0) or 0)
-            invoice_status = str(getattr(invoice, 'trang_thai', '') or '')
-            print(f"   - Hóa đơn: {invoice_amount:,.0f} VND, Trạng thái: '{invoice_status}'")
-        
-        # Tính lại số tiền còn nợ
-        new_paid = 0
-        for invoice in invoices:
-            status = str(getattr(invoice, 'trang_thai', '') or '')
-            if status == 'Đã thanh toán':
-                new_paid += float(getattr(invoice, 'tong_tien', 0) or 0)
-            elif 'Đã thanh toán' in status and 'VND' in status:
-                # Trích xuất số tiền từ trạng thái "Đã thanh toán X VND"
-                try:
-                    import re
-                    match = re.search(r'Đã thanh toán ([\d,]+) VND', status)
-                    if match:
-                        paid_str = match.group(1).replace(',', '')
-                        paid_amount = float(paid_str)
-                        new_paid += paid_amount
-                        print(f"     💰 Trích xuất số tiền đã thanh toán: {paid_amount:,.0f} VND")
-                except:
-                    print(f"     ⚠️ Không thể trích xuất số tiền từ trạng thái: {status}")
-        
-        remaining_debt = total_debt - new_paid
-        
-        print(f"📊 Kết quả cuối cùng:")
-        print(f"   - Tổng công nợ: {total_debt:,.0f} VND")
-        print(f"   - Đã thanh toán: {new_paid:,.0f} VND")
-        print(f"   - Còn nợ: {remaining_debt:,.0f} VND")
-        
-        # Cập nhật bảng debts để đồng bộ với frontend
-        try:
-            from ..models import Debt
-            debt_record = db.query(Debt).filter(Debt.customer_name == customer_name).first()
-            
-            if debt_record:
-                # Cập nhật record hiện có
-                setattr(debt_record, 'paid_amount', new_paid)
-                setattr(debt_record, 'remaining_debt', remaining_debt)
-                setattr(debt_record, 'status', 'Hết nợ' if remaining_debt <= 0 else 'Còn nợ')
-                if new_paid > 0:
-                    setattr(debt_record, 'last_payment_date', datetime.now())
-                print(f"✅ Đã cập nhật bảng debts cho {customer_name}")
-            else:
-                # Tạo record mới nếu chưa có
-                debt_record = Debt(
-                    customer_name=customer_name,
-                    total_debt=total_debt,
-                    paid_amount=new_paid,
-                    remaining_debt=remaining_debt,
-                    status='Hết nợ' if remaining_debt <= 0 else 'Còn nợ',
-                    created_at=datetime.now()
-                )
-                db.add(debt_record)
-                print(f"✅ Đã tạo record mới trong bảng debts cho {customer_name}")
-            
-            # Commit thay đổi bảng debts
+        if delta > 0:
+            payments.record_payment(
+                db, customer_name, delta, ghi_chu='Cập nhật từ báo cáo công nợ', account_id=key.account_id
+            )
             db.commit()
-            print(f"✅ Đã commit cập nhật bảng debts")
-            
-        except Exception as e:
-            print(f"⚠️ Lỗi cập nhật bảng debts: {e}")
-            # Không rollback vì hóa đơn đã được cập nhật thành công
+        
+        _, total_debt, new_paid = debts.customer_totals(db, key)
         
         return {
             'success': True,
             'data': {
                 'customer_name': customer_name,
+                'account_id': key.account_id,
                 'total_debt': total_debt,
                 'paid_amount': new_paid,
-                'remaining_debt': remaining_debt
+                'remaining_debt': total_debt - new_paid
             }
         }
         
-    except HTTPException:
+    except (HTTPException, customers.UnknownAccount):
         raise
     except Exception as e:
+        db.rollback()
         print(f"❌ Lỗi: {e}")
         raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
 
@@ -540,123 +868,3 @@ def delete_report(report_id: int, db: Session = Depends(get_db)):
     db.delete(report)
     db.commit()
     return {"success": True}
-
-@router.get("/revenue-by-product")
-def get_revenue_by_product(from_date: str, to_date: str, db: Session = Depends(get_db)):
-    """
-    Lấy báo cáo doanh thu theo sản phẩm từ from_date đến to_date
-    """
-    try:
-        # Parse dates
-        start_date = datetime.strptime(from_date, "%Y-%m-%d").date()
-        end_date = datetime.strptime(to_date, "%Y-%m-%d").date()
-        
-        # Validate date range
-        if (end_date - start_date).days > 31:
-            raise HTTPException(status_code=400, detail="Khoảng thời gian tối đa là 31 ngày")
-        
-        if start_date > end_date:
-            raise HTTPException(status_code=400, detail="Ngày bắt đầu phải nhỏ hơn ngày kết thúc")
-        
-        # Get orders in date range (không bị hủy)
-        orders = db.query(Order).filter(
-            Order.ngay_tao.between(start_date, end_date),
-            Order.trang_thai != 'Đã hủy'
-        ).all()
-        
-        # Get products to map sp_banggia to product info
-        products = db.query(Product).all()
-        product_map = {p.ma_sp: p for p in products}
-        
-        # Group orders by product
-        product_revenue = {}
-        for order in orders:
-            sp_code = getattr(order, 'sp_banggia', None)
-            if sp_code:
-                product = product_map.get(sp_code)
-                if product:
-                    product_key = sp_code
-                    if product_key not in product_revenue:
-                        product_revenue[product_key] = {
-                            'ten_sp': getattr(product, 'ten_sp', None),
-                            'nhom_sp': getattr(product, 'nhom_sp', None) or 'Chưa phân loại',
-                            'total_quantity': 0,
-                            'total_revenue': 0
-                        }
-                    
-                    # Tính doanh thu từ hóa đơn đã thanh toán
-                    # Tìm hóa đơn tương ứng với đơn hàng này
-                    invoice = db.query(Invoice).filter(
-                        Invoice.ngay_hd.between(start_date, end_date),
-                        Invoice.trang_thai == 'Đã thanh toán'
-                    ).first()
-                    
-                    if invoice:
-                        # Tính doanh thu dựa trên tỷ lệ đơn hàng
-                        order_total = getattr(order, 'tong_tien', 0)
-                        order_revenue = float(order_total or 0)
-                        product_revenue[product_key]['total_revenue'] += order_revenue
-                    
-                    product_revenue[product_key]['total_quantity'] += int(getattr(order, 'so_luong', 0) or 0)
-        
-        # Convert to list format
-        product_list = []
-        for i, (product_code, data) in enumerate(product_revenue.items(), 1):
-            product_list.append({
-                'stt': i,
-                'ten_sp': data['ten_sp'],
-                'nhom_sp': data['nhom_sp'],
-                'total_quantity': data['total_quantity'],
-                'total_revenue': data['total_revenue']
-            })
-        
-        # Calculate chart data (daily revenue for the chart)
-        revenue_data = {}
-        invoices = db.query(Invoice).filter(
-            Invoice.ngay_hd.between(start_date, end_date),
-            Invoice.trang_thai == 'Đã thanh toán'
-        ).all()
-        
-        for invoice in invoices:
-            date_key = invoice.ngay_hd.strftime("%Y-%m-%d")
-            if date_key not in revenue_data:
-                revenue_data[date_key] = 0
-            revenue_data[date_key] += float(getattr(invoice, 'tong_tien', 0) or 0)
-        
-        # Generate date range for chart
-        date_range = []
-        current_date = start_date
-        while current_date <= end_date:
-            date_range.append(current_date)
-            current_date += timedelta(days=1)
-        
-        chart_data = {
-            'labels': [date.strftime("%d/%m/%Y") for date in date_range],
-            'revenue': [revenue_data.get(date.strftime("%Y-%m-%d"), 0) for date in date_range]
-        }
-        
-        # Calculate totals
-        total_revenue = sum(data['total_revenue'] for data in product_list)
-        total_quantity = sum(data['total_quantity'] for data in product_list)
-        
-        return {
-            'success': True,
-            'data': {
-                'products': product_list,
-                'chart_data': chart_data,
-                'summary': {
-                    'total_revenue': total_revenue,
-                    'total_quantity': total_quantity,
-                    'date_range': {
-                        'from_date': from_date,
-                        'to_date': to_date,
-                        'total_days': len(date_range)
-                    }
-                }
-            }
-        }
-        
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=f"Định dạng ngày không hợp lệ: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
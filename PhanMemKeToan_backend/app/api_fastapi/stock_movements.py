@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import and_
+from sqlalchemy.orm import Session
+from ..database import get_db
+from ..models import Product, StockMovement
+from ..schemas_fastapi import StockMovementOut
+from ..config import Config
+from .. import stock_ledger, stock_shards
+from .. import pagination
+from ..pagination import PageParams, page_params
+
+
+router = APIRouter(prefix="/stock", tags=["stock"])
+
+MOVEMENT_SORT_FIELDS = {'id': StockMovement.id}
+
+
+@router.get("/movements")
+def list_movements(
+    product_id: int | None = None,
+    ma_sp: str | None = None,
+    source_type: str | None = None,
+    source_id: int | None = None,
+    page: PageParams = Depends(page_params),
+    db: Session = Depends(get_db)
+):
+    """Sổ kho (luôn phân trang keyset theo id vì bảng chỉ tăng thêm)"""
+    query = (
+        db.query(
+            StockMovement.id, StockMovement.product_id, Product.ma_sp, StockMovement.warehouse_id,
+            StockMovement.delta, StockMovement.source_type, StockMovement.source_id, StockMovement.created_at
+        )
+        .join(Product, Product.id == StockMovement.product_id)
+    )
+    if product_id is not None:
+        query = query.filter(StockMovement.product_id == product_id)
+    if ma_sp:
+        query = query.filter(Product.ma_sp == ma_sp)
+    if source_type:
+        query = query.filter(StockMovement.source_type == source_type)
+    if source_id is not None:
+        query = query.filter(StockMovement.source_id == source_id)
+    rows, page_info = pagination.paginate(query, page, MOVEMENT_SORT_FIELDS, StockMovement.id)
+    return pagination.page_response([StockMovementOut.model_validate(row._mapping) for row in rows], page_info)
+
+
+@router.get("/as-of")
+def stock_as_of(
+    ngay: str,
+    ma_sp: str | None = None,
+    nhom_sp: str | None = None,
+    db: Session = Depends(get_db)
+):
+    """Tồn kho của tất cả sản phẩm vào cuối ngày ngay (YYYY-MM-DD), dùng cho khóa sổ cuối kỳ"""
+    try:
+        day = datetime.strptime(ngay, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(
+            status_code=422,
+            detail="Định dạng ngày không hợp lệ. Sử dụng định dạng YYYY-MM-DD"
+        )
+    conditions = []
+    if ma_sp:
+        conditions.append(Product.ma_sp == ma_sp)
+    if nhom_sp:
+        conditions.append(Product.nhom_sp == nhom_sp)
+    product_filter = and_(*conditions) if conditions else None
+    rows = stock_ledger.balances_as_of(db, day + timedelta(days=1), product_filter)
+    return {
+        "success": True,
+        "ngay": ngay,
+        "tong_so_luong": sum(row['so_luong'] for row in rows),
+        "products": rows,
+    }
+
+
+@router.get("/audit")
+def audit_stock(product_id: int | None = None, db: Session = Depends(get_db)):
+    """So sánh products.so_luong với số dư theo sổ kho (checkpoint cuối + movement sau nó)"""
+    checked, drift = stock_ledger.audit(db, Product.id == product_id if product_id is not None else None)
+    return {"success": True, "checked": checked, "drift": drift}
+
+
+@router.post("/rebuild")
+def rebuild_stock(product_id: int | None = None, db: Session = Depends(get_db)):
+    """
+    Đặt lại so_luong của các sản phẩm bị lệch theo số dư trong sổ kho; sản phẩm có
+    checkpoint không khớp tổng movement không bị ghi đè (skipped)
+    """
+    updated, skipped = stock_ledger.rebuild(db, Product.id == product_id if product_id is not None else None)
+    db.commit()
+    return {"success": True, "updated": updated, "skipped": skipped}
+
+
+@router.post("/checkpoint")
+def checkpoint_stock(db: Session = Depends(get_db)):
+    """Chốt số dư sổ kho ngay (bình thường chạy định kỳ trên thread nền)"""
+    created = stock_ledger.checkpoint(db)
+    db.commit()
+    return {"success": True, "created": created}
+
+
+def _get_product(db: Session, product_id: int):
+    product = db.query(Product).get(product_id)
+    if not product:
+        raise HTTPException(status_code=404, detail="Không tìm thấy sản phẩm")
+    return product
+
+
+@router.post("/hot/{product_id}")
+def enable_hot_product(
+    product_id: int,
+    shards: int | None = Query(None, ge=2, le=256),
+    db: Session = Depends(get_db)
+):
+    """Đánh dấu sản phẩm bán chạy: chia tồn kho vào nhiều shard để các đơn hàng trừ kho song song"""
+    _get_product(db, product_id)
+    shards = shards or Config.STOCK_HOT_SHARDS
+    total = stock_shards.enable(db, product_id, shards)
+    db.commit()
+    return {"success": True, "so_shard": shards, "so_luong": total}
+
+
+@router.post("/hot/{product_id}/rebalance")
+def rebalance_hot_product(product_id: int, db: Session = Depends(get_db)):
+    """Chia đều lại tồn kho giữa các shard và đồng bộ products.so_luong"""
+    if not _get_product(db, product_id).so_shard:
+        raise HTTPException(status_code=400, detail="Sản phẩm không được chia shard")
+    total = stock_shards.rebalance(db, product_id)
+    db.commit()
+    return {"success": True, "so_luong": total}
+
+
+@router.delete("/hot/{product_id}")
+def disable_hot_product(product_id: int, db: Session = Depends(get_db)):
+    """Bỏ đánh dấu bán chạy: gộp tồn kho các shard về products.so_luong"""
+    if not _get_product(db, product_id).so_shard:
+        raise HTTPException(status_code=400, detail="Sản phẩm không được chia shard")
+    total = stock_shards.disable(db, product_id)
+    db.commit()
+    return {"success": True, "so_luong": total}
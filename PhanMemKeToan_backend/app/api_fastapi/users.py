@@ -4,14 +4,31 @@ from ..database import get_db
 from ..models import User
 from ..schemas_fastapi import UserOut, UserCreate, UserUpdate
 from werkzeug.security import generate_password_hash
+from .. import pagination
+from ..pagination import PageParams, page_params
 
 
 router = APIRouter(prefix="/users", tags=["users"])
 
+USER_SORT_FIELDS = {'id': User.id, 'username': User.username}
 
-@router.get("/", response_model=list[UserOut])
-def list_users(db: Session = Depends(get_db)):
-    return db.query(User).all()
+
+@router.get("/")
+def list_users(
+    department: str | None = None,
+    status: bool | None = None,
+    page: PageParams = Depends(page_params),
+    db: Session = Depends(get_db)
+):
+    query = pagination.search(db.query(User), page.q, [User.username, User.name, User.email])
+    if department:
+        query = query.filter(User.department == department)
+    if status is not None:
+        query = query.filter(User.status == status)
+    if page.is_legacy:
+        return [UserOut.model_validate(user) for user in query.all()]
+    rows, page_info = pagination.paginate(query, page, USER_SORT_FIELDS, User.id)
+    return pagination.page_response([UserOut.model_validate(user) for user in rows], page_info)
 
 
 @router.get("/{user_id}", response_model=UserOut)
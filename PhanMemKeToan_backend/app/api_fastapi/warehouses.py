@@ -3,14 +3,28 @@ from sqlalchemy.orm import Session
 from ..database import get_db
 from ..models import Warehouse
 from ..schemas_fastapi import WarehouseOut, WarehouseCreate
+from .. import pagination
+from ..pagination import PageParams, page_params
 
 
 router = APIRouter(prefix="/warehouses", tags=["warehouses"])
 
-
-@router.get("/", response_model=list[WarehouseOut])
-def list_warehouses(db: Session = Depends(get_db)):
-    return db.query(Warehouse).all()
+WAREHOUSE_SORT_FIELDS = {'id': Warehouse.id, 'ma_kho': Warehouse.ma_kho}
+
+
+@router.get("/")
+def list_warehouses(
+    trang_thai: str | None = None,
+    page: PageParams = Depends(page_params),
+    db: Session = Depends(get_db)
+):
+    query = pagination.search(db.query(Warehouse), page.q, [Warehouse.ma_kho, Warehouse.ten_kho, Warehouse.dia_chi])
+    if trang_thai:
+        query = query.filter(Warehouse.trang_thai == trang_thai)
+    if page.is_legacy:
+        return [WarehouseOut.model_validate(wh) for wh in query.all()]
+    rows, page_info = pagination.paginate(query, page, WAREHOUSE_SORT_FIELDS, Warehouse.id)
+    return pagination.page_response([WarehouseOut.model_validate(wh) for wh in rows], page_info)
 
 
 @router.post("/")
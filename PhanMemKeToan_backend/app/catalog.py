@@ -0,0 +1,101 @@
+"""
+In-process catalog cache for PhanMemKeToan application
+
+Mã sp_banggia của đơn hàng là một dòng bảng giá loại "Hành động" hoặc một sản
+phẩm có tồn kho. Việc phân loại cần dữ liệu của cả prices và products, nên được
+lưu trong một cache LRU giới hạn theo mã: ma_sp -> (loại, đơn giá, product id).
+Các mã chưa có trong cache được tra bằng một câu UNION ALL trên hai bảng; mã
+không tồn tại cũng được lưu (loại UNKNOWN). prices.py/products.py đánh dấu mã bị
+thay đổi vào session (mark_dirty) và cache chỉ bị xóa khi transaction commit.
+Tồn kho không được cache (luôn đọc/ghi trực tiếp, xem stock.py).
+"""
+from collections import namedtuple
+from sqlalchemy import select, union_all, literal, null, Integer, String
+from sqlalchemy.orm import Session
+from .config import Config
+from .lru_cache import LRUCache, invalidate_after_commit
+from .models import Price, Product
+
+_DIRTY_KEY = 'catalog_cache_dirty'
+
+ACTION = 'action'    # Bảng giá loại "Hành động": không kiểm tra tồn kho
+PRODUCT = 'product'  # Sản phẩm trong products: kiểm tra và trừ tồn kho
+UNKNOWN = 'unknown'  # Không có trong prices/products: xử lý như hành động
+
+ACTION_PRICE_TYPE = 'Hành động'
+
+# unit_price: giá chung của sản phẩm (PRODUCT) hoặc của bảng giá; None nếu không có
+CatalogEntry = namedtuple('CatalogEntry', ['kind', 'unit_price', 'product_id'])
+
+UNKNOWN_ENTRY = CatalogEntry(UNKNOWN, None, None)
+
+
+def _entry(price_row, product_row) -> CatalogEntry:
+    """Phân loại như orders.py: bảng giá "Hành động" trước, sau đó tới sản phẩm"""
+    if price_row and price_row['loai_sp'] == ACTION_PRICE_TYPE:
+        return CatalogEntry(ACTION, price_row['gia_chung'], None)
+    if product_row:
+        return CatalogEntry(PRODUCT, product_row['gia_chung'], product_row['id'])
+    if price_row:
+        return CatalogEntry(ACTION, price_row['gia_chung'], None)
+    return UNKNOWN_ENTRY
+
+
+def load(db: Session, codes) -> dict:
+    """Tra các mã trong prices và products bằng một câu truy vấn (không dùng cache)"""
+    codes = {c for c in codes if c}
+    if not codes:
+        return {}
+    query = union_all(
+        select(
+            Price.ma_sp, literal('price', String).label('source'), Price.loai_sp,
+            Price.gia_chung, null().cast(Integer).label('product_id')
+        ).where(Price.ma_sp.in_(codes)),
+        select(
+            Product.ma_sp, literal('product', String), null().cast(String),
+            Product.gia_chung, Product.id
+        ).where(Product.ma_sp.in_(codes)),
+    )
+    found = {}
+    for ma_sp, source, loai_sp, gia_chung, product_id in db.execute(query):
+        row = {'loai_sp': loai_sp, 'gia_chung': float(gia_chung) if gia_chung is not None else None, 'id': product_id}
+        found.setdefault(ma_sp, {})[source] = row
+    return {code: _entry(found.get(code, {}).get('price'), found.get(code, {}).get('product')) for code in codes}
+
+
+class CatalogCache(LRUCache):
+    """LRU cache ma_sp -> CatalogEntry, xóa theo mã khi prices/products thay đổi"""
+
+    def lookup(self, db: Session, codes) -> dict:
+        """Trả về {ma_sp: CatalogEntry}; các mã thiếu được tra chung một câu truy vấn"""
+        codes = {c for c in codes if c}
+        result, generation = self._get_many(codes)
+        missing = codes - set(result)
+        if missing:
+            loaded = load(db, missing)
+            result.update(loaded)
+            # Có thay đổi catalog trong lúc đang tra: _put_many không lưu kết quả có thể đã cũ
+            self._put_many(loaded, generation)
+        return result
+
+    def get(self, db: Session, code) -> CatalogEntry:
+        if not code:
+            return UNKNOWN_ENTRY
+        return self.lookup(db, [code])[code]
+
+    def invalidate(self, codes):
+        codes = {c for c in codes if c}
+        if not codes:
+            return 0
+        return self._invalidate(lambda entries: [code for code in codes if code in entries])
+
+
+catalog_cache = CatalogCache(Config.CATALOG_CACHE_SIZE)
+
+
+def mark_dirty(db, codes=()):
+    """Ghi nhận các mã bị thay đổi trong prices/products; cache chỉ bị xóa khi transaction commit"""
+    db.info.setdefault(_DIRTY_KEY, set()).update(c for c in codes if c)
+
+
+invalidate_after_commit(_DIRTY_KEY, catalog_cache.invalidate)
@@ -27,6 +27,40 @@ class Config:
         'http://127.0.0.1:5000,http://localhost:5000'
     ).split(',')
     
+    # Report result cache (number of cached report results, 0 = disabled)
+    REPORT_CACHE_SIZE = int(os.getenv('REPORT_CACHE_SIZE', 256))
+    
+    # Catalog cache (sp_banggia code -> price item/product classification, 0 = disabled)
+    CATALOG_CACHE_SIZE = int(os.getenv('CATALOG_CACHE_SIZE', 4096))
+    
+    # List endpoints: without limit/after return the whole table in the old shape (false = always paginate)
+    LIST_LEGACY_RESPONSES = os.getenv('LIST_LEGACY_RESPONSES', 'true').lower() in ('1', 'true', 'yes')
+    
+    # Search totals: count exactly up to this many matches, above it use the planner estimate (PostgreSQL)
+    SEARCH_EXACT_COUNT_LIMIT = int(os.getenv('SEARCH_EXACT_COUNT_LIMIT', 10000))
+    
+    # Idempotency-Key: how long a stored response is replayed (seconds)
+    IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 86400))
+    # Idempotency-Key: a request still in progress after this long is assumed lost and may be retried (seconds)
+    IDEMPOTENCY_LEASE_SECONDS = int(os.getenv('IDEMPOTENCY_LEASE_SECONDS', 60))
+    
+    # Background report jobs (worker threads, each holds one DB connection while running)
+    REPORT_JOB_WORKERS = int(os.getenv('REPORT_JOB_WORKERS', 2))
+    # A running job not finished after this long is assumed lost and may be resumed by another worker (seconds)
+    REPORT_JOB_LEASE_SECONDS = int(os.getenv('REPORT_JOB_LEASE_SECONDS', 1800))
+    
+    # Bulk order import (maximum rows per POST /api/orders/bulk request)
+    ORDER_BULK_MAX_ROWS = int(os.getenv('ORDER_BULK_MAX_ROWS', 10000))
+    
+    # Stock ledger checkpoints (seconds between background checkpoints, 0 = only on demand)
+    STOCK_CHECKPOINT_INTERVAL_SECONDS = int(os.getenv('STOCK_CHECKPOINT_INTERVAL_SECONDS', 3600))
+    
+    # Hot products: default number of stock_shards rows the stock is split into
+    STOCK_HOT_SHARDS = int(os.getenv('STOCK_HOT_SHARDS', 8))
+    
+    # Customer account backfill (orders/invoices rows resolved per batch/transaction)
+    CUSTOMER_BACKFILL_BATCH_SIZE = int(os.getenv('CUSTOMER_BACKFILL_BATCH_SIZE', 1000))
+    
     # Environment
     ENV = os.getenv('FLASK_ENV', 'development')
     DEBUG = ENV == 'development'
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+Customer account resolution for PhanMemKeToan application
+
+Đơn hàng (thong_tin_kh), hóa đơn (nguoi_mua) và khoản thanh toán (customer_name)
+lưu khách hàng dạng văn bản; cột account_id gắn chúng với bảng accounts để các
+truy vấn theo khách hàng (cả công nợ, bảng debts) dùng index số nguyên. Văn bản được gắn với một tài khoản khi khớp đúng ten_tk hoặc
+dạng "tk_no - tk_co - ten_tk" mà màn hình đơn hàng tạo ra; nếu khớp nhiều tài
+khoản (trùng tên) thì để NULL và các truy vấn dùng lại cách so sánh văn bản.
+
+Dữ liệu cũ được gắn bằng backfill() theo từng lô (chạy trong setup_database.py
+hoặc: python -m app.customers).
+"""
+import logging
+
+from sqlalchemy import update, case, and_
+from sqlalchemy.orm import Session
+from .config import Config
+from .models import Account, Order, Invoice, Payment
+from .sales_rollup import CustomerKey, customer_key
+
+SEPARATOR = ' - '
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownAccount(LookupError):
+    """account_id client gửi lên không có trong bảng accounts"""
+
+    def __init__(self, account_id: int):
+        self.account_id = account_id
+        super().__init__(f"Không tìm thấy khách hàng (account_id={account_id})")
+
+
+def _candidate_names(text: str):
+    """Các ten_tk có thể nằm trong chuỗi: cả chuỗi hoặc phần sau 'tk_no - tk_co - '"""
+    names = {text}
+    parts = text.split(SEPARATOR, 2)
+    if len(parts) == 3 and parts[2].strip():
+        names.add(parts[2].strip())
+    return names
+
+
+def _labels(ten_tk, tk_no, tk_co):
+    """Các cách một tài khoản được ghi vào thong_tin_kh/nguoi_mua"""
+    name = (ten_tk or '').strip()
+    return {name, f"{(tk_no or '').strip()}{SEPARATOR}{(tk_co or '').strip()}{SEPARATOR}{name}".strip()}
+
+
+def resolve(db: Session, texts) -> dict:
+    """{văn bản khách hàng: account_id} cho các văn bản khớp đúng một tài khoản (một câu truy vấn)"""
+    texts = {t for t in texts if t and t.strip()}
+    if not texts:
+        return {}
+    candidates = set()
+    for text in texts:
+        candidates |= _candidate_names(text.strip())
+    matches = {}
+    rows = db.query(Account.id, Account.ten_tk, Account.tk_no, Account.tk_co).filter(Account.ten_tk.in_(candidates))
+    for account_id, ten_tk, tk_no, tk_co in rows:
+        for label in _labels(ten_tk, tk_no, tk_co):
+            matches.setdefault(label, set()).add(account_id)
+    resolved = {}
+    for text in texts:
+        ids = matches.get(text.strip(), set())
+        if len(ids) == 1:
+            resolved[text] = next(iter(ids))
+    return resolved
+
+
+def account_for(db: Session, account_id: int | None, text: str | None):
+    """
+    account_id client gửi lên (không tồn tại -> UnknownAccount) hoặc tài khoản suy ra
+    từ văn bản
+    """
+    if account_id is not None:
+        if db.query(Account.id).filter(Account.id == account_id).first() is None:
+            raise UnknownAccount(account_id)
+        return account_id
+    return resolve(db, [text]).get(text)
+
+
+def key_for(db: Session, account_id: int | None, text: str | None) -> CustomerKey | None:
+    """CustomerKey của khách hàng client gửi lên (account_id hoặc tên, tên được gắn tài khoản nếu khớp)"""
+    return customer_key(account_for(db, account_id, text), text)
+
+
+def matches(key: CustomerKey, account_column, name_column):
+    """Điều kiện SQL: dòng thuộc khách hàng key (theo account_id; dòng chưa gắn tài khoản: theo tên)"""
+    if key.account_id is not None:
+        return account_column == key.account_id
+    return and_(account_column.is_(None), name_column == key.name)
+
+
+def group_columns(account_column, name_column):
+    """Cột GROUP BY theo khách hàng: account_id, và tên chỉ với các dòng chưa gắn tài khoản"""
+    return account_column, case((account_column.is_(None), name_column))
+
+
+def _backfill_table(db: Session, model, text_column, batch_size: int) -> int:
+    """Gắn account_id cho các dòng còn NULL, mỗi lô một transaction (duyệt theo id)"""
+    updated = 0
+    last_id = 0
+    while True:
+        rows = (
+            db.query(model.id, text_column)
+            .filter(model.id > last_id, model.account_id.is_(None), text_column.isnot(None))
+            .order_by(model.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            return updated
+        first_id, last_id = rows[0][0], rows[-1][0]
+        resolved = resolve(db, {text for _, text in rows})
+        if resolved:
+            updated += db.execute(
+                update(model)
+                .where(model.id.between(first_id, last_id), model.account_id.is_(None), text_column.in_(resolved))
+                .values(account_id=case(resolved, value=text_column))
+                .execution_options(synchronize_session=False)
+            ).rowcount
+        db.commit()
+
+
+def backfill(db: Session, batch_size: int | None = None) -> dict:
+    """
+    Gắn account_id cho đơn hàng, hóa đơn và khoản thanh toán cũ theo lô. Hóa đơn được
+    gắn sản phẩm qua đơn hàng đầu tiên của cùng khách hàng và công nợ được gom theo
+    tài khoản, nên bảng tổng hợp doanh thu và bảng debts được tính lại nếu có dòng
+    thay đổi.
+    """
+    from . import sales_rollup, debts
+    batch_size = batch_size or Config.CUSTOMER_BACKFILL_BATCH_SIZE
+    result = {
+        'orders': _backfill_table(db, Order, Order.thong_tin_kh, batch_size),
+        'invoices': _backfill_table(db, Invoice, Invoice.nguoi_mua, batch_size),
+        'payments': _backfill_table(db, Payment, Payment.customer_name, batch_size),
+    }
+    if result['orders'] or result['invoices']:
+        sales_rollup.rebuild(db)
+        db.commit()
+    if result['invoices'] or result['payments']:
+        debts.recompute_all(db)
+        db.commit()
+    return result
+
+
+if __name__ == '__main__':
+    from .database import SessionLocal
+    logging.basicConfig(level=logging.INFO)
+    session = SessionLocal()
+    try:
+        logger.info("Customer accounts backfilled: %s", backfill(session))
+    finally:
+        session.close()
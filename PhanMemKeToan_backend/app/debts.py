@@ -0,0 +1,176 @@
+"""
+Debt (bảng debts) maintenance for PhanMemKeToan application
+
+Bảng debts lưu tổng công nợ / đã thanh toán / còn nợ theo khách hàng để màn hình
+báo cáo công nợ đọc nhanh. Số đã thanh toán là tổng invoices.da_thanh_toan.
+Khách hàng là tài khoản (account_id) nếu hóa đơn đã gắn tài khoản, ngược lại là
+tên người mua (customers.matches).
+
+Mỗi thao tác ghi hóa đơn/thanh toán chỉ cộng phần chênh lệch (apply_delta) vào
+dòng của khách hàng bằng một câu upsert, trong cùng transaction với thao tác
+đó. recompute/recompute_all tính lại từ hóa đơn, dùng để sửa dữ liệu.
+"""
+from datetime import datetime
+from sqlalchemy import select, func, case, literal, null, and_, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .models import Account, Debt, Invoice
+from .sales_rollup import CustomerKey, customer_key
+from . import customers
+
+DEBT_OPEN = 'Còn nợ'
+DEBT_CLOSED = 'Hết nợ'
+
+
+def debt_status(remaining_debt) -> str:
+    return DEBT_CLOSED if float(remaining_debt or 0) <= 0 else DEBT_OPEN
+
+
+def _status_expr(remaining):
+    return case((remaining <= 0, DEBT_CLOSED), else_=DEBT_OPEN)
+
+
+def customer_totals(db: Session, key: CustomerKey):
+    """(số hóa đơn, tổng công nợ, đã thanh toán) của khách hàng, tính trong SQL"""
+    count, total_debt, paid_amount = db.query(
+        func.count(Invoice.id),
+        func.coalesce(func.sum(Invoice.tong_tien), 0),
+        func.coalesce(func.sum(Invoice.da_thanh_toan), 0),
+    ).filter(customers.matches(key, Invoice.account_id, Invoice.nguoi_mua)).one()
+    return int(count), float(total_debt), float(paid_amount)
+
+
+def _upsert(stmt, account_linked: bool, set_):
+    """ON CONFLICT theo unique index của dòng: account_id, hoặc customer_name khi chưa gắn tài khoản"""
+    if account_linked:
+        return stmt.on_conflict_do_update(
+            index_elements=['account_id'], index_where=Debt.account_id.isnot(None), set_=set_
+        )
+    return stmt.on_conflict_do_update(
+        index_elements=['customer_name'], index_where=Debt.account_id.is_(None), set_=set_
+    )
+
+
+def apply_delta(db: Session, account_id: int | None, customer_name: str, total_delta: float = 0,
+                paid_delta: float = 0, payment_made: bool = False):
+    """
+    Cộng phần chênh lệch vào dòng debts của khách hàng (upsert nguyên tử, không commit).
+    Khách hàng có tài khoản: dòng theo account_id (customer_name chỉ dùng để hiển thị).
+    """
+    if (account_id is None and not customer_name) or (not total_delta and not paid_delta and not payment_made):
+        return
+    total_delta = float(total_delta or 0)
+    paid_delta = float(paid_delta or 0)
+    now = datetime.now()
+    stmt = insert(Debt).values(
+        customer_name=customer_name or '',
+        account_id=account_id,
+        total_debt=total_delta,
+        paid_amount=paid_delta,
+        remaining_debt=total_delta - paid_delta,
+        status=debt_status(total_delta - paid_delta),
+        last_payment_date=now if payment_made else None,
+        created_at=now,
+        updated_at=now,
+    )
+    table = Debt.__table__
+    remaining = table.c.remaining_debt + stmt.excluded.remaining_debt
+    set_ = {
+        'total_debt': table.c.total_debt + stmt.excluded.total_debt,
+        'paid_amount': table.c.paid_amount + stmt.excluded.paid_amount,
+        'remaining_debt': remaining,
+        'status': _status_expr(remaining),
+        'updated_at': stmt.excluded.updated_at,
+    }
+    if payment_made:
+        set_['last_payment_date'] = stmt.excluded.last_payment_date
+    db.execute(_upsert(stmt, account_id is not None, set_))
+
+
+def apply_invoice(db: Session, invoice: Invoice, sign: int = 1):
+    """Cộng (sign=1) hoặc trừ (sign=-1) phần của một hóa đơn vào công nợ người mua"""
+    apply_delta(
+        db, invoice.account_id, invoice.nguoi_mua,
+        sign * float(invoice.tong_tien or 0),
+        sign * float(invoice.da_thanh_toan or 0)
+    )
+
+
+def _row_of(key: CustomerKey):
+    if key.account_id is not None:
+        return Debt.account_id == key.account_id
+    return and_(Debt.account_id.is_(None), Debt.customer_name == key.name)
+
+
+def recompute(db: Session, account_id: int | None, customer_name: str, payment_made: bool = False):
+    """Tính lại dòng debts của khách hàng từ hóa đơn (không commit)"""
+    key = customer_key(account_id, customer_name)
+    if key is None:
+        return None
+    count, total_debt, paid_amount = customer_totals(db, key)
+    remaining_debt = total_debt - paid_amount
+    debt_record = db.query(Debt).filter(_row_of(key)).first()
+    if debt_record is None:
+        if count == 0:
+            return None
+        debt_record = Debt(customer_name=customer_name or '', account_id=account_id, created_at=datetime.now())
+        db.add(debt_record)
+    debt_record.total_debt = total_debt
+    debt_record.paid_amount = paid_amount
+    debt_record.remaining_debt = remaining_debt
+    debt_record.status = debt_status(remaining_debt)
+    if payment_made:
+        debt_record.last_payment_date = datetime.now()
+    return debt_record
+
+
+def _recompute_source(account_linked: bool, now):
+    """SELECT các dòng debts tính từ hóa đơn: theo account_id, hoặc theo nguoi_mua với hóa đơn chưa gắn tài khoản"""
+    total_debt = func.coalesce(func.sum(Invoice.tong_tien), 0)
+    paid_amount = func.coalesce(func.sum(Invoice.da_thanh_toan), 0)
+    remaining = total_debt - paid_amount
+    totals = (total_debt, paid_amount, remaining, _status_expr(remaining), literal(now), literal(now))
+    if account_linked:
+        return (
+            select(func.coalesce(func.max(Account.ten_tk), func.min(Invoice.nguoi_mua)), Invoice.account_id, *totals)
+            .select_from(Invoice)
+            .join(Account, Account.id == Invoice.account_id)
+            .group_by(Invoice.account_id)
+        )
+    return (
+        select(Invoice.nguoi_mua, null(), *totals)
+        .where(Invoice.account_id.is_(None))
+        .group_by(Invoice.nguoi_mua)
+    )
+
+
+def recompute_all(db: Session):
+    """
+    Tính lại toàn bộ bảng debts từ hóa đơn bằng hai câu INSERT ... SELECT ... GROUP BY
+    (upsert): khách hàng có tài khoản theo account_id, còn lại theo nguoi_mua; rồi
+    đưa về 0 các khách hàng không còn hóa đơn. Không commit.
+    """
+    now = datetime.now()
+    columns = ['customer_name', 'account_id', 'total_debt', 'paid_amount', 'remaining_debt', 'status',
+               'created_at', 'updated_at']
+    for account_linked in (True, False):
+        stmt = insert(Debt).from_select(columns, _recompute_source(account_linked, now))
+        db.execute(_upsert(stmt, account_linked, {
+            'customer_name': stmt.excluded.customer_name,
+            'total_debt': stmt.excluded.total_debt,
+            'paid_amount': stmt.excluded.paid_amount,
+            'remaining_debt': stmt.excluded.remaining_debt,
+            'status': stmt.excluded.status,
+            'updated_at': stmt.excluded.updated_at,
+        }))
+    linked = select(Invoice.account_id).where(Invoice.account_id.isnot(None)).distinct()
+    unlinked = select(Invoice.nguoi_mua).where(Invoice.account_id.is_(None)).distinct()
+    orphaned = db.query(Debt).filter(or_(
+        and_(Debt.account_id.isnot(None), ~Debt.account_id.in_(linked)),
+        and_(Debt.account_id.is_(None), ~Debt.customer_name.in_(unlinked)),
+    ))
+    orphaned.update(
+        {Debt.total_debt: 0, Debt.paid_amount: 0, Debt.remaining_debt: 0, Debt.status: DEBT_CLOSED},
+        synchronize_session=False
+    )
+    return db.query(func.count(Debt.id)).scalar()
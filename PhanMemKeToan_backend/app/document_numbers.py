@@ -0,0 +1,199 @@
+"""
+Document number allocation for PhanMemKeToan application
+
+Số hóa đơn (HĐ-0001) và mã đơn hàng (DH-000001) được cấp từ bảng document_series:
+mỗi dãy một dòng, cấp số bằng một câu UPDATE ... SET so_hien_tai = so_hien_tai + n
+RETURNING nên hai người tạo chứng từ cùng lúc không thể nhận cùng một số, không
+cần đọc chứng từ cuối cùng hay thử lại khi trùng khóa unique.
+
+- khoi = 1: cấp trong transaction của chứng từ. Dòng dãy số bị khóa tới khi commit
+  nên số liên tục, không nhảy số khi rollback (hóa đơn).
+- khoi > 1: mỗi worker giữ trước một khối khoi số (transaction riêng, commit ngay,
+  kể cả lần cấp đầu tiên) và cấp dần trong bộ nhớ; không chờ khóa nhưng số giữa
+  các worker không theo thứ tự thời gian và có thể bị bỏ trống khi
+  rollback/khởi động lại (đơn hàng).
+
+Đổi khoi/tiền tố có hiệu lực ở mỗi worker khi worker đó lấy khối tiếp theo.
+
+Mã nhập tay có dạng của dãy số (tiền tố hiện tại + chữ số, vd. DH-000123) bị từ
+chối (is_series_code): số đó có thể đang nằm trong khối của một worker hoặc sẽ được
+cấp sau này và trùng với chứng từ nhập tay.
+"""
+import re
+import threading
+from collections import namedtuple
+from sqlalchemy import update, func, cast, BigInteger
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .models import DocumentSeries, Invoice, Order
+
+INVOICE = 'invoice'
+ORDER = 'order'
+
+SeriesDefault = namedtuple('SeriesDefault', 'tien_to do_dai khoi column')
+
+# Cấu hình ban đầu của các dãy số; column dùng để tiếp nối số lớn nhất đang có
+DEFAULTS = {
+    INVOICE: SeriesDefault('HĐ-', 4, 1, Invoice.so_hd),
+    ORDER: SeriesDefault('DH-', 6, 20, Order.ma_don_hang),
+}
+
+
+class _Block:
+    """Các khoảng số worker đang giữ: [[next, last, tien_to, do_dai], ...] (gồm last)"""
+
+    def __init__(self):
+        self.ranges = []
+
+    def take(self, count: int) -> list:
+        numbers = []
+        while self.ranges and len(numbers) < count:
+            current = self.ranges[0]
+            next_number, last, tien_to, do_dai = current
+            take = min(count - len(numbers), last - next_number + 1)
+            numbers.extend(format_number(tien_to, do_dai, n) for n in range(next_number, next_number + take))
+            current[0] += take
+            if current[0] > last:
+                self.ranges.pop(0)
+        return numbers
+
+    def peek(self):
+        if not self.ranges:
+            return None
+        next_number, _, tien_to, do_dai = self.ranges[0]
+        return next_number, format_number(tien_to, do_dai, next_number)
+
+
+_blocks = {}
+_blocks_lock = threading.Lock()
+
+
+def format_number(tien_to: str, do_dai: int, number: int) -> str:
+    return f"{tien_to}{number:0{do_dai}d}"
+
+
+def series_pattern(db: Session, ma: str):
+    """Regex các mã có dạng số của dãy ma theo tiền tố hiện tại (dãy chưa tạo: tiền tố mặc định)"""
+    tien_to = db.query(DocumentSeries.tien_to).filter(DocumentSeries.ma == ma).scalar()
+    if tien_to is None:
+        tien_to = DEFAULTS[ma].tien_to
+    return re.compile(re.escape(tien_to) + '[0-9]+')
+
+
+def is_series_code(db: Session, ma: str, code: str) -> bool:
+    """Mã nhập tay có dạng số do dãy ma cấp (chỉ allocate được cấp các mã này)"""
+    return series_pattern(db, ma).fullmatch(code) is not None
+
+
+def series_code_detail(code: str) -> str:
+    return f"Mã '{code}' có dạng số tự động của dãy số, để trống để hệ thống cấp số"
+
+
+def _highest_used(db: Session, column, tien_to: str) -> int:
+    """Số lớn nhất đang được dùng với tiền tố (dữ liệu nhập trước khi có dãy số), tính trong SQL"""
+    pattern = '^' + re.escape(tien_to) + '[0-9]{1,18}$'
+    number = cast(func.substr(column, len(tien_to) + 1), BigInteger)
+    return int(db.query(func.coalesce(func.max(number), 0)).filter(column.regexp_match(pattern)).scalar() or 0)
+
+
+def ensure_series(db: Session, ma: str):
+    """Tạo dòng dãy số nếu chưa có, tiếp nối số lớn nhất đang dùng (không commit)"""
+    if db.query(DocumentSeries.ma).filter(DocumentSeries.ma == ma).first() is not None:
+        return
+    default = DEFAULTS[ma]
+    db.execute(
+        insert(DocumentSeries)
+        .values(
+            ma=ma, tien_to=default.tien_to, do_dai=default.do_dai, khoi=default.khoi,
+            so_hien_tai=_highest_used(db, default.column, default.tien_to),
+        )
+        .on_conflict_do_nothing(index_elements=['ma'])
+    )
+
+
+def _reserve(db: Session, ma: str, count: int):
+    """Tăng so_hien_tai thêm count; trả về (so_hien_tai mới, tien_to, do_dai, khoi)"""
+    stmt = (
+        update(DocumentSeries)
+        .where(DocumentSeries.ma == ma)
+        .values(so_hien_tai=DocumentSeries.so_hien_tai + count)
+        .returning(DocumentSeries.so_hien_tai, DocumentSeries.tien_to, DocumentSeries.do_dai, DocumentSeries.khoi)
+    )
+    row = db.execute(stmt).first()
+    if row is None:
+        ensure_series(db, ma)
+        row = db.execute(stmt).one()
+    return row
+
+
+def _block_size(db: Session, ma: str) -> int:
+    """khoi hiện tại của dãy số (đọc không khóa; dãy chưa tạo: khoi mặc định)"""
+    khoi = db.query(DocumentSeries.khoi).filter(DocumentSeries.ma == ma).scalar()
+    return DEFAULTS[ma].khoi if khoi is None else khoi
+
+
+def _reserve_block(db: Session, ma: str, count: int) -> list:
+    """
+    Giữ một khối mới (ít nhất khoi số) trong transaction riêng, commit ngay nên dòng
+    dãy số không bị khóa tới khi chứng từ commit. Trả về count số đầu tiên; phần
+    còn lại vào khối của worker.
+    """
+    with Session(bind=db.get_bind()) as own:
+        # Đọc khoi trong transaction riêng: dãy số chưa có thì được tạo và commit ở đây
+        size = max(_block_size(own, ma), count)
+        row = _reserve(own, ma, size)
+        own.commit()
+    first, last = row.so_hien_tai - size + 1, row.so_hien_tai
+    numbers = [format_number(row.tien_to, row.do_dai, n) for n in range(first, first + count)]
+    with _blocks_lock:
+        if row.khoi > 1:
+            block = _blocks.setdefault(ma, _Block())
+            if first + count <= last:
+                block.ranges.append([first + count, last, row.tien_to, row.do_dai])
+        else:
+            # Dãy số đã chuyển về cấp trong transaction
+            _blocks.pop(ma, None)
+    return numbers
+
+
+def allocate(db: Session, ma: str, count: int = 1) -> list:
+    """Cấp count số liên tiếp của dãy ma (đã định dạng, vd. 'HĐ-0012')"""
+    if count <= 0:
+        return []
+    with _blocks_lock:
+        block = _blocks.get(ma)
+        numbers = block.take(count) if block is not None else []
+    remaining = count - len(numbers)
+    if not remaining:
+        return numbers
+    if block is not None or _block_size(db, ma) > 1:
+        # Dãy số dùng khối: giữ khối mới ngoài _blocks_lock, các luồng khác vẫn lấy số từ khối đang có
+        return numbers + _reserve_block(db, ma, remaining)
+    row = _reserve(db, ma, remaining)
+    numbers.extend(
+        format_number(row.tien_to, row.do_dai, n)
+        for n in range(row.so_hien_tai - remaining + 1, row.so_hien_tai + 1)
+    )
+    return numbers
+
+
+def allocate_one(db: Session, ma: str) -> str:
+    return allocate(db, ma, 1)[0]
+
+
+def peek(db: Session, ma: str):
+    """(số, số đã định dạng) sẽ được cấp tiếp theo ở worker này; chỉ để hiển thị, không giữ số"""
+    with _blocks_lock:
+        block = _blocks.get(ma)
+        upcoming = block.peek() if block is not None else None
+    if upcoming is not None:
+        return upcoming
+    ensure_series(db, ma)
+    series = db.query(DocumentSeries).get(ma)
+    return series.so_hien_tai + 1, format_number(series.tien_to, series.do_dai, series.so_hien_tai + 1)
+
+
+def forget_block(ma: str):
+    """Bỏ khối số worker đang giữ (sau khi đổi cấu hình dãy số); các số chưa dùng bị bỏ trống"""
+    with _blocks_lock:
+        _blocks.pop(ma, None)
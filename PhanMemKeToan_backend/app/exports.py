@@ -0,0 +1,152 @@
+"""
+Streaming CSV/XLSX writers for PhanMemKeToan application
+
+Các hàm ở đây nhận một iterator các dòng (tuple) và sinh ra từng khối bytes,
+để StreamingResponse gửi dữ liệu ngay khi đọc được từ database. Bộ nhớ chỉ phụ
+thuộc vào kích thước một khối, không phụ thuộc số dòng của bảng.
+"""
+import csv
+import io
+import zipfile
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+# Số dòng gom lại trước khi gửi một khối
+CHUNK_ROWS = 1000
+
+CSV_MEDIA_TYPE = 'text/csv; charset=utf-8'
+XLSX_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+EXPORT_FORMATS = ('csv', 'xlsx')
+
+
+def _cell_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def stream_csv(headers, rows):
+    """Sinh CSV (UTF-8 có BOM để Excel đọc đúng tiếng Việt)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(headers)
+    count = 0
+    for row in rows:
+        writer.writerow([_cell_text(value) for value in row])
+        count += 1
+        if count % CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink:
+    """File object chỉ ghi (không seek được): zipfile ghi vào, generator lấy ra từng khối"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '</Relationships>'
+)
+
+
+def _workbook_xml(sheet_name):
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        f'<sheets><sheet name="{escape(sheet_name[:31])}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    )
+
+
+def _xlsx_row(values):
+    cells = []
+    for value in values:
+        if isinstance(value, bool) or value is None:
+            cells.append(f'<c t="inlineStr"><is><t>{escape(_cell_text(value))}</t></is></c>')
+        elif isinstance(value, (int, float)):
+            cells.append(f'<c><v>{value}</v></c>')
+        else:
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{escape(_cell_text(value))}</t></is></c>')
+    return '<row>' + ''.join(cells) + '</row>'
+
+
+def stream_xlsx(headers, rows, sheet_name='Sheet1'):
+    """
+    Sinh file XLSX tối giản (một sheet, chuỗi inline) bằng zipfile của thư viện chuẩn.
+    Sheet được nén và gửi dần theo từng khối dòng.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', _CONTENT_TYPES)
+        archive.writestr('_rels/.rels', _ROOT_RELS)
+        archive.writestr('xl/workbook.xml', _workbook_xml(sheet_name))
+        archive.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS)
+        yield sink.drain()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(_xlsx_row(headers).encode('utf-8'))
+            count = 0
+            for row in rows:
+                sheet.write(_xlsx_row(row).encode('utf-8'))
+                count += 1
+                if count % CHUNK_ROWS == 0:
+                    data = sink.drain()
+                    if data:
+                        yield data
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+
+def stream_export(fmt, headers, rows, sheet_name='Sheet1'):
+    """Chọn writer theo định dạng ('csv' hoặc 'xlsx')"""
+    if fmt == 'xlsx':
+        return stream_xlsx(headers, rows, sheet_name)
+    return stream_csv(headers, rows)
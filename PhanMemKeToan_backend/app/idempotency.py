@@ -0,0 +1,232 @@
+"""
+Idempotency-Key support for write endpoints of PhanMemKeToan application
+
+Client gửi header Idempotency-Key với POST/PUT (đơn hàng, hóa đơn, thanh toán,
+nhật ký chung). Lần đầu, middleware "giữ chỗ" key bằng một câu INSERT ... ON
+CONFLICT trên khóa chính (key đã hết hạn được giữ chỗ lại trong cùng câu lệnh),
+thực hiện yêu cầu rồi lưu phản hồi. Các lần gửi lại trong thời hạn TTL nhận lại
+phản hồi đã lưu mà không thực hiện lại; nếu lần đầu còn đang xử lý thì trả 409.
+Phản hồi lỗi 5xx không được lưu để client có thể thử lại.
+
+Giữ chỗ có thời hạn ngắn (IDEMPOTENCY_LEASE_SECONDS): nếu process chết sau khi
+endpoint commit nhưng trước khi lưu phản hồi, key không bị kẹt ở trạng thái đang
+xử lý tới hết TTL mà lần gửi lại sau khi hết hạn giữ chỗ sẽ giữ chỗ lại và thực
+hiện yêu cầu. Vì vậy thời hạn giữ chỗ phải dài hơn yêu cầu ghi chậm nhất. Lưu và
+bỏ giữ chỗ chỉ áp dụng cho đúng lần giữ chỗ của mình (created_at).
+
+Key và nội dung yêu cầu chỉ được lưu dưới dạng sha256; các dòng hết hạn được xóa
+định kỳ.
+"""
+import hashlib
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, and_, or_
+from sqlalchemy.dialects.postgresql import insert
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from .config import Config
+from .database import engine
+from .models import IdempotencyKey
+
+HEADER = b'idempotency-key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+# Các endpoint ghi được hỗ trợ; yêu cầu đọc dùng POST (vd. /api/invoices/search) không qua middleware
+WRITE_ROUTES = {
+    'POST': re.compile(r'/api/(orders/?|orders/bulk|orders/with-items|invoices/?|payments/?|general-diary/?)'),
+    'PUT': re.compile(r'/api/(orders/[0-9]+|orders/[0-9]+/items|invoices/[0-9]+|general-diary/[0-9]+)'),
+}
+MAX_KEY_LENGTH = 255
+
+# Xóa các key hết hạn tối đa một lần mỗi PURGE_INTERVAL giây (trong mỗi process)
+PURGE_INTERVAL = 300
+_purge_lock = threading.Lock()
+_next_purge = 0.0
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def fingerprint(method: str, path: str, query_string: bytes, body: bytes) -> str:
+    return _sha256(b'\n'.join([method.encode(), path.encode(), query_string, body]))
+
+
+def _purge_due() -> bool:
+    global _next_purge
+    with _purge_lock:
+        now = time.monotonic()
+        if now < _next_purge:
+            return False
+        _next_purge = now + PURGE_INTERVAL
+        return True
+
+
+def purge_expired(conn=None) -> int:
+    stmt = delete(IdempotencyKey).where(IdempotencyKey.expires_at < datetime.now())
+    if conn is not None:
+        return conn.execute(stmt).rowcount
+    with engine.begin() as conn:
+        return conn.execute(stmt).rowcount
+
+
+def claim(key: str, request_fingerprint: str):
+    """
+    Giữ chỗ key (hoặc key đã hết hạn, hoặc key đang xử lý đã hết hạn giữ chỗ);
+    trả về thời điểm giữ chỗ, None nếu key đang được dùng
+    """
+    now = datetime.now()
+    stmt = insert(IdempotencyKey).values(
+        key=key,
+        fingerprint=request_fingerprint,
+        created_at=now,
+        expires_at=now + timedelta(seconds=Config.IDEMPOTENCY_TTL_SECONDS),
+        lease_expires_at=now + timedelta(seconds=Config.IDEMPOTENCY_LEASE_SECONDS),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['key'],
+        set_={
+            'fingerprint': stmt.excluded.fingerprint,
+            'status_code': None,
+            'content_type': None,
+            'response_body': None,
+            'created_at': stmt.excluded.created_at,
+            'expires_at': stmt.excluded.expires_at,
+            'lease_expires_at': stmt.excluded.lease_expires_at,
+        },
+        where=or_(
+            IdempotencyKey.expires_at < now,
+            and_(IdempotencyKey.status_code.is_(None), IdempotencyKey.lease_expires_at < now),
+        ),
+    ).returning(IdempotencyKey.key)
+    with engine.begin() as conn:
+        claimed = conn.execute(stmt).first() is not None
+        if claimed and _purge_due():
+            purge_expired(conn)
+    return now if claimed else None
+
+
+def load(key: str):
+    with engine.connect() as conn:
+        return conn.execute(select(IdempotencyKey.__table__).where(IdempotencyKey.key == key)).first()
+
+
+def _own_claim(key: str, claimed_at: datetime):
+    """Dòng của đúng lần giữ chỗ claimed_at (chưa bị lần gửi lại khác giữ chỗ lại)"""
+    return and_(IdempotencyKey.key == key, IdempotencyKey.created_at == claimed_at)
+
+
+def store(key: str, claimed_at: datetime, status_code: int, content_type: str | None, body: bytes):
+    with engine.begin() as conn:
+        conn.execute(
+            update(IdempotencyKey)
+            .where(_own_claim(key, claimed_at))
+            .values(status_code=status_code, content_type=content_type, response_body=body.decode('utf-8', 'replace'),
+                    lease_expires_at=None)
+        )
+
+
+def release(key: str, claimed_at: datetime):
+    """Bỏ giữ chỗ (yêu cầu lỗi 5xx hoặc exception) để client có thể thử lại"""
+    with engine.begin() as conn:
+        conn.execute(delete(IdempotencyKey).where(_own_claim(key, claimed_at)))
+
+
+def _header(scope, name: bytes):
+    for header_name, value in scope.get('headers', []):
+        if header_name == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+class IdempotencyMiddleware:
+    """ASGI middleware: đọc body một lần, chuyển lại cho endpoint và ghi lại phản hồi"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope['type'] != 'http'
+            or scope['method'] not in WRITE_ROUTES
+            or not WRITE_ROUTES[scope['method']].fullmatch(scope['path'])
+        ):
+            await self.app(scope, receive, send)
+            return
+        raw_key = _header(scope, HEADER)
+        if not raw_key:
+            await self.app(scope, receive, send)
+            return
+        if len(raw_key) > MAX_KEY_LENGTH:
+            await JSONResponse({'detail': f"Idempotency-Key tối đa {MAX_KEY_LENGTH} ký tự"}, status_code=400)(scope, receive, send)
+            return
+
+        body = await _read_body(receive)
+        key = _sha256(raw_key.encode('utf-8'))
+        request_fingerprint = fingerprint(scope['method'], scope['path'], scope.get('query_string', b''), body)
+
+        claimed_at = await run_in_threadpool(claim, key, request_fingerprint)
+        if claimed_at is None:
+            await self._replay(key, request_fingerprint, scope, receive, send)
+            return
+
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            return await receive()
+
+        response = {'status': 500, 'content_type': None, 'chunks': []}
+
+        async def capture_send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['content_type'] = _header(message, b'content-type')
+            elif message['type'] == 'http.response.body':
+                response['chunks'].append(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        except Exception:
+            await run_in_threadpool(release, key, claimed_at)
+            raise
+        if response['status'] >= 500:
+            await run_in_threadpool(release, key, claimed_at)
+        else:
+            await run_in_threadpool(store, key, claimed_at, response['status'], response['content_type'],
+                                    b''.join(response['chunks']))
+
+    async def _replay(self, key, request_fingerprint, scope, receive, send):
+        record = await run_in_threadpool(load, key)
+        if record is None or record.status_code is None:
+            result = JSONResponse(
+                {'detail': "Yêu cầu với Idempotency-Key này đang được xử lý, vui lòng thử lại sau"},
+                status_code=409
+            )
+        elif record.fingerprint != request_fingerprint:
+            result = JSONResponse(
+                {'detail': "Idempotency-Key đã được dùng cho một yêu cầu khác"},
+                status_code=422
+            )
+        else:
+            result = Response(
+                content=record.response_body or '',
+                status_code=record.status_code,
+                media_type=record.content_type,
+                headers={REPLAYED_HEADER: 'true'},
+            )
+        await result(scope, receive, send)
@@ -0,0 +1,109 @@
+"""
+Shared in-process LRU cache for PhanMemKeToan application
+
+Lớp cơ sở của report_cache.ReportCache và catalog.CatalogCache: OrderedDict giới
+hạn số phần tử (loại bỏ theo LRU), khóa giữa các thread, số thế hệ (generation)
+để không lưu kết quả được tính trước một lần xóa, và thống kê. Lớp con chỉ định
+nghĩa khóa cache và cách chọn phần tử cần xóa.
+
+Các thao tác ghi đánh dấu phần dữ liệu bị thay đổi vào session.info;
+invalidate_after_commit đăng ký hook để cache chỉ bị xóa khi transaction commit
+(rollback thì bỏ phần đã đánh dấu).
+"""
+from collections import OrderedDict
+import threading
+from sqlalchemy import event
+from .database import SessionLocal
+
+
+class LRUCache:
+    """LRU cache giới hạn max_entries phần tử, an toàn giữa các thread"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(int(max_entries), 0)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def _get_many(self, keys):
+        """({khóa: giá trị} của các khóa có trong cache, generation lúc đọc)"""
+        found = {}
+        with self._lock:
+            for key in keys:
+                value = self._entries.get(key)
+                if value is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = value
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            return found, self._generation
+
+    def _put_many(self, items: dict, generation: int | None = None):
+        """
+        Lưu các phần tử. Nếu có invalidation xảy ra kể từ `generation` (lúc bắt đầu tính)
+        thì bỏ qua để không lưu kết quả có thể đã cũ.
+        """
+        if self.max_entries == 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            for key, value in items.items():
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _invalidate(self, stale_keys) -> int:
+        """Xóa các khóa do stale_keys(entries) trả về; tăng generation"""
+        with self._lock:
+            self._generation += 1
+            stale = list(stale_keys(self._entries))
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+def invalidate_after_commit(info_key: str, invalidate):
+    """
+    Khi session commit, gọi invalidate(session.info[info_key]) nếu có phần dữ liệu
+    được đánh dấu; khi rollback thì bỏ phần đã đánh dấu.
+    """
+    @event.listens_for(SessionLocal, 'after_commit')
+    def _invalidate_after_commit(session):
+        dirty = session.info.pop(info_key, None)
+        if dirty:
+            invalidate(dirty)
+
+    @event.listens_for(SessionLocal, 'after_rollback')
+    def _discard_after_rollback(session):
+        session.info.pop(info_key, None)
@@ -1,11 +1,14 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from .database import Base, engine
 from .config import Config
+from . import report_jobs, stock_ledger, customers
+from .idempotency import IdempotencyMiddleware
 from .api_fastapi import (
     products, prices, orders, invoices, users, 
     accounts, reports, product_groups, warehouses, 
-    auth, general_diary
+    auth, general_diary, exports, payments, stock_movements, document_series
 )
 
 # Create FastAPI app
@@ -21,6 +24,10 @@ app = FastAPI(
 if Config.ENV == 'development':
     Base.metadata.create_all(bind=engine)
 
+# Idempotency-Key cho POST/PUT đơn hàng, hóa đơn, thanh toán, nhật ký chung
+# (thêm trước CORS để phản hồi trả lại cũng có header CORS)
+app.add_middleware(IdempotencyMiddleware)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -42,6 +49,28 @@ app.include_router(product_groups.router, prefix="/api", tags=["product_groups"]
 app.include_router(warehouses.router, prefix="/api", tags=["warehouses"])
 app.include_router(auth.router, prefix="/api", tags=["authentication"])
 app.include_router(general_diary.router, prefix="/api", tags=["general_diary"])
+app.include_router(exports.router, prefix="/api", tags=["exports"])
+app.include_router(payments.router, prefix="/api", tags=["payments"])
+app.include_router(stock_movements.router, prefix="/api", tags=["stock"])
+app.include_router(document_series.router, prefix="/api", tags=["document_series"])
+
+
+@app.exception_handler(customers.UnknownAccount)
+def unknown_account(request: Request, exc: customers.UnknownAccount):
+    """account_id không tồn tại trong dữ liệu gửi lên -> 422"""
+    return JSONResponse(status_code=422, content={"detail": str(exc)})
+
+@app.on_event("startup")
+def resume_report_jobs():
+    """Đưa lại các job báo cáo chưa hoàn thành vào hàng đợi"""
+    report_jobs.resume_pending(reports.build_report_job)
+
+
+@app.on_event("startup")
+def start_stock_checkpointer():
+    """Chốt số dư sổ kho định kỳ (Config.STOCK_CHECKPOINT_INTERVAL_SECONDS)"""
+    stock_ledger.start_checkpointer()
+
 
 @app.get("/", tags=["root"])
 def read_root():
@@ -1,10 +1,21 @@
 """
 Database models for PhanMemKeToan application
 """
-from sqlalchemy import Column, Integer, String, Float, Date, Boolean, Text, DateTime, func, Numeric, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, Date, Boolean, Text, DateTime, func, Numeric, ForeignKey, Index, DDL, event, text
 from sqlalchemy.orm import relationship
 from .database import Base
 
+# Index trigram (gin_trgm_ops) cho tìm kiếm ILIKE '%...%' cần extension pg_trgm
+event.listen(
+    Base.metadata, 'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql')
+)
+
+
+def trigram_index(name: str, column: str) -> Index:
+    """Index GIN trigram trên PostgreSQL (index thường trên các database khác)"""
+    return Index(name, column, postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'})
+
 
 class User(Base):
     """User model for authentication and authorization"""
@@ -55,6 +66,11 @@ class GeneralDiary(Base):
     so_luong_xuat = Column(Integer, default=0)
     so_tien = Column(Float, default=0.0)
     
+    __table_args__ = (
+        # Phân trang keyset theo ngày nhập (ngay_nhap, id)
+        Index('ix_general_diary_ngay_nhap_id', 'ngay_nhap', 'id'),
+    )
+    
     def __repr__(self):
         return f"<GeneralDiary(so_hieu='{self.so_hieu}', ngay='{self.ngay_nhap}')>"
 
@@ -84,6 +100,7 @@ class Product(Base):
     gia_chung = Column(Float, default=0.0)
     trang_thai = Column(String(50), default='active')
     mo_ta = Column(String(255))
+    so_shard = Column(Integer, default=0)  # > 0: sản phẩm bán chạy, tồn kho chia trong stock_shards
     
     def __repr__(self):
         return f"<Product(ma_sp='{self.ma_sp}', ten_sp='{self.ten_sp}')>"
@@ -120,6 +137,19 @@ class Order(Base):
     tong_tien = Column(Float, default=0.0)
     hinh_thuc_tt = Column(String(50))
     trang_thai = Column(String(50), default='pending')
+    # Khách hàng (accounts) suy ra từ thong_tin_kh; NULL nếu chưa gắn được tài khoản
+    account_id = Column(Integer, ForeignKey('accounts.id', ondelete='SET NULL'))
+    
+    __table_args__ = (
+        # Tra cứu đơn hàng đầu tiên của khách hàng (gắn hóa đơn với sản phẩm)
+        Index('ix_orders_thong_tin_kh_id', 'thong_tin_kh', 'id'),
+        Index('ix_orders_account_id_id', 'account_id', 'id'),
+        # Tìm kiếm đơn hàng theo khách hàng / mã đơn (ILIKE '%...%')
+        trigram_index('ix_orders_thong_tin_kh_trgm', 'thong_tin_kh'),
+        trigram_index('ix_orders_ma_don_hang_trgm', 'ma_don_hang'),
+        # Phân trang keyset theo ngày tạo (ngay_tao, id)
+        Index('ix_orders_ngay_tao_id', 'ngay_tao', 'id'),
+    )
     
     def __repr__(self):
         return f"<Order(ma_don_hang='{self.ma_don_hang}')>"
@@ -130,7 +160,7 @@ class OrderItem(Base):
     __tablename__ = 'order_items'
     
     id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('orders.id'), nullable=False)
+    order_id = Column(Integer, ForeignKey('orders.id'), nullable=False, index=True)
     product_id = Column(Integer, ForeignKey('products.id'), nullable=False)
     so_luong = Column(Integer, nullable=False)
     don_gia = Column(Float, nullable=False)
@@ -151,11 +181,58 @@ class Invoice(Base):
     tong_tien = Column(Float, nullable=False)
     loai_hd = Column(String(50), nullable=False)
     trang_thai = Column(String(50), default='pending')
+    da_thanh_toan = Column(Float, default=0.0)  # Số tiền đã được phân bổ từ các khoản thanh toán
+    # Khách hàng (accounts) suy ra từ nguoi_mua; NULL nếu chưa gắn được tài khoản
+    account_id = Column(Integer, ForeignKey('accounts.id', ondelete='SET NULL'))
+    
+    __table_args__ = (
+        # Báo cáo công nợ / tuổi nợ / công nợ theo ngày của khách hàng chưa gắn tài khoản:
+        # lọc ngay_hd trong từng nguoi_mua, đọc số tiền từ index (index-only scan)
+        Index('ix_invoices_nguoi_mua_ngay_hd', 'nguoi_mua', 'ngay_hd',
+              postgresql_include=['tong_tien', 'da_thanh_toan']),
+        # Phân trang keyset theo ngày hóa đơn (ngay_hd, id)
+        Index('ix_invoices_ngay_hd_id', 'ngay_hd', 'id'),
+        # Hóa đơn theo khách hàng (tài khoản)
+        Index('ix_invoices_account_id_ngay_hd', 'account_id', 'ngay_hd'),
+        # Tìm kiếm ILIKE '%...%' theo số hóa đơn / người mua (POST /invoices/search)
+        trigram_index('ix_invoices_so_hd_trgm', 'so_hd'),
+        trigram_index('ix_invoices_nguoi_mua_trgm', 'nguoi_mua'),
+    )
     
     def __repr__(self):
         return f"<Invoice(so_hd='{self.so_hd}')>"
 
 
+class Payment(Base):
+    """Payment model: một khoản thanh toán của khách hàng (số âm = điều chỉnh giảm)"""
+    __tablename__ = 'payments'
+    
+    id = Column(Integer, primary_key=True)
+    customer_name = Column(String(255), nullable=False, index=True)
+    # Khách hàng (accounts) của khoản thanh toán; NULL: khớp hóa đơn theo customer_name
+    account_id = Column(Integer, ForeignKey('accounts.id', ondelete='SET NULL'), index=True)
+    so_tien = Column(Float, nullable=False)
+    ngay_tt = Column(Date, nullable=False, default=func.current_date(), index=True)
+    ghi_chu = Column(String(255))
+    created_at = Column(DateTime, default=func.now())
+    
+    def __repr__(self):
+        return f"<Payment(customer='{self.customer_name}', so_tien='{self.so_tien}')>"
+
+
+class PaymentAllocation(Base):
+    """Phần của một khoản thanh toán được phân bổ vào một hóa đơn (FIFO)"""
+    __tablename__ = 'payment_allocations'
+    
+    id = Column(Integer, primary_key=True)
+    payment_id = Column(Integer, ForeignKey('payments.id', ondelete='CASCADE'), nullable=False, index=True)
+    invoice_id = Column(Integer, ForeignKey('invoices.id', ondelete='CASCADE'), nullable=False, index=True)
+    so_tien = Column(Float, nullable=False)
+    
+    def __repr__(self):
+        return f"<PaymentAllocation(payment={self.payment_id}, invoice={self.invoice_id}, so_tien='{self.so_tien}')>"
+
+
 class Warehouse(Base):
     """Warehouse model for inventory management"""
     __tablename__ = 'warehouses'
@@ -189,6 +266,7 @@ class Report(Base):
     tong_so_luong_con_lai = Column(Integer, default=0)
     ngay_tao = Column(DateTime, default=func.now())
     trang_thai = Column(String(50), default='active')
+    lease_expires_at = Column(DateTime)  # job đang chạy: hết hạn giữ chỗ của worker đang tính
     
     def __repr__(self):
         return f"<Report(ten_bao_cao='{self.ten_bao_cao}', loai='{self.loai_bao_cao}')>"
@@ -199,7 +277,9 @@ class Debt(Base):
     __tablename__ = 'debts'
     
     id = Column(Integer, primary_key=True)
-    customer_name = Column(String(255), nullable=False, index=True)
+    customer_name = Column(String(255), nullable=False)
+    # Khách hàng (accounts); NULL: công nợ của các hóa đơn chưa gắn tài khoản có nguoi_mua = customer_name
+    account_id = Column(Integer, ForeignKey('accounts.id', ondelete='CASCADE'))
     total_debt = Column(Numeric(15, 2), default=0.00)
     paid_amount = Column(Numeric(15, 2), default=0.00)
     remaining_debt = Column(Numeric(15, 2), default=0.00)
@@ -208,5 +288,121 @@ class Debt(Base):
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
     
+    __table_args__ = (
+        # Mỗi khách hàng một dòng: cập nhật công nợ là một câu upsert theo account_id,
+        # hoặc theo customer_name với khách hàng chưa gắn tài khoản
+        Index('uq_debts_account_id', 'account_id', unique=True,
+              postgresql_where=text('account_id IS NOT NULL'), sqlite_where=text('account_id IS NOT NULL')),
+        Index('uq_debts_unlinked_customer_name', 'customer_name', unique=True,
+              postgresql_where=text('account_id IS NULL'), sqlite_where=text('account_id IS NULL')),
+    )
+    
+    def __repr__(self):
+        return f"<Debt(customer='{self.customer_name}', remaining='{self.remaining_debt}')>"
+
+
+class StockMovement(Base):
+    """Một thay đổi tồn kho (chỉ thêm, không sửa): delta > 0 nhập/hoàn trả, delta < 0 xuất"""
+    __tablename__ = 'stock_movements'
+    
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey('products.id', ondelete='CASCADE'), nullable=False)
+    warehouse_id = Column(Integer, ForeignKey('warehouses.id', ondelete='SET NULL'))
+    delta = Column(Integer, nullable=False)
+    source_type = Column(String(30), nullable=False)  # order / product / opening
+    source_id = Column(Integer)  # id chứng từ nguồn (đơn hàng, sản phẩm)
+    created_at = Column(DateTime, nullable=False, default=func.now())
+    
+    __table_args__ = (
+        # Lịch sử và số dư theo sản phẩm (các movement sau checkpoint cuối cùng)
+        Index('ix_stock_movements_product_id_id', 'product_id', 'id'),
+        # Các movement của một chứng từ
+        Index('ix_stock_movements_source', 'source_type', 'source_id'),
+    )
+    
+    def __repr__(self):
+        return f"<StockMovement(product={self.product_id}, delta={self.delta}, source='{self.source_type}:{self.source_id}')>"
+
+
+class StockCheckpoint(Base):
+    """Số dư tồn kho của sản phẩm tính tới movement_id (gồm cả movement đó)"""
+    __tablename__ = 'stock_checkpoints'
+    
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey('products.id', ondelete='CASCADE'), nullable=False)
+    movement_id = Column(Integer, nullable=False)
+    balance = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=func.now())
+    
+    __table_args__ = (
+        Index('uq_stock_checkpoints_product_movement', 'product_id', 'movement_id', unique=True),
+        # Checkpoint gần nhất trước một ngày (tồn kho tại ngày khóa sổ)
+        Index('ix_stock_checkpoints_product_created_at', 'product_id', 'created_at'),
+    )
+    
+    def __repr__(self):
+        return f"<StockCheckpoint(product={self.product_id}, movement={self.movement_id}, balance={self.balance})>"
+
+
+class StockShard(Base):
+    """Một phần tồn kho của sản phẩm bán chạy (products.so_shard > 0); tồn kho = tổng các phần"""
+    __tablename__ = 'stock_shards'
+    
+    product_id = Column(Integer, ForeignKey('products.id', ondelete='CASCADE'), primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    so_luong = Column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<StockShard(product={self.product_id}, shard={self.shard}, so_luong={self.so_luong})>"
+
+
+class DocumentSeries(Base):
+    """Dãy số chứng từ (hóa đơn, đơn hàng): tiền tố, độ dài phần số và số đã cấp cuối cùng"""
+    __tablename__ = 'document_series'
+    
+    ma = Column(String(30), primary_key=True)  # invoice / order
+    tien_to = Column(String(20), nullable=False, default='')
+    do_dai = Column(Integer, nullable=False, default=4)  # số chữ số (thêm 0 phía trước)
+    so_hien_tai = Column(Integer, nullable=False, default=0)
+    # Số lượng số mỗi worker giữ trước; 1 = cấp trong transaction của chứng từ (không nhảy số)
+    khoi = Column(Integer, nullable=False, default=1)
+    
+    def __repr__(self):
+        return f"<DocumentSeries(ma='{self.ma}', tien_to='{self.tien_to}', so_hien_tai={self.so_hien_tai})>"
+
+
+class IdempotencyKey(Base):
+    """Idempotency-Key của các yêu cầu ghi; lưu phản hồi để trả lại khi client gửi lại yêu cầu"""
+    __tablename__ = 'idempotency_keys'
+    
+    key = Column(String(64), primary_key=True)  # sha256 của header Idempotency-Key
+    fingerprint = Column(String(64), nullable=False)  # sha256 của method + path + body
+    status_code = Column(Integer)  # NULL: yêu cầu đang được xử lý
+    content_type = Column(String(100))
+    response_body = Column(Text)
+    created_at = Column(DateTime, default=func.now())  # lúc giữ chỗ; cũng dùng để nhận biết lần giữ chỗ
+    expires_at = Column(DateTime, nullable=False, index=True)
+    lease_expires_at = Column(DateTime)  # hết hạn giữ chỗ khi status_code còn NULL
+    
+    def __repr__(self):
+        return f"<IdempotencyKey(key='{self.key[:12]}', status={self.status_code})>"
+
+
+class DailySalesSummary(Base):
+    """Daily sales rollup per product code, maintained in the same transaction as invoice/order writes"""
+    __tablename__ = 'daily_sales_summary'
+    
+    ngay = Column(Date, primary_key=True)
+    ma_sp = Column(String(100), primary_key=True, default='')  # '' = không gắn được sản phẩm
+    # Phía hóa đơn (theo ngày hóa đơn, gắn với đơn hàng đầu tiên của khách hàng)
+    doanh_thu = Column(Float, default=0.0)
+    doanh_thu_da_tt = Column(Float, default=0.0)
+    so_luong = Column(Integer, default=0)
+    so_hoa_don = Column(Integer, default=0)
+    # Phía đơn hàng (theo ngày tạo đơn, bỏ qua đơn đã hủy)
+    so_don_hang = Column(Integer, default=0)
+    so_luong_don_hang = Column(Integer, default=0)
+    doanh_thu_don_hang = Column(Float, default=0.0)
+    
     def __repr__(self):
-        return f"<Debt(customer='{self.customer_name}', remaining='{self.remaining_debt}')>"
\ No newline at end of file
+        return f"<DailySalesSummary(ngay='{self.ngay}', ma_sp='{self.ma_sp}')>"
@@ -0,0 +1,165 @@
+"""
+Keyset (cursor) pagination for list endpoints of PhanMemKeToan application
+
+Trang tiếp theo được lọc bằng điều kiện (sort, id) > (giá trị, id) của dòng cuối
+trang trước thay vì OFFSET, nên mỗi trang chỉ đọc `limit` dòng qua index
+(sort, id), không phụ thuộc kích thước bảng. Cursor là JSON (sort, order, giá trị,
+id) mã hóa base64url, client chỉ cần gửi lại next_cursor trong tham số `after`.
+
+Các cột sort phải NOT NULL và có index (hoặc là khóa chính).
+
+Khi client không truyền limit/after, endpoint trả về toàn bộ bảng theo dạng cũ
+nếu Config.LIST_LEGACY_RESPONSES bật (tham số legacy ghi đè cấu hình).
+
+count() trả về tổng số kết quả tìm kiếm mà không COUNT(*) toàn bộ khi kết quả lớn
+(đếm tới Config.SEARCH_EXACT_COUNT_LIMIT, lớn hơn thì dùng ước lượng của planner).
+"""
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import date, datetime
+from typing import Optional
+from fastapi import HTTPException, Query
+from sqlalchemy import or_, and_, func
+from .config import Config
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+
+
+class PageParams(namedtuple('PageParams', ['limit', 'after', 'sort', 'order', 'q', 'legacy'])):
+    __slots__ = ()
+
+    @property
+    def is_legacy(self) -> bool:
+        """Trả về dạng cũ (toàn bộ bảng, không phân trang)?"""
+        if self.legacy is not None:
+            return self.legacy
+        return Config.LIST_LEGACY_RESPONSES and self.limit is None and self.after is None
+
+
+def page_params(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_LIMIT, description=f"Số dòng mỗi trang (mặc định {DEFAULT_LIMIT})"),
+    after: Optional[str] = Query(None, description="next_cursor của trang trước"),
+    sort: Optional[str] = Query(None, description="Trường sắp xếp (mặc định id)"),
+    order: str = Query('asc', pattern='^(asc|desc)$', description="asc hoặc desc"),
+    q: Optional[str] = Query(None, description="Tìm kiếm gần đúng trên các trường văn bản"),
+    legacy: Optional[bool] = Query(None, description="true: trả về toàn bộ danh sách theo dạng cũ"),
+) -> PageParams:
+    """Dependency chung cho các endpoint danh sách"""
+    return PageParams(limit, after, sort, order, q, legacy)
+
+
+def search(query, q: Optional[str], columns):
+    """Lọc ILIKE '%q%' trên một trong các cột văn bản"""
+    if not q:
+        return query
+    pattern = f"%{q.strip()}%"
+    return query.filter(or_(*(column.ilike(pattern) for column in columns)))
+
+
+def between(query, column, start: Optional[date], end: Optional[date]):
+    if start is not None:
+        query = query.filter(column >= start)
+    if end is not None:
+        query = query.filter(column <= end)
+    return query
+
+
+def _encode_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _decode_value(column, value):
+    python_type = column.type.python_type
+    if value is not None and python_type in (date, datetime):
+        return python_type.fromisoformat(value)
+    return value
+
+
+def encode_cursor(sort: str, order: str, value, row_id: int) -> str:
+    raw = json.dumps([sort, order, _encode_value(value), row_id], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort, order, value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return sort, order, value, int(row_id)
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Cursor không hợp lệ")
+
+
+def paginate(query, params: PageParams, sort_fields: dict, id_column):
+    """
+    Áp dụng sắp xếp (sort, id), điều kiện keyset và limit.
+    sort_fields: {tên tham số sort: cột}; trả về (danh sách dòng, thông tin pagination).
+    """
+    sort = params.sort or 'id'
+    if sort not in sort_fields:
+        raise HTTPException(status_code=400, detail=f"Không hỗ trợ sắp xếp theo '{sort}'. Chọn một trong: {', '.join(sort_fields)}")
+    column = sort_fields[sort]
+    descending = params.order == 'desc'
+    limit = params.limit or DEFAULT_LIMIT
+
+    if params.after:
+        cursor_sort, cursor_order, value, last_id = decode_cursor(params.after)
+        if (cursor_sort, cursor_order) != (sort, params.order):
+            raise HTTPException(status_code=400, detail="Cursor không khớp với sort/order hiện tại")
+        value = _decode_value(column, value)
+        if column is id_column:
+            query = query.filter(id_column < last_id if descending else id_column > last_id)
+        elif descending:
+            query = query.filter(or_(column < value, and_(column == value, id_column < last_id)))
+        else:
+            query = query.filter(or_(column > value, and_(column == value, id_column > last_id)))
+
+    if column is id_column:
+        ordering = [id_column.desc() if descending else id_column.asc()]
+    elif descending:
+        ordering = [column.desc(), id_column.desc()]
+    else:
+        ordering = [column.asc(), id_column.asc()]
+
+    rows = query.order_by(*ordering).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(sort, params.order, getattr(last, column.key), getattr(last, id_column.key))
+    return rows, {'limit': limit, 'sort': sort, 'order': params.order, 'next_cursor': next_cursor}
+
+
+def page_response(data, pagination):
+    return {'success': True, 'data': data, 'pagination': pagination}
+
+
+def _planner_estimate(query) -> int:
+    """Số dòng PostgreSQL ước lượng cho câu truy vấn (EXPLAIN, không chạy truy vấn)"""
+    connection = query.session.connection()
+    compiled = query.order_by(None).statement.compile(dialect=connection.dialect)
+    plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled.string}", compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count(query, exact_limit: Optional[int] = None):
+    """
+    Tổng số dòng khớp cho giao diện phân trang: (tổng, là ước lượng?). Đếm chính xác
+    tối đa exact_limit dòng (đọc không quá exact_limit + 1 dòng); nhiều hơn thì trên
+    PostgreSQL dùng ước lượng của planner thay vì COUNT(*) toàn bộ kết quả.
+    """
+    exact_limit = Config.SEARCH_EXACT_COUNT_LIMIT if exact_limit is None else exact_limit
+    session = query.session
+    capped = query.order_by(None).limit(exact_limit + 1).subquery()
+    total = session.query(func.count()).select_from(capped).scalar()
+    if total <= exact_limit:
+        return total, False
+    if session.get_bind().dialect.name != 'postgresql':
+        return query.order_by(None).count(), False
+    return max(_planner_estimate(query), total), True
@@ -0,0 +1,266 @@
+"""
+Payment ledger and FIFO allocation for PhanMemKeToan application
+
+Mỗi khoản thanh toán là một dòng payments; phần được phân bổ vào từng hóa đơn là
+các dòng payment_allocations và được cộng vào invoices.da_thanh_toan. Việc phân
+bổ theo FIFO (ngay_hd, id) được tính trong SQL bằng tổng lũy kế (window sum):
+
+    phân bổ_i = min(còn nợ_i, max(số tiền - lũy kế còn nợ của các hóa đơn trước i, 0))
+
+Khoản âm (điều chỉnh giảm) hoàn lại theo thứ tự ngược (hóa đơn mới nhất trước).
+Khi hóa đơn bị sửa (tong_tien, trạng thái, khách hàng) hoặc xóa, phần phân bổ
+vượt quá được trả về khoản thanh toán (reconcile_invoice) rồi phân bổ lại FIFO
+(allocate_surplus), nên da_thanh_toan luôn bằng tổng phân bổ (trừ hóa đơn được
+đánh dấu đã thanh toán trực tiếp).
+Một khoản thanh toán chỉ tốn vài câu lệnh, không phụ thuộc số hóa đơn.
+"""
+from datetime import date
+from sqlalchemy import select, update, insert, func, case, literal, Integer
+from sqlalchemy.orm import Session
+from .models import Invoice, Payment, PaymentAllocation
+from .sales_rollup import PAID_STATUS, CustomerKey, customer_key
+from . import sales_rollup, debts, customers
+
+PARTIAL_STATUS = 'Thanh toán một phần'
+UNPAID_STATUS = 'Chưa thanh toán'
+
+
+def _paid_column():
+    return func.coalesce(Invoice.da_thanh_toan, 0)
+
+
+def _allocation_order(amount: float):
+    """(phần có thể phân bổ của mỗi hóa đơn, thứ tự phân bổ, dấu) theo chiều của khoản thanh toán"""
+    if amount >= 0:
+        # Phân bổ vào phần còn nợ, hóa đơn cũ trước
+        return Invoice.tong_tien - _paid_column(), (Invoice.ngay_hd, Invoice.id), 1
+    # Hoàn lại phần đã phân bổ, hóa đơn mới trước
+    return _paid_column(), (Invoice.ngay_hd.desc(), Invoice.id.desc()), -1
+
+
+def _invoices_of(key: CustomerKey):
+    return customers.matches(key, Invoice.account_id, Invoice.nguoi_mua)
+
+
+def lock_invoices(db: Session, key: CustomerKey, amount: float = None):
+    """
+    Khóa (FOR UPDATE, theo thứ tự phân bổ) các hóa đơn của khách hàng mà khoản
+    thanh toán amount có thể phân bổ vào (amount=None: mọi hóa đơn của khách hàng).
+    Hai khoản thanh toán đồng thời của cùng khách hàng chạy lần lượt: khoản sau
+    chờ tới khi khoản trước commit rồi mới đọc số đã thanh toán, nên không phân
+    bổ hai lần vào cùng phần còn nợ.
+    """
+    if key is None:
+        return
+    balance, ordering, _ = _allocation_order(amount or 0)
+    query = select(Invoice.id).where(_invoices_of(key)).order_by(*ordering).with_for_update()
+    if amount is not None:
+        query = query.where(balance > 0)
+    db.execute(query).all()
+
+
+def unallocated_total(db: Session, key: CustomerKey) -> float:
+    """Phần vượt quá công nợ (chưa phân bổ vào hóa đơn nào) của các khoản thanh toán của khách hàng"""
+    allocated = (
+        select(func.coalesce(func.sum(PaymentAllocation.so_tien), 0))
+        .where(PaymentAllocation.payment_id == Payment.id)
+        .scalar_subquery()
+    )
+    return float(
+        db.query(func.coalesce(func.sum(Payment.so_tien - allocated), 0))
+        .filter(customers.matches(key, Payment.account_id, Payment.customer_name))
+        .scalar()
+    )
+
+
+def allocation_source(key: CustomerKey, amount: float):
+    """SELECT (invoice_id, số tiền phân bổ) cho khoản thanh toán amount của khách hàng"""
+    balance, ordering, sign = _allocation_order(amount)
+    running = func.sum(balance).over(order_by=ordering, rows=(None, 0))
+    candidates = (
+        select(Invoice.id.label('invoice_id'), balance.label('balance'), running.label('running'))
+        .where(_invoices_of(key), balance > 0)
+        .subquery()
+    )
+    remaining = abs(amount) - (candidates.c.running - candidates.c.balance)
+    return (
+        select(
+            candidates.c.invoice_id,
+            (sign * func.least(candidates.c.balance, remaining)).label('so_tien')
+        )
+        .where(remaining > 0)
+    )
+
+
+def allocations_after(as_of: date):
+    """(invoice_id, so_tien) phần được phân bổ từ các khoản thanh toán sau ngày as_of, theo hóa đơn"""
+    return (
+        select(PaymentAllocation.invoice_id, func.sum(PaymentAllocation.so_tien).label('so_tien'))
+        .join(Payment, Payment.id == PaymentAllocation.payment_id)
+        .where(Payment.ngay_tt > as_of)
+        .group_by(PaymentAllocation.invoice_id)
+        .subquery()
+    )
+
+
+def paid_as_of(later):
+    """
+    Số đã thanh toán của hóa đơn tại ngày as_of (later = allocations_after(as_of), cần
+    outer join theo invoice_id): da_thanh_toan trừ phần phân bổ sau ngày đó. Phần
+    da_thanh_toan ghi trực tiếp trên hóa đơn (không qua payments) không có ngày nên
+    được tính là đã trả.
+    """
+    return _paid_column() - func.coalesce(later.c.so_tien, 0)
+
+
+def status_for(paid, total):
+    """Trạng thái hóa đơn theo số đã thanh toán (biểu thức SQL)"""
+    return case(
+        (paid >= total, PAID_STATUS),
+        (paid > 0, PARTIAL_STATUS),
+        else_=UNPAID_STATUS
+    )
+
+
+def _allocate(db: Session, payment_id: int, key: CustomerKey, amount: float, payment_made: bool = False) -> float:
+    """
+    Phân bổ FIFO amount của khoản thanh toán payment_id vào hóa đơn của khách hàng
+    (hóa đơn đã khóa); cập nhật hóa đơn, bảng tổng hợp doanh thu và công nợ. Trả về
+    số đã phân bổ.
+    """
+    # Chỉ các dòng phân bổ vừa ghi (khoản thanh toán có thể đã có dòng phân bổ cũ)
+    start = db.query(func.coalesce(func.max(PaymentAllocation.id), 0)).scalar()
+    new_rows = (PaymentAllocation.payment_id == payment_id, PaymentAllocation.id > start)
+
+    # 1. Ghi các dòng phân bổ (một câu INSERT ... SELECT với window sum)
+    source = allocation_source(key, amount).subquery()
+    db.execute(
+        insert(PaymentAllocation).from_select(
+            ['payment_id', 'invoice_id', 'so_tien'],
+            select(literal(payment_id, Integer), source.c.invoice_id, source.c.so_tien)
+        )
+    )
+
+    # 2. Bảng tổng hợp doanh thu: trừ đóng góp cũ của các hóa đơn bị ảnh hưởng
+    touched = select(PaymentAllocation.invoice_id).where(*new_rows)
+    sales_rollup.apply_invoices(db, Invoice.id.in_(touched), -1)
+
+    # 3. Cập nhật số đã thanh toán và trạng thái của các hóa đơn (một câu UPDATE ... FROM)
+    new_paid = _paid_column() + PaymentAllocation.so_tien
+    db.execute(
+        update(Invoice)
+        .where(Invoice.id == PaymentAllocation.invoice_id, *new_rows)
+        .values(da_thanh_toan=new_paid, trang_thai=status_for(new_paid, Invoice.tong_tien))
+        .execution_options(synchronize_session=False)
+    )
+    sales_rollup.apply_invoices(db, Invoice.id.in_(touched))
+
+    allocated = float(db.query(func.coalesce(func.sum(PaymentAllocation.so_tien), 0)).filter(*new_rows).scalar())
+    debts.apply_delta(db, key.account_id, key.name, paid_delta=allocated, payment_made=payment_made)
+    return allocated
+
+
+def record_payment(db: Session, customer_name: str, amount: float, ngay_tt: date = None, ghi_chu: str = None,
+                   account_id: int = None):
+    """
+    Ghi nhận khoản thanh toán và phân bổ FIFO vào hóa đơn của khách hàng (không commit).
+    Khách hàng có tài khoản (account_id): phân bổ vào các hóa đơn của tài khoản; ngược
+    lại vào các hóa đơn chưa gắn tài khoản có nguoi_mua = customer_name.
+    Phần vượt quá tổng còn nợ được giữ lại trên payments (không phân bổ).
+    """
+    key = customer_key(account_id, customer_name)
+    lock_invoices(db, key, amount)
+    payment = Payment(customer_name=customer_name, account_id=account_id, so_tien=amount,
+                      ngay_tt=ngay_tt or date.today(), ghi_chu=ghi_chu)
+    db.add(payment)
+    db.flush()
+    _allocate(db, payment.id, key, amount, payment_made=True)
+    return payment
+
+
+def allocate_surplus(db: Session, key: CustomerKey) -> float:
+    """
+    Phân bổ lại FIFO phần chưa phân bổ của các khoản thanh toán của khách hàng (khoản
+    cũ trước), ví dụ sau khi hóa đơn bị giảm tiền/xóa làm phần đã phân bổ được trả
+    về khoản thanh toán. Không commit; trả về số đã phân bổ.
+    """
+    if key is None:
+        return 0.0
+    lock_invoices(db, key, 1)
+    allocated = (
+        select(func.coalesce(func.sum(PaymentAllocation.so_tien), 0))
+        .where(PaymentAllocation.payment_id == Payment.id)
+        .scalar_subquery()
+    )
+    surplus = (
+        db.query(Payment.id, Payment.so_tien - allocated)
+        .filter(customers.matches(key, Payment.account_id, Payment.customer_name), Payment.so_tien - allocated > 0)
+        .order_by(Payment.ngay_tt, Payment.id)
+        .all()
+    )
+    total = 0.0
+    for payment_id, remaining in surplus:
+        placed = _allocate(db, payment_id, key, float(remaining))
+        total += placed
+        if placed < float(remaining):
+            break  # Không còn hóa đơn nợ
+    return total
+
+
+def release_allocations(db: Session, invoice: Invoice, keep: float) -> float:
+    """
+    Giảm các dòng phân bổ vào hóa đơn (khoản thanh toán mới nhất trước) cho tới khi tổng
+    không quá keep; phần nhả ra trở thành phần chưa phân bổ của khoản thanh toán. Trả về
+    tổng còn phân bổ vào hóa đơn.
+    """
+    rows = (
+        db.query(PaymentAllocation)
+        .join(Payment, Payment.id == PaymentAllocation.payment_id)
+        .filter(PaymentAllocation.invoice_id == invoice.id)
+        .order_by(Payment.ngay_tt.desc(), Payment.id.desc(), PaymentAllocation.id.desc())
+        .all()
+    )
+    excess = sum(float(row.so_tien or 0) for row in rows) - max(float(keep), 0)
+    # Chỉ giảm các dòng dương (dòng âm là phần hoàn lại của khoản điều chỉnh giảm)
+    for row in rows:
+        if excess <= 0:
+            break
+        if float(row.so_tien or 0) <= 0:
+            continue
+        amount = float(row.so_tien or 0)
+        if amount <= excess:
+            db.delete(row)
+        else:
+            row.so_tien = amount - excess
+        excess -= amount
+    db.flush()
+    return float(
+        db.query(func.coalesce(func.sum(PaymentAllocation.so_tien), 0))
+        .filter(PaymentAllocation.invoice_id == invoice.id)
+        .scalar()
+    )
+
+
+def reconcile_invoice(db: Session, invoice: Invoice, customer_changed: bool = False):
+    """
+    Đặt lại số đã thanh toán của hóa đơn sau khi sửa tong_tien/trang_thai/khách hàng
+    (không commit). Phân bổ vượt quá tong_tien (hoặc mọi phân bổ khi đổi khách hàng,
+    vì các khoản thanh toán thuộc khách hàng cũ) được trả về khoản thanh toán; sau đó
+    gọi allocate_surplus cho khách hàng để phân bổ lại phần đó.
+    Hóa đơn được đánh dấu đã thanh toán: phần ngoài payments là trả trực tiếp. Ngược
+    lại số đã thanh toán là tổng phân bổ và trạng thái được tính theo số đó.
+    """
+    total = float(invoice.tong_tien or 0)
+    allocated = release_allocations(db, invoice, 0 if customer_changed else total)
+    if invoice.trang_thai == PAID_STATUS:
+        invoice.da_thanh_toan = total
+        return
+    invoice.da_thanh_toan = allocated
+    invoice.trang_thai = PAID_STATUS if total > 0 and allocated >= total else (
+        PARTIAL_STATUS if allocated > 0 else UNPAID_STATUS
+    )
+
+
+def sync_invoice_paid(invoice: Invoice):
+    """Số đã thanh toán của hóa đơn mới tạo (chưa có phân bổ): đủ nếu được đánh dấu đã thanh toán"""
+    invoice.da_thanh_toan = float(invoice.tong_tien or 0) if invoice.trang_thai == PAID_STATUS else 0.0
@@ -0,0 +1,72 @@
+"""
+In-process report result cache for PhanMemKeToan application
+
+Kết quả báo cáo được lưu theo (endpoint, tham số đã chuẩn hóa), giới hạn số
+phần tử và loại bỏ theo LRU. Các thao tác ghi đánh dấu khoảng ngày / mã sản
+phẩm bị ảnh hưởng vào session (mark_dirty); sau khi commit chỉ những kết quả
+giao với phần bị ảnh hưởng mới bị xóa khỏi cache.
+"""
+from bisect import bisect_left
+from datetime import date
+from .config import Config
+from .lru_cache import LRUCache, invalidate_after_commit
+
+_DIRTY_KEY = 'report_cache_dirty'
+
+
+class ReportCache(LRUCache):
+    """LRU cache có thể xóa có chọn lọc theo khoảng ngày, mã sản phẩm hoặc endpoint"""
+
+    @staticmethod
+    def make_key(endpoint: str, **params):
+        return (endpoint, tuple(sorted((name, str(value)) for name, value in params.items())))
+
+    def get(self, key):
+        entry = self._get_many([key])[0].get(key)
+        return entry['value'] if entry is not None else None
+
+    def put(self, key, value, start_date: date, end_date: date, codes=(), generation: int | None = None):
+        """Lưu kết quả kèm khoảng ngày và mã sản phẩm mà nó phụ thuộc (dùng khi xóa có chọn lọc)"""
+        self._put_many({key: {
+            'value': value,
+            'endpoint': key[0],
+            'start': start_date,
+            'end': end_date,
+            'codes': frozenset(codes),
+        }}, generation)
+
+    def invalidate(self, dates=(), codes=(), endpoints=()):
+        """Xóa các kết quả có khoảng ngày chứa một trong `dates`, tham chiếu `codes` hoặc thuộc `endpoints`"""
+        dates = sorted(set(dates))
+        codes = set(codes)
+        endpoints = set(endpoints)
+        if not dates and not codes and not endpoints:
+            return 0
+
+        def stale_keys(entries):
+            for key, entry in entries.items():
+                if entry['endpoint'] in endpoints or (codes and entry['codes'] & codes):
+                    yield key
+                elif dates:
+                    # Có ngày nào nằm trong [start, end] không
+                    i = bisect_left(dates, entry['start'])
+                    if i < len(dates) and dates[i] <= entry['end']:
+                        yield key
+
+        return self._invalidate(stale_keys)
+
+
+report_cache = ReportCache(Config.REPORT_CACHE_SIZE)
+
+
+def mark_dirty(db, dates=(), codes=(), endpoints=()):
+    """Ghi nhận phần dữ liệu báo cáo bị thay đổi; cache chỉ bị xóa khi transaction commit"""
+    dirty = db.info.setdefault(_DIRTY_KEY, {'dates': set(), 'codes': set(), 'endpoints': set()})
+    dirty['dates'].update(d for d in dates if d is not None)
+    dirty['codes'].update(c for c in codes if c)
+    dirty['endpoints'].update(endpoints)
+
+
+invalidate_after_commit(
+    _DIRTY_KEY, lambda dirty: report_cache.invalidate(dirty['dates'], dirty['codes'], dirty['endpoints'])
+)
@@ -0,0 +1,133 @@
+"""
+Background report generation jobs for PhanMemKeToan application
+
+Yêu cầu tạo báo cáo được lưu thành một dòng Report (trang_thai='pending') và
+được tính trên một pool worker riêng, ngoài luồng xử lý request. Kết quả được
+ghi vào Report.du_lieu; client hỏi trạng thái qua GET /api/reports/jobs/{id}.
+
+Worker giữ job bằng một câu UPDATE ... WHERE trang_thai='pending' RETURNING, đặt
+trang_thai='running' với thời hạn giữ chỗ (REPORT_JOB_LEASE_SECONDS): nhiều worker
+cùng resume_pending khi khởi động chỉ một worker chạy mỗi job. Job 'running' chỉ
+được giữ lại khi hết hạn giữ chỗ (worker cũ đã chết), và kết quả chỉ được ghi nếu
+worker vẫn còn giữ đúng lần giữ chỗ của mình (lease_expires_at).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import logging
+from sqlalchemy import update, and_, or_
+from .config import Config
+from .database import SessionLocal
+from .models import Report
+
+logger = logging.getLogger(__name__)
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+
+_executor = ThreadPoolExecutor(max_workers=Config.REPORT_JOB_WORKERS, thread_name_prefix='report-job')
+
+
+def submit(report_id: int, builder):
+    """
+    Đưa job vào hàng đợi. builder(db, report, params) trả về (payload, summary) với
+    summary là dict các cột tổng hợp của Report (tong_doanh_thu, ...).
+    """
+    return _executor.submit(_run, report_id, builder)
+
+
+def _claimable(now: datetime):
+    """Job chờ chạy, hoặc đang chạy nhưng đã hết hạn giữ chỗ"""
+    return or_(
+        Report.trang_thai == JOB_PENDING,
+        and_(
+            Report.trang_thai == JOB_RUNNING,
+            or_(Report.lease_expires_at.is_(None), Report.lease_expires_at < now),
+        ),
+    )
+
+
+def resume_pending(builder):
+    """
+    Đưa lại vào hàng đợi các job chờ chạy và các job 'running' đã hết hạn giữ chỗ
+    (ví dụ sau khi khởi động lại server); job vẫn đang chạy ở worker khác được bỏ qua
+    """
+    db = SessionLocal()
+    try:
+        job_ids = [row.id for row in db.query(Report.id).filter(_claimable(datetime.now())).all()]
+    finally:
+        db.close()
+    for job_id in job_ids:
+        submit(job_id, builder)
+    return len(job_ids)
+
+
+def _claim(db, report_id: int):
+    """Giữ job (commit ngay); trả về lease_expires_at của lần giữ chỗ, None nếu job không còn để chạy"""
+    now = datetime.now()
+    lease = now + timedelta(seconds=Config.REPORT_JOB_LEASE_SECONDS)
+    claimed = db.execute(
+        update(Report)
+        .where(Report.id == report_id, _claimable(now))
+        .values(trang_thai=JOB_RUNNING, lease_expires_at=lease)
+        .returning(Report.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    db.commit()
+    return lease if claimed is not None else None
+
+
+def _finish(db, report_id: int, lease: datetime, values: dict) -> bool:
+    """Ghi kết quả nếu worker vẫn giữ đúng lần giữ chỗ lease"""
+    finished = db.execute(
+        update(Report)
+        .where(Report.id == report_id, Report.trang_thai == JOB_RUNNING, Report.lease_expires_at == lease)
+        .values(lease_expires_at=None, **values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    if not finished:
+        logger.warning(f"Report job {report_id} was taken over by another worker; result discarded")
+    return bool(finished)
+
+
+def _params(report) -> dict:
+    return json.loads(report.du_lieu or '{}').get('params', {})
+
+
+def _run(report_id: int, builder):
+    db = SessionLocal()
+    lease = None
+    try:
+        lease = _claim(db, report_id)
+        if lease is None:
+            return
+        report = db.get(Report, report_id)
+        params = _params(report)
+
+        payload, summary = builder(db, report, params)
+
+        _finish(db, report_id, lease, {
+            'du_lieu': json.dumps({'params': params, 'result': payload}, ensure_ascii=False, default=str),
+            'trang_thai': JOB_COMPLETED,
+            **summary,
+        })
+    except Exception as e:
+        logger.error(f"Report job {report_id} failed: {e}")
+        db.rollback()
+        if lease is None:
+            return
+        try:
+            report = db.get(Report, report_id)
+            if report is not None:
+                _finish(db, report_id, lease, {
+                    'du_lieu': json.dumps({'params': _params(report), 'error': str(e)}, ensure_ascii=False),
+                    'trang_thai': JOB_FAILED,
+                })
+        except Exception as inner:
+            logger.error(f"Could not mark report job {report_id} as failed: {inner}")
+            db.rollback()
+    finally:
+        db.close()
@@ -0,0 +1,219 @@
+"""
+Daily sales rollup (daily_sales_summary) maintenance for PhanMemKeToan application
+
+Mỗi thao tác ghi hóa đơn/đơn hàng trừ phần đóng góp cũ (sign=-1) trước khi
+thay đổi và cộng phần đóng góp mới (sign=+1) sau khi flush, trong cùng một
+transaction. Các báo cáo doanh thu chỉ cần đọc bảng tổng hợp theo ngày.
+"""
+from collections import namedtuple
+from sqlalchemy import select, func, case, delete, true, union_all, and_, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .models import DailySalesSummary, Invoice, Order, OrderItem, Product
+from .report_cache import mark_dirty
+
+CANCELLED_STATUSES = ('đã hủy', 'da huy', 'hủy', 'huy', 'canceled', 'cancelled')
+PAID_STATUS = 'Đã thanh toán'
+
+INVOICE_COLUMNS = ['doanh_thu', 'doanh_thu_da_tt', 'so_luong', 'so_hoa_don']
+ORDER_COLUMNS = ['so_don_hang', 'so_luong_don_hang', 'doanh_thu_don_hang']
+
+# Các báo cáo đọc từ bảng tổng hợp (khóa endpoint trong cache báo cáo)
+REPORT_ENDPOINTS = ('revenue-by-date', 'revenue-by-product')
+
+
+def is_cancelled_expr(status_column):
+    """Biểu thức SQL tương đương orders.is_cancelled()"""
+    return func.lower(func.trim(func.coalesce(status_column, ''))).in_(CANCELLED_STATUSES)
+
+
+# Khách hàng: theo tài khoản (account_id) nếu đã gắn được, ngược lại theo tên văn bản
+CustomerKey = namedtuple('CustomerKey', ['account_id', 'name'])
+
+
+def customer_key(account_id: int | None, name: str | None):
+    if account_id is not None:
+        return CustomerKey(account_id, None)
+    if name:
+        return CustomerKey(None, name)
+    return None
+
+
+def _orders_of(key: CustomerKey):
+    if key.account_id is not None:
+        return Order.account_id == key.account_id
+    return and_(Order.account_id.is_(None), Order.thong_tin_kh == key.name)
+
+
+def _invoices_of(keys):
+    account_ids = [k.account_id for k in keys if k.account_id is not None]
+    names = [k.name for k in keys if k.account_id is None]
+    conditions = []
+    if account_ids:
+        conditions.append(Invoice.account_id.in_(account_ids))
+    if names:
+        conditions.append(and_(Invoice.account_id.is_(None), Invoice.nguoi_mua.in_(names)))
+    return or_(*conditions)
+
+
+def first_order_subqueries(invoice_filter):
+    """
+    Đơn hàng đầu tiên (id nhỏ nhất) của mỗi khách hàng có hóa đơn thỏa invoice_filter:
+    theo account_id (index ix_orders_account_id_id) và, với hóa đơn chưa gắn tài khoản,
+    theo tên trong các đơn hàng cũng chưa gắn tài khoản
+    """
+    accounts = select(Invoice.account_id).where(invoice_filter, Invoice.account_id.isnot(None)).distinct()
+    names = select(Invoice.nguoi_mua).where(invoice_filter, Invoice.account_id.is_(None)).distinct()
+    by_account = (
+        select(Order.account_id, func.min(Order.id).label('order_id'))
+        .where(Order.account_id.in_(accounts))
+        .group_by(Order.account_id)
+        .subquery()
+    )
+    by_name = (
+        select(Order.thong_tin_kh, func.min(Order.id).label('order_id'))
+        .where(Order.account_id.is_(None), Order.thong_tin_kh.in_(names))
+        .group_by(Order.thong_tin_kh)
+        .subquery()
+    )
+    return by_account, by_name
+
+
+def _upsert_from_select(db: Session, columns, source):
+    """INSERT ... SELECT vào bảng tổng hợp, cộng dồn nếu (ngay, ma_sp) đã tồn tại"""
+    stmt = insert(DailySalesSummary).from_select(['ngay', 'ma_sp', *columns], source)
+    table = DailySalesSummary.__table__
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['ngay', 'ma_sp'],
+        set_={col: func.coalesce(table.c[col], 0) + stmt.excluded[col] for col in columns},
+    ).returning(table.c.ngay)
+    # Các ngày bị thay đổi sẽ bị xóa khỏi cache báo cáo khi commit
+    mark_dirty(db, dates=[row[0] for row in db.execute(stmt)])
+
+
+def apply_invoices(db: Session, invoice_filter, sign: int = 1):
+    """Cộng (sign=1) hoặc trừ (sign=-1) phần đóng góp của các hóa đơn thỏa invoice_filter"""
+    by_account, by_name = first_order_subqueries(invoice_filter)
+    ma_sp = func.coalesce(Order.sp_banggia, '')
+    paid_amount = case((Invoice.trang_thai == PAID_STATUS, Invoice.tong_tien), else_=0)
+    source = (
+        select(
+            Invoice.ngay_hd,
+            ma_sp,
+            sign * func.coalesce(func.sum(Invoice.tong_tien), 0),
+            sign * func.coalesce(func.sum(paid_amount), 0),
+            sign * func.coalesce(func.sum(Order.so_luong), 0),
+            sign * func.count(Invoice.id),
+        )
+        .select_from(Invoice)
+        .outerjoin(by_account, by_account.c.account_id == Invoice.account_id)
+        .outerjoin(by_name, and_(Invoice.account_id.is_(None), by_name.c.thong_tin_kh == Invoice.nguoi_mua))
+        .outerjoin(Order, Order.id == func.coalesce(by_account.c.order_id, by_name.c.order_id))
+        .where(invoice_filter)
+        .group_by(Invoice.ngay_hd, ma_sp)
+    )
+    _upsert_from_select(db, INVOICE_COLUMNS, source)
+
+
+def apply_orders(db: Session, order_filter, sign: int = 1):
+    """
+    Cộng (sign=1) hoặc trừ (sign=-1) phần đóng góp của các đơn hàng (không hủy) thỏa order_filter.
+    Đơn hàng nhiều dòng (có order_items) được tính theo từng sản phẩm của các dòng.
+    """
+    not_cancelled = ~is_cancelled_expr(Order.trang_thai)
+    has_items = select(OrderItem.id).where(OrderItem.order_id == Order.id).exists()
+    single = (
+        select(
+            Order.ngay_tao.label('ngay'),
+            func.coalesce(Order.sp_banggia, '').label('ma_sp'),
+            func.count(Order.id).label('so_don_hang'),
+            func.coalesce(func.sum(Order.so_luong), 0).label('so_luong'),
+            func.coalesce(func.sum(Order.tong_tien), 0).label('doanh_thu'),
+        )
+        .where(order_filter, not_cancelled, ~has_items)
+        .group_by(Order.ngay_tao, func.coalesce(Order.sp_banggia, ''))
+    )
+    lines = (
+        select(
+            Order.ngay_tao,
+            Product.ma_sp,
+            func.count(func.distinct(Order.id)),
+            func.coalesce(func.sum(OrderItem.so_luong), 0),
+            func.coalesce(func.sum(OrderItem.total_price), 0),
+        )
+        .select_from(OrderItem)
+        .join(Order, Order.id == OrderItem.order_id)
+        .join(Product, Product.id == OrderItem.product_id)
+        .where(order_filter, not_cancelled)
+        .group_by(Order.ngay_tao, Product.ma_sp)
+    )
+    # Gộp hai nguồn theo (ngày, mã SP): ON CONFLICT không cho phép cập nhật một dòng hai lần
+    combined = union_all(single, lines).subquery()
+    source = (
+        select(
+            combined.c.ngay,
+            combined.c.ma_sp,
+            sign * func.sum(combined.c.so_don_hang),
+            sign * func.sum(combined.c.so_luong),
+            sign * func.sum(combined.c.doanh_thu),
+        )
+        .group_by(combined.c.ngay, combined.c.ma_sp)
+    )
+    _upsert_from_select(db, ORDER_COLUMNS, source)
+
+
+def first_order_id(db: Session, customer: CustomerKey | None):
+    """Id đơn hàng đầu tiên của khách hàng (None nếu chưa có)"""
+    if customer is None:
+        return None
+    return db.query(func.min(Order.id)).filter(_orders_of(customer)).scalar()
+
+
+def attribution_customers(db: Session, order_id: int | None, old_customer: CustomerKey | None, new_customer: CustomerKey | None):
+    """
+    Các khách hàng (CustomerKey) có hóa đơn cần gắn lại sản phẩm khi đơn hàng order_id thay đổi
+    (order_id=None: đơn hàng sắp tạo, luôn có id lớn nhất). Chỉ đơn hàng đầu tiên
+    của khách hàng mới ảnh hưởng tới phần hóa đơn của bảng tổng hợp.
+    """
+    customers = set()
+    if old_customer:
+        first_id = first_order_id(db, old_customer)
+        if first_id is not None and first_id == order_id:
+            customers.add(old_customer)
+    if new_customer and new_customer != old_customer:
+        first_id = first_order_id(db, new_customer)
+        if first_id is None or (order_id is not None and order_id < first_id):
+            customers.add(new_customer)
+    return customers
+
+
+def customers_without_orders(db: Session, customers):
+    """Các khách hàng chưa có đơn hàng nào (đơn hàng sắp tạo sẽ là đơn đầu tiên của họ)"""
+    customers = {c for c in customers if c}
+    if not customers:
+        return set()
+    account_ids = {c.account_id for c in customers if c.account_id is not None}
+    names = {c.name for c in customers if c.account_id is None}
+    existing = set()
+    if account_ids:
+        rows = db.query(Order.account_id).filter(Order.account_id.in_(account_ids)).distinct()
+        existing |= {CustomerKey(row[0], None) for row in rows}
+    if names:
+        rows = db.query(Order.thong_tin_kh).filter(Order.account_id.is_(None), Order.thong_tin_kh.in_(names)).distinct()
+        existing |= {CustomerKey(None, row[0]) for row in rows}
+    return customers - existing
+
+
+def apply_customers(db: Session, customers, sign: int = 1):
+    """Cộng/trừ phần đóng góp của toàn bộ hóa đơn thuộc các khách hàng (CustomerKey) đã cho"""
+    customers = [c for c in customers if c]
+    if customers:
+        apply_invoices(db, _invoices_of(customers), sign)
+
+
+def rebuild(db: Session):
+    """Tính lại toàn bộ bảng tổng hợp từ invoices/orders (dùng để khởi tạo hoặc sửa lỗi)"""
+    db.execute(delete(DailySalesSummary))
+    mark_dirty(db, endpoints=REPORT_ENDPOINTS)
+    apply_invoices(db, true())
+    apply_orders(db, true())
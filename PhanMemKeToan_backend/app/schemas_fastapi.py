@@ -212,14 +212,18 @@ class OrderOut(BaseModel):
     tong_tien: Optional[float]
     hinh_thuc_tt: Optional[str]
     trang_thai: Optional[str]
+    account_id: Optional[int] = None
 
     class Config:
         from_attributes = True
 
 
 class OrderCreate(BaseModel):
-    ma_don_hang: str
+    # Không truyền: cấp tự động từ dãy số đơn hàng (document_series)
+    ma_don_hang: Optional[str] = None
     thong_tin_kh: str
+    # Không truyền: suy ra từ thong_tin_kh
+    account_id: Optional[int] = None
     sp_banggia: Optional[str] = None
     ngay_tao: Optional[date] = None
     ma_co_quan_thue: Optional[str] = None
@@ -229,9 +233,16 @@ class OrderCreate(BaseModel):
     trang_thai: Optional[str] = None
 
 
+class OrderBulkCreate(BaseModel):
+    orders: list[OrderCreate]
+    # True: bỏ qua các dòng lỗi và vẫn lưu các dòng hợp lệ; False: có lỗi thì không lưu dòng nào
+    allow_partial: bool = False
+
+
 class OrderUpdate(BaseModel):
     ma_don_hang: Optional[str] = None
     thong_tin_kh: Optional[str] = None
+    account_id: Optional[int] = None
     sp_banggia: Optional[str] = None
     ngay_tao: Optional[date] = None
     ma_co_quan_thue: Optional[str] = None
@@ -249,6 +260,42 @@ class OrderItemCreate(BaseModel):
     total_price: Optional[float] = 0
 
 
+class OrderLineIn(BaseModel):
+    ma_sp: str
+    so_luong: int = 1
+    # Chỉ dùng khi sản phẩm chưa có giá chung
+    don_gia: Optional[float] = None
+
+
+class OrderWithItemsCreate(BaseModel):
+    ma_don_hang: Optional[str] = None
+    thong_tin_kh: str
+    account_id: Optional[int] = None
+    ngay_tao: Optional[date] = None
+    ma_co_quan_thue: Optional[str] = None
+    hinh_thuc_tt: Optional[str] = None
+    trang_thai: Optional[str] = None
+    items: list[OrderLineIn]
+
+
+class OrderItemsUpdate(BaseModel):
+    items: list[OrderLineIn]
+
+
+class OrderItemOut(BaseModel):
+    id: int
+    order_id: int
+    product_id: int
+    ma_sp: Optional[str] = None
+    ten_sp: Optional[str] = None
+    so_luong: int
+    don_gia: float
+    total_price: float
+
+    class Config:
+        from_attributes = True
+
+
 # Invoices
 class InvoiceOut(BaseModel):
     id: int
@@ -258,15 +305,20 @@ class InvoiceOut(BaseModel):
     tong_tien: Optional[float]
     loai_hd: Optional[str]
     trang_thai: Optional[str]
+    da_thanh_toan: Optional[float] = 0
+    account_id: Optional[int] = None
 
     class Config:
         from_attributes = True
 
 
 class InvoiceCreate(BaseModel):
-    so_hd: str
+    # Không truyền: cấp tự động từ dãy số hóa đơn (document_series)
+    so_hd: Optional[str] = None
     ngay_hd: date
     nguoi_mua: str
+    # Không truyền: suy ra từ nguoi_mua
+    account_id: Optional[int] = None
     tong_tien: float
     loai_hd: str
     trang_thai: Optional[str] = 'Đã thanh toán'
@@ -276,11 +328,25 @@ class InvoiceUpdate(BaseModel):
     so_hd: Optional[str] = None
     ngay_hd: Optional[date] = None
     nguoi_mua: Optional[str] = None
+    account_id: Optional[int] = None
     tong_tien: Optional[float] = None
     loai_hd: Optional[str] = None
     trang_thai: Optional[str] = None
 
 
+class InvoiceSearch(BaseModel):
+    # Tiêu chí lọc (cùng tên trường với tham số xuất file /exports/invoices)
+    fromDate: Optional[date] = None
+    toDate: Optional[date] = None
+    invoiceNumber: Optional[str] = None  # tìm gần đúng trong so_hd
+    customerInfo: Optional[str] = None  # tìm gần đúng trong nguoi_mua
+    # Phân trang keyset (như các endpoint danh sách); không truyền limit/after: trả về tất cả (dạng cũ)
+    limit: Optional[int] = None
+    after: Optional[str] = None
+    sort: Optional[str] = None  # id / ngay_hd / so_hd
+    order: str = 'desc'
+
+
 # Reports
 class ReportOut(BaseModel):
     id: int
@@ -323,10 +389,19 @@ class ReportUpdate(BaseModel):
     trang_thai: Optional[str] = None
 
 
+class ReportJobCreate(BaseModel):
+    loai_bao_cao: str  # 'revenue' hoặc 'debt'
+    tu_ngay: date
+    den_ngay: date
+    granularity: Optional[str] = 'day'
+    ten_bao_cao: Optional[str] = None
+
+
 # Debts
 class DebtOut(BaseModel):
     id: int
     customer_name: str
+    account_id: Optional[int] = None
     total_debt: Decimal
     paid_amount: Decimal
     remaining_debt: Decimal
@@ -355,6 +430,70 @@ class DebtUpdate(BaseModel):
     last_payment_date: Optional[datetime] = None
 
 
+# Payments
+class PaymentCreate(BaseModel):
+    customer_name: str
+    account_id: Optional[int] = None  # Không gửi: suy ra từ customer_name
+    so_tien: float
+    ngay_tt: Optional[date] = None
+    ghi_chu: Optional[str] = None
+
+
+class PaymentAllocationOut(BaseModel):
+    id: int
+    invoice_id: int
+    so_tien: float
+
+    class Config:
+        from_attributes = True
+
+
+class PaymentOut(BaseModel):
+    id: int
+    customer_name: str
+    account_id: Optional[int] = None
+    so_tien: float
+    ngay_tt: Optional[date] = None
+    ghi_chu: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+# Stock ledger
+class StockMovementOut(BaseModel):
+    id: int
+    product_id: int
+    ma_sp: Optional[str] = None
+    warehouse_id: Optional[int] = None
+    delta: int
+    source_type: str
+    source_id: Optional[int] = None
+    created_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+
+# Document number series
+class DocumentSeriesOut(BaseModel):
+    ma: str
+    tien_to: str
+    do_dai: int
+    so_hien_tai: int
+    khoi: int
+
+    class Config:
+        from_attributes = True
+
+
+class DocumentSeriesUpdate(BaseModel):
+    tien_to: Optional[str] = None
+    do_dai: Optional[int] = None
+    so_hien_tai: Optional[int] = None
+    khoi: Optional[int] = None  # 1 = không giữ trước khối số
 
 
 
@@ -372,6 +511,10 @@ class GeneralDiaryCreate(BaseModel):
         from_attributes = True
 
 
+class GeneralDiaryOut(GeneralDiaryCreate):
+    id: int
+
+
 class ProductGroupCreate(BaseModel):
     ten_nhom: str
     mo_ta: Optional[str] = None
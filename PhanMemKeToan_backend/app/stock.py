@@ -0,0 +1,182 @@
+"""
+Product stock adjustments for PhanMemKeToan application
+
+Trừ kho bằng một câu UPDATE có điều kiện (so_luong >= n) nên kiểm tra và trừ là
+một thao tác nguyên tử trong database: hai đơn hàng đồng thời không thể cùng
+lấy phần tồn kho cuối cùng. Nhiều sản phẩm được trừ/hoàn kho chung một câu
+UPDATE (take_many/give_back_many). Các hàm không commit; thay đổi kho nằm trong
+cùng transaction với đơn hàng. Mỗi thay đổi cũng được ghi vào sổ stock_movements
+(stock_ledger.py) với chứng từ nguồn source=(loại, id). Sản phẩm bán chạy
+(so_shard > 0) không đi qua dòng products mà trừ/hoàn trên stock_shards
+(stock_shards.py).
+"""
+from sqlalchemy import select, update, func, case
+from sqlalchemy.orm import Session
+from .models import Product
+from . import stock_ledger, stock_shards
+
+IN_STOCK = 'Còn hàng'
+OUT_OF_STOCK = 'Hết hàng'
+
+
+class InsufficientStock(Exception):
+    """Không đủ tồn kho cho sản phẩm ma_sp"""
+
+    def __init__(self, ma_sp: str, requested: int, available: int):
+        self.ma_sp = ma_sp
+        self.requested = requested
+        self.available = available
+        super().__init__(f"Số lượng sản phẩm {ma_sp} không đủ! Hiện có: {available}, yêu cầu: {requested}")
+
+
+def stock_status(new_quantity):
+    return case((new_quantity > 0, IN_STOCK), else_=OUT_OF_STOCK)
+
+
+def _not_sharded():
+    return func.coalesce(Product.so_shard, 0) == 0
+
+
+def _locked_products(codes):
+    """Id các sản phẩm (không chia shard) cần cập nhật, khóa theo thứ tự ma_sp (tránh deadlock giữa các transaction)"""
+    return (
+        select(Product.id)
+        .where(Product.ma_sp.in_(codes), _not_sharded())
+        .order_by(Product.ma_sp)
+        .with_for_update()
+    )
+
+
+def _sharded_products(db: Session, codes) -> dict:
+    """{ma_sp: product_id} của các sản phẩm bán chạy trong codes, theo thứ tự ma_sp"""
+    if not codes:
+        return {}
+    rows = (
+        db.query(Product.ma_sp, Product.id)
+        .filter(Product.ma_sp.in_(codes), ~_not_sharded())
+        .order_by(Product.ma_sp)
+    )
+    return dict(rows)
+
+
+def available(db: Session, codes) -> dict:
+    """{ma_sp: tồn kho hiện tại}; sản phẩm bán chạy lấy tổng các shard"""
+    rows = db.query(Product.id, Product.ma_sp, func.coalesce(Product.so_luong, 0), Product.so_shard).filter(
+        Product.ma_sp.in_(codes)
+    ).all()
+    sharded = stock_shards.totals(db, [product_id for product_id, _, _, so_shard in rows if so_shard])
+    return {ma_sp: int(sharded.get(product_id, quantity) or 0) for product_id, ma_sp, quantity, _ in rows}
+
+
+def _record(db: Session, product_ids: dict, quantities: dict, sign: int, source):
+    if source is not None:
+        source_type, source_id = source
+        stock_ledger.record(db, [
+            (product_id, sign * quantities[ma_sp], source_type, source_id)
+            for ma_sp, product_id in product_ids.items()
+        ])
+
+
+def take_many(db: Session, quantities: dict, source=None) -> dict:
+    """
+    Trừ tồn kho nhiều sản phẩm {ma_sp: số lượng} bằng một câu UPDATE có điều kiện.
+    Trả về {ma_sp: tồn kho mới (None với sản phẩm bán chạy)}; nếu có sản phẩm không đủ hàng thì raise
+    InsufficientStock và bên gọi phải rollback (các dòng khác có thể đã bị trừ).
+    source=(loại, id) chứng từ ghi vào sổ; None: bên gọi tự ghi sổ.
+    """
+    quantities = {ma_sp: int(qty or 0) for ma_sp, qty in quantities.items() if ma_sp and int(qty or 0) > 0}
+    if not quantities:
+        return {}
+    codes = sorted(quantities)
+    requested = case(quantities, value=Product.ma_sp, else_=0)
+    current = func.coalesce(Product.so_luong, 0)
+    new_quantity = current - requested
+    rows = db.execute(
+        update(Product)
+        .where(Product.id.in_(_locked_products(codes)), current >= requested, _not_sharded())
+        .values(so_luong=new_quantity, trang_thai=stock_status(new_quantity))
+        .returning(Product.id, Product.ma_sp, Product.so_luong)
+        .execution_options(synchronize_session=False)
+    ).all()
+    remaining = {ma_sp: quantity for _, ma_sp, quantity in rows}
+    product_ids = {ma_sp: product_id for product_id, ma_sp, _ in rows}
+    # Sản phẩm bán chạy: trừ trên một shard, không khóa dòng products
+    for ma_sp, product_id in _sharded_products(db, [c for c in codes if c not in remaining]).items():
+        if stock_shards.take(db, product_id, quantities[ma_sp]):
+            remaining[ma_sp] = None
+            product_ids[ma_sp] = product_id
+    short = [ma_sp for ma_sp in codes if ma_sp not in remaining]
+    if short:
+        raise InsufficientStock(short[0], quantities[short[0]], available(db, short[:1]).get(short[0], 0))
+    _record(db, product_ids, quantities, -1, source)
+    return remaining
+
+
+def give_back_many(db: Session, quantities: dict, source=None):
+    """Hoàn trả tồn kho nhiều sản phẩm {ma_sp: số lượng} bằng một câu UPDATE"""
+    quantities = {ma_sp: int(qty or 0) for ma_sp, qty in quantities.items() if ma_sp and int(qty or 0) > 0}
+    if not quantities:
+        return
+    codes = sorted(quantities)
+    new_quantity = func.coalesce(Product.so_luong, 0) + case(quantities, value=Product.ma_sp, else_=0)
+    rows = db.execute(
+        update(Product)
+        .where(Product.id.in_(_locked_products(codes)), _not_sharded())
+        .values(so_luong=new_quantity, trang_thai=stock_status(new_quantity))
+        .returning(Product.id, Product.ma_sp)
+        .execution_options(synchronize_session=False)
+    ).all()
+    product_ids = {ma_sp: product_id for product_id, ma_sp in rows}
+    for ma_sp, product_id in _sharded_products(db, [c for c in codes if c not in product_ids]).items():
+        stock_shards.give_back(db, product_id, quantities[ma_sp])
+        product_ids[ma_sp] = product_id
+    _record(db, product_ids, quantities, 1, source)
+
+
+def take(db: Session, ma_sp: str, quantity: int, source=None) -> int:
+    """Trừ quantity khỏi tồn kho nếu đủ; trả về tồn kho mới hoặc raise InsufficientStock"""
+    return take_many(db, {ma_sp: quantity}, source).get(ma_sp)
+
+
+def give_back(db: Session, ma_sp: str, quantity: int, source=None):
+    """Hoàn trả quantity vào tồn kho"""
+    give_back_many(db, {ma_sp: quantity}, source)
+
+
+def set_quantity(db: Session, product_id: int, quantity: int, source) -> int:
+    """Đặt tồn kho của sản phẩm (nhập/sửa tay) và ghi phần chênh lệch vào sổ; trả về chênh lệch"""
+    current, so_shard = db.query(func.coalesce(Product.so_luong, 0), Product.so_shard).filter(
+        Product.id == product_id
+    ).with_for_update().one()
+    if so_shard:
+        current = stock_shards.set_total(db, product_id, quantity)
+    else:
+        db.execute(
+            update(Product)
+            .where(Product.id == product_id)
+            .values(so_luong=quantity)
+            .execution_options(synchronize_session=False)
+        )
+    delta = int(quantity or 0) - int(current or 0)
+    source_type, source_id = source
+    stock_ledger.record(db, [(product_id, delta, source_type, source_id)])
+    return delta
+
+
+def net_changes(before: dict, after: dict) -> dict:
+    """Chênh lệch giữa lượng kho đơn hàng đang giữ trước và sau khi sửa {ma_sp: số lượng}"""
+    changes = {}
+    for ma_sp in set(before) | set(after):
+        delta = int(after.get(ma_sp, 0) or 0) - int(before.get(ma_sp, 0) or 0)
+        if delta:
+            changes[ma_sp] = delta
+    return changes
+
+
+def apply_changes(db: Session, changes: dict, source=None):
+    """
+    Áp dụng thay đổi tồn kho {ma_sp: số lượng cần trừ (âm = hoàn trả)}.
+    Hoàn trả trước, trừ sau; mỗi chiều là một câu UPDATE cho mọi sản phẩm.
+    """
+    give_back_many(db, {ma_sp: -qty for ma_sp, qty in changes.items() if qty < 0}, source)
+    take_many(db, {ma_sp: qty for ma_sp, qty in changes.items() if qty > 0}, source)
@@ -0,0 +1,288 @@
+"""
+Stock movement ledger for PhanMemKeToan application
+
+Mọi thay đổi tồn kho được ghi thêm (append-only) vào stock_movements cùng
+transaction với thao tác đó; products.so_luong là số dư hiện tại (projection)
+được cập nhật trong cùng transaction (xem stock.py). Định kỳ, số dư của từng sản
+phẩm được chốt vào stock_checkpoints, nên số dư theo sổ chỉ cần checkpoint cuối
+cùng cộng các movement sau nó; tồn kho tại một ngày trong quá khứ (khóa sổ cuối
+tháng/năm) cũng bắt đầu từ checkpoint gần nhất trước ngày đó (balances_as_of).
+audit() so sánh sổ với products.so_luong và rebuild() đặt lại so_luong theo sổ,
+mỗi việc một lượt đọc.
+
+Checkpoint chỉ chốt tới mốc id mà mọi movement có id nhỏ hơn đã commit: trên
+PostgreSQL mỗi transaction ghi movement giữ advisory lock LEDGER_LOCK ở chế độ
+shared tới khi commit; checkpoint lấy lock đó ở chế độ exclusive (không chờ: đang
+có transaction ghi thì bỏ qua lượt này), đọc max(id) rồi nhả ngay. Không dựa vào
+created_at (giờ của máy chạy ứng dụng) nên transaction chạy lâu (nhập hàng loạt,
+chờ khóa) không bị bỏ sót.
+"""
+from datetime import datetime
+import logging
+import threading
+import time
+from sqlalchemy import select, update, func, case, literal, and_, exists
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .config import Config
+from .models import Product, StockMovement, StockCheckpoint, StockShard
+from . import stock_shards
+
+logger = logging.getLogger(__name__)
+
+SOURCE_ORDER = 'order'      # Đơn hàng (source_id = orders.id)
+SOURCE_PRODUCT = 'product'  # Nhập/sửa số lượng trên màn hình sản phẩm (source_id = products.id)
+SOURCE_OPENING = 'opening'  # Số dư đầu kỳ khi bắt đầu dùng sổ
+
+# Khóa advisory giữa các transaction ghi movement (shared) và checkpoint (exclusive)
+LEDGER_LOCK = 0x534B4C47  # 'SKLG'
+
+
+def _is_postgresql(db: Session) -> bool:
+    return db.get_bind().dialect.name == 'postgresql'
+
+
+def _hold_writer_lock(db: Session):
+    """
+    Transaction này ghi movement: giữ LEDGER_LOCK (shared, tới khi commit/rollback).
+    SQLite chỉ có một transaction ghi tại một thời điểm nên không cần.
+    """
+    if _is_postgresql(db):
+        db.execute(select(func.pg_advisory_xact_lock_shared(LEDGER_LOCK)))
+
+
+def committed_horizon(db: Session):
+    """
+    Id movement lớn nhất mà mọi movement có id <= nó đã commit; None nếu đang có
+    transaction ghi movement (PostgreSQL) hoặc sổ trống.
+    """
+    if not _is_postgresql(db):
+        return db.query(func.max(StockMovement.id)).scalar()
+    if not db.execute(select(func.pg_try_advisory_lock(LEDGER_LOCK))).scalar():
+        return None
+    try:
+        # Không transaction nào đang giữ lock shared: mọi id đã cấp đều thuộc transaction
+        # đã kết thúc; transaction ghi sau đó nhận id lớn hơn
+        return db.query(func.max(StockMovement.id)).scalar()
+    finally:
+        db.execute(select(func.pg_advisory_unlock(LEDGER_LOCK)))
+
+
+def record(db: Session, movements):
+    """Ghi các movement [(product_id, delta, source_type, source_id)] bằng một câu INSERT (không commit)"""
+    now = datetime.now()
+    rows = [
+        {'product_id': product_id, 'delta': int(delta), 'source_type': source_type,
+         'source_id': source_id, 'created_at': now}
+        for product_id, delta, source_type, source_id in movements
+        if product_id is not None and int(delta or 0) != 0
+    ]
+    if rows:
+        _hold_writer_lock(db)
+        db.execute(insert(StockMovement), rows)
+    return len(rows)
+
+
+def _last_checkpoints(before=None):
+    """Checkpoint mới nhất (chốt trước thời điểm before nếu có) của mỗi sản phẩm (product_id, movement_id, balance)"""
+    latest = select(StockCheckpoint.product_id, func.max(StockCheckpoint.movement_id).label('movement_id'))
+    if before is not None:
+        latest = latest.where(StockCheckpoint.created_at < before)
+    latest = latest.group_by(StockCheckpoint.product_id).subquery()
+    return (
+        select(StockCheckpoint.product_id, StockCheckpoint.movement_id, StockCheckpoint.balance)
+        .join(latest, and_(
+            latest.c.product_id == StockCheckpoint.product_id,
+            latest.c.movement_id == StockCheckpoint.movement_id,
+        ))
+        .subquery()
+    )
+
+
+def _balance_query(product_filter=None, before=None, columns=()):
+    """
+    (id, ma_sp, so_luong, số dư theo sổ) của các sản phẩm: checkpoint cuối + các movement
+    sau nó. Với before, số dư tại thời điểm đó: checkpoint cuối chốt trước before + các
+    movement sau checkpoint có created_at < before (movement trong checkpoint luôn được
+    ghi trước khi chốt nên không cần trừ ngược).
+    """
+    checkpoint = _last_checkpoints(before)
+    after = (
+        select(StockMovement.product_id, func.sum(StockMovement.delta).label('delta'))
+        .select_from(StockMovement)
+        .outerjoin(checkpoint, checkpoint.c.product_id == StockMovement.product_id)
+        .where(StockMovement.id > func.coalesce(checkpoint.c.movement_id, 0))
+    )
+    if before is not None:
+        after = after.where(StockMovement.created_at < before)
+    after = after.group_by(StockMovement.product_id).subquery()
+    ledger = func.coalesce(checkpoint.c.balance, 0) + func.coalesce(after.c.delta, 0)
+    # Sản phẩm bán chạy: tồn kho hiện tại là tổng các shard
+    shards = stock_shards.totals_subquery()
+    current = stock_shards.live_quantity(shards)
+    query = (
+        select(Product.id, Product.ma_sp, current.label('so_luong'), ledger.label('ledger'), *columns)
+        .outerjoin(checkpoint, checkpoint.c.product_id == Product.id)
+        .outerjoin(after, after.c.product_id == Product.id)
+        .outerjoin(shards, shards.c.product_id == Product.id)
+    )
+    if product_filter is not None:
+        query = query.where(product_filter)
+    return query
+
+
+def audit(db: Session, product_filter=None):
+    """Các sản phẩm có so_luong khác số dư theo sổ: [{product_id, ma_sp, so_luong, ledger, drift}]"""
+    rows = db.execute(_balance_query(product_filter).order_by(Product.id)).all()
+    drift = [
+        {'product_id': row.id, 'ma_sp': row.ma_sp, 'so_luong': int(row.so_luong),
+         'ledger': int(row.ledger), 'drift': int(row.so_luong) - int(row.ledger)}
+        for row in rows if int(row.so_luong) != int(row.ledger)
+    ]
+    return len(rows), drift
+
+
+def balances_as_of(db: Session, before: datetime, product_filter=None):
+    """
+    Tồn kho của các sản phẩm tại thời điểm before (không gồm before), bắt đầu từ
+    checkpoint gần nhất nên chỉ cộng các movement trong một chu kỳ chốt:
+    [{product_id, ma_sp, ten_sp, nhom_sp, so_luong, so_luong_hien_tai}]
+    """
+    query = _balance_query(product_filter, before, (Product.ten_sp, Product.nhom_sp)).order_by(Product.ma_sp)
+    return [
+        {'product_id': row.id, 'ma_sp': row.ma_sp, 'ten_sp': row.ten_sp, 'nhom_sp': row.nhom_sp,
+         'so_luong': int(row.ledger), 'so_luong_hien_tai': int(row.so_luong)}
+        for row in db.execute(query)
+    ]
+
+
+def _movement_totals(db: Session, product_ids) -> dict:
+    """{product_id: tổng mọi movement} (không dùng checkpoint)"""
+    rows = (
+        db.query(StockMovement.product_id, func.sum(StockMovement.delta))
+        .filter(StockMovement.product_id.in_(product_ids))
+        .group_by(StockMovement.product_id)
+    )
+    return {product_id: int(total or 0) for product_id, total in rows}
+
+
+def rebuild(db: Session, product_filter=None):
+    """
+    Đặt lại products.so_luong (và trạng thái) theo số dư trong sổ cho các sản phẩm bị
+    lệch; sản phẩm bán chạy được chia lại vào các shard (không commit).
+    Trước khi ghi: khóa các sản phẩm bị lệch (dòng products rồi các shard) và tính lại
+    độ lệch, rồi đối chiếu số dư theo checkpoint với tổng toàn bộ movement. Sản phẩm
+    có checkpoint không khớp sổ không bị ghi đè mà được trả về để kiểm tra.
+    Trả về (số sản phẩm được cập nhật, [các sản phẩm bị bỏ qua]).
+    """
+    from .stock import stock_status
+    _, drift = audit(db, product_filter)
+    if not drift:
+        return 0, []
+    ids = sorted(row['product_id'] for row in drift)
+    # Thao tác kho đồng thời không đổi so_luong giữa lúc kiểm tra và lúc ghi
+    db.execute(select(Product.id).where(Product.id.in_(ids)).order_by(Product.id).with_for_update()).all()
+    db.execute(
+        select(StockShard.product_id)
+        .where(StockShard.product_id.in_(ids))
+        .order_by(StockShard.product_id, StockShard.shard)
+        .with_for_update()
+    ).all()
+    _, drift = audit(db, Product.id.in_(ids))
+    totals = _movement_totals(db, ids)
+    skipped = [dict(row, movements=totals.get(row['product_id'], 0))
+               for row in drift if totals.get(row['product_id'], 0) != row['ledger']]
+    for row in skipped:
+        logger.warning("Stock rebuild skipped %s: checkpoint balance %d, movements %d",
+                       row['ma_sp'], row['ledger'], row['movements'])
+    balances = {row['product_id']: row['ledger'] for row in drift
+                if totals.get(row['product_id'], 0) == row['ledger']}
+    updated = len(balances)
+    sharded = {product_id for (product_id,) in db.query(Product.id).filter(Product.id.in_(balances), Product.so_shard > 0)}
+    for product_id in sorted(sharded):
+        stock_shards.set_total(db, product_id, balances.pop(product_id))
+    if balances:
+        new_quantity = case(balances, value=Product.id)
+        db.execute(
+            update(Product)
+            .where(Product.id.in_(balances))
+            .values(so_luong=new_quantity, trang_thai=stock_status(new_quantity))
+            .execution_options(synchronize_session=False)
+        )
+    return updated, skipped
+
+
+def open_balances(db: Session) -> int:
+    """Ghi số dư đầu kỳ (so_luong hiện tại) cho các sản phẩm chưa có movement nào (không commit)"""
+    _hold_writer_lock(db)
+    has_movement = exists().where(StockMovement.product_id == Product.id)
+    source = select(
+        Product.id, Product.so_luong, literal(SOURCE_OPENING), Product.id, literal(datetime.now())
+    ).where(func.coalesce(Product.so_luong, 0) != 0, ~has_movement)
+    result = db.execute(
+        insert(StockMovement).from_select(
+            ['product_id', 'delta', 'source_type', 'source_id', 'created_at'], source
+        )
+    )
+    return result.rowcount
+
+
+def checkpoint(db: Session) -> int:
+    """
+    Chốt số dư của các sản phẩm có movement mới (tới committed_horizon) bằng một câu
+    INSERT ... SELECT. Chạy đồng thời nhiều lần cũng an toàn (bỏ qua trùng).
+    """
+    upto = committed_horizon(db)
+    if upto is None:
+        return 0
+    last = _last_checkpoints()
+    source = (
+        select(
+            StockMovement.product_id,
+            func.max(StockMovement.id),
+            func.coalesce(last.c.balance, 0) + func.sum(StockMovement.delta),
+            literal(datetime.now()),
+        )
+        .select_from(StockMovement)
+        .outerjoin(last, last.c.product_id == StockMovement.product_id)
+        .where(StockMovement.id > func.coalesce(last.c.movement_id, 0), StockMovement.id <= upto)
+        .group_by(StockMovement.product_id, last.c.balance)
+    )
+    stmt = insert(StockCheckpoint).from_select(['product_id', 'movement_id', 'balance', 'created_at'], source)
+    result = db.execute(stmt.on_conflict_do_nothing(index_elements=['product_id', 'movement_id']))
+    return result.rowcount
+
+
+_checkpointer_started = False
+_checkpointer_lock = threading.Lock()
+
+
+def _checkpoint_loop(interval: int):
+    from .database import SessionLocal
+    while True:
+        time.sleep(interval)
+        db = SessionLocal()
+        try:
+            created = checkpoint(db)
+            db.commit()
+            if created:
+                logger.info("Stock checkpoint: %d products", created)
+        except Exception:
+            db.rollback()
+            logger.exception("Stock checkpoint failed")
+        finally:
+            db.close()
+
+
+def start_checkpointer():
+    """Chạy checkpoint() định kỳ trên một thread nền (Config.STOCK_CHECKPOINT_INTERVAL_SECONDS)"""
+    global _checkpointer_started
+    interval = Config.STOCK_CHECKPOINT_INTERVAL_SECONDS
+    if interval <= 0:
+        return False
+    with _checkpointer_lock:
+        if _checkpointer_started:
+            return False
+        _checkpointer_started = True
+    threading.Thread(target=_checkpoint_loop, args=(interval,), name='stock-checkpoint', daemon=True).start()
+    return True
@@ -0,0 +1,225 @@
+"""
+Sharded stock counters for hot products in PhanMemKeToan application
+
+Khi có khuyến mãi, hàng trăm đơn hàng đồng thời trừ kho cùng một ma_sp và xếp
+hàng chờ khóa trên một dòng products. Với sản phẩm được đánh dấu bán chạy
+(products.so_shard = N > 0), tồn kho được chia vào N dòng stock_shards; mỗi đơn
+hàng chỉ khóa một dòng còn đủ hàng (FOR UPDATE SKIP LOCKED) nên các đơn chạy song
+song. Khi không dòng nào đủ, đơn hàng khóa tất cả các dòng (theo thứ tự shard),
+gom lại và chia đều (rebalance) rồi cập nhật products.so_luong.
+
+Khi mọi dòng đủ hàng đều đang bị khóa, đơn hàng gom phần còn thiếu từ nhiều dòng
+chưa bị khóa, rồi chờ khóa một dòng đủ hàng; chỉ khi tổng các dòng không đủ mới
+khóa tất cả.
+
+Tồn kho thật = tổng các dòng (totals); products.so_luong chỉ được đồng bộ khi
+rebalance/đặt số lượng nên có thể chậm hơn giữa các lần đó. Truy vấn cần tồn kho
+(báo cáo, danh sách) join totals_subquery và đọc live_quantity. Các hàm không commit.
+"""
+from sqlalchemy import select, update, delete, func, case
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .models import Product, StockShard
+
+
+def _spread(total: int, shards: int):
+    """Chia total thành shards phần chênh nhau tối đa 1"""
+    base, extra = divmod(max(int(total), 0), shards)
+    return [base + (1 if i < extra else 0) for i in range(shards)]
+
+
+def totals(db: Session, product_ids=None) -> dict:
+    """{product_id: tồn kho} của các sản phẩm bán chạy (tổng các dòng, không khóa)"""
+    query = db.query(StockShard.product_id, func.sum(StockShard.so_luong)).group_by(StockShard.product_id)
+    if product_ids is not None:
+        query = query.filter(StockShard.product_id.in_(product_ids))
+    return {product_id: int(total or 0) for product_id, total in query}
+
+
+def totals_subquery():
+    """(product_id, so_luong) tổng các dòng của mỗi sản phẩm bán chạy, để join trong truy vấn"""
+    return (
+        select(StockShard.product_id, func.sum(StockShard.so_luong).label('so_luong'))
+        .group_by(StockShard.product_id)
+        .subquery()
+    )
+
+
+def live_quantity(shards):
+    """Tồn kho thật trong truy vấn đã outer join shards = totals_subquery(): tổng các shard nếu có"""
+    return func.coalesce(shards.c.so_luong, Product.so_luong, 0)
+
+
+def _lock_all(db: Session, product_id: int):
+    """
+    Khóa dòng products rồi mọi dòng của sản phẩm theo thứ tự shard (cùng thứ tự ở mọi
+    nơi để tránh deadlock); trả về (danh sách shard, tổng). Sản phẩm chưa có dòng
+    shard nào: tổng là products.so_luong.
+    """
+    current = db.execute(
+        select(func.coalesce(Product.so_luong, 0)).where(Product.id == product_id).with_for_update()
+    ).scalar()
+    rows = db.execute(
+        select(StockShard.shard, StockShard.so_luong)
+        .where(StockShard.product_id == product_id)
+        .order_by(StockShard.shard)
+        .with_for_update()
+    ).all()
+    if not rows:
+        return [], int(current or 0)
+    return [row.shard for row in rows], sum(int(row.so_luong or 0) for row in rows)
+
+
+def _write(db: Session, product_id: int, shards, total: int):
+    """Chia đều total vào các dòng đã khóa và đồng bộ products.so_luong/trang_thai"""
+    from .stock import stock_status
+    if shards:
+        values = dict(zip(shards, _spread(total, len(shards))))
+        db.execute(
+            update(StockShard)
+            .where(StockShard.product_id == product_id)
+            .values(so_luong=case(values, value=StockShard.shard, else_=0))
+            .execution_options(synchronize_session=False)
+        )
+    db.execute(
+        update(Product)
+        .where(Product.id == product_id)
+        .values(so_luong=total, trang_thai=stock_status(total))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _subtract(db: Session, product_id: int, parts: dict):
+    """Trừ {shard: số lượng} trên các dòng đã khóa bằng một câu UPDATE"""
+    db.execute(
+        update(StockShard)
+        .where(StockShard.product_id == product_id, StockShard.shard.in_(parts))
+        .values(so_luong=StockShard.so_luong - case(parts, value=StockShard.shard, else_=0))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _pick(db: Session, product_id: int, minimum: int, skip_locked: bool = True, exclude=()):
+    """Khóa một dòng ngẫu nhiên có so_luong >= minimum; trả về (shard, so_luong) hoặc None"""
+    query = (
+        select(StockShard.shard, StockShard.so_luong)
+        .where(StockShard.product_id == product_id, StockShard.so_luong >= minimum)
+        .order_by(func.random())
+        .limit(1)
+        .with_for_update(skip_locked=skip_locked)
+    )
+    if exclude:
+        query = query.where(StockShard.shard.notin_(exclude))
+    return db.execute(query).first()
+
+
+def _take_split(db: Session, product_id: int, quantity: int) -> bool:
+    """
+    Gom quantity từ nhiều dòng chưa bị khóa. Chạy trong savepoint: nếu không gom đủ
+    thì rollback để nhả các dòng đã khóa (giữ chúng rồi khóa theo thứ tự shard có
+    thể deadlock với đơn khác).
+    """
+    savepoint = db.begin_nested()
+    parts = {}
+    needed = quantity
+    while needed > 0:
+        row = _pick(db, product_id, 1, exclude=list(parts))
+        if row is None:
+            savepoint.rollback()
+            return False
+        parts[row.shard] = min(needed, int(row.so_luong))
+        needed -= parts[row.shard]
+    _subtract(db, product_id, parts)
+    savepoint.commit()
+    return True
+
+
+def take(db: Session, product_id: int, quantity: int) -> bool:
+    """
+    Trừ quantity khỏi tồn kho sản phẩm bán chạy, khóa ít dòng nhất có thể:
+    1. một dòng đủ hàng chưa bị đơn khác khóa;
+    2. gom từ nhiều dòng chưa bị khóa;
+    3. chờ khóa một dòng đủ hàng (mọi dòng đang bận, ví dụ nhiều đơn đồng thời hơn số shard);
+    4. khóa hết các dòng, trừ trên tổng và chia đều lại. False nếu tổng không đủ.
+    """
+    row = _pick(db, product_id, quantity)
+    if row is None and _take_split(db, product_id, quantity):
+        return True
+    if row is None:
+        row = _pick(db, product_id, quantity, skip_locked=False)
+    if row is not None:
+        _subtract(db, product_id, {row.shard: quantity})
+        return True
+    shards, total = _lock_all(db, product_id)
+    if total < quantity:
+        return False
+    _write(db, product_id, shards, total - quantity)
+    return True
+
+
+def give_back(db: Session, product_id: int, quantity: int):
+    """
+    Cộng quantity vào một dòng chưa bị khóa (hoặc chờ một dòng nếu tất cả đang bận).
+    Sản phẩm không có dòng shard nào: cộng vào products.so_luong.
+    """
+    row = _pick(db, product_id, 0) or _pick(db, product_id, 0, skip_locked=False)
+    if row is None:
+        shards, total = _lock_all(db, product_id)
+        _write(db, product_id, shards, total + quantity)
+        return
+    _subtract(db, product_id, {row.shard: -quantity})
+
+
+def set_total(db: Session, product_id: int, quantity: int) -> int:
+    """Đặt tồn kho của sản phẩm bán chạy (chia đều lại); trả về tồn kho trước đó"""
+    shards, total = _lock_all(db, product_id)
+    _write(db, product_id, shards, int(quantity or 0))
+    return total
+
+
+def rebalance(db: Session, product_id: int) -> int:
+    """Chia đều lại tồn kho giữa các dòng và đồng bộ products.so_luong; trả về tồn kho"""
+    shards, total = _lock_all(db, product_id)
+    _write(db, product_id, shards, total)
+    return total
+
+
+def enable(db: Session, product_id: int, shards: int) -> int:
+    """
+    Đánh dấu sản phẩm bán chạy và chia tồn kho vào shards dòng (đổi số dòng nếu đã
+    bật). Khóa dòng products trước nên đơn hàng đang trừ kho trên products xong
+    trước hoặc thấy so_shard mới. Trả về tồn kho.
+    """
+    product = db.execute(
+        select(Product.so_luong, Product.so_shard).where(Product.id == product_id).with_for_update()
+    ).one()
+    if product.so_shard:
+        _, total = _lock_all(db, product_id)
+        db.execute(delete(StockShard).where(StockShard.product_id == product_id))
+    else:
+        total = int(product.so_luong or 0)
+    db.execute(insert(StockShard), [
+        {'product_id': product_id, 'shard': i, 'so_luong': so_luong}
+        for i, so_luong in enumerate(_spread(total, shards))
+    ])
+    db.execute(
+        update(Product)
+        .where(Product.id == product_id)
+        .values(so_luong=total, so_shard=shards)
+        .execution_options(synchronize_session=False)
+    )
+    return total
+
+
+def disable(db: Session, product_id: int) -> int:
+    """Gộp tồn kho về products.so_luong và bỏ đánh dấu bán chạy; trả về tồn kho"""
+    _, total = _lock_all(db, product_id)
+    db.execute(delete(StockShard).where(StockShard.product_id == product_id))
+    _write(db, product_id, [], total)
+    db.execute(
+        update(Product)
+        .where(Product.id == product_id)
+        .values(so_shard=0)
+        .execution_options(synchronize_session=False)
+    )
+    return total
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Benchmark: gom nhóm doanh thu bằng vòng lặp Python (kiểu reports.py cũ) so với AnalyticsEngine (NumPy)
+
+Chạy: python benchmarks/bench_analytics.py [số_hóa_đơn] [số_đơn_hàng]
+Dữ liệu được sinh ngẫu nhiên trong bộ nhớ, không cần database.
+"""
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.analytics import AnalyticsEngine
+from app.sales_rollup import PAID_STATUS
+
+START = date(2024, 1, 1)
+END = date(2024, 12, 31)
+
+
+def make_rows(n_invoices, n_orders, seed=42):
+    rng = random.Random(seed)
+    days = (END - START).days + 1
+    customers = [f"Khách hàng {i}" for i in range(500)]
+    groups = [f"Nhóm {i}" for i in range(20)] + [None]
+    methods = ['Tiền mặt', 'Chuyển khoản', 'Thẻ', None]
+    invoices = [
+        (
+            START + timedelta(days=rng.randrange(days)),
+            rng.choice(customers),
+            float(rng.randint(1, 10_000) * 1000),
+            PAID_STATUS if rng.random() < 0.6 else 'Chưa thanh toán',
+        )
+        for _ in range(n_invoices)
+    ]
+    orders = [
+        (
+            START + timedelta(days=rng.randrange(days)),
+            rng.choice(groups),
+            rng.choice(methods),
+            rng.randint(1, 20),
+            float(rng.randint(1, 10_000) * 1000),
+            1,
+            1,
+        )
+        for _ in range(n_orders)
+    ]
+    return invoices, orders
+
+
+def loop_based(invoices, orders):
+    """Gom nhóm bằng dict như các vòng lặp trong reports.py trước đây"""
+    by_day = {}
+    by_customer = {}
+    for ngay_hd, nguoi_mua, tong_tien, trang_thai in invoices:
+        key = ngay_hd.isoformat()
+        by_day[key] = by_day.get(key, 0) + float(tong_tien or 0)
+        entry = by_customer.setdefault(nguoi_mua, {'revenue': 0, 'paid_revenue': 0})
+        entry['revenue'] += float(tong_tien or 0)
+        if trang_thai == PAID_STATUS:
+            entry['paid_revenue'] += float(tong_tien or 0)
+    by_group = {}
+    by_method = {}
+    for ngay_tao, nhom_sp, hinh_thuc_tt, so_luong, tong_tien, _, _ in orders:
+        for target, label in ((by_group, nhom_sp), (by_method, hinh_thuc_tt)):
+            entry = target.setdefault(label or '', {'order_revenue': 0, 'quantity': 0})
+            entry['order_revenue'] += float(tong_tien or 0)
+            entry['quantity'] += int(so_luong or 0)
+    return by_day, by_customer, by_group, by_method
+
+
+def vectorized(invoices, orders):
+    engine = AnalyticsEngine(START, END, invoices, orders)
+    return engine, [engine.aggregate(d) for d in ('day', 'customer', 'product_group', 'payment_method')]
+
+
+def best_of(fn, repeat=5):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    n_invoices = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    n_orders = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+    invoices, orders = make_rows(n_invoices, n_orders)
+    print(f"📊 {n_invoices:,} hóa đơn, {n_orders:,} đơn hàng")
+
+    loop_time, (by_day, by_customer, _, _) = best_of(lambda: loop_based(invoices, orders))
+    vec_time, (engine, (day_rows, customer_rows, _, _)) = best_of(lambda: vectorized(invoices, orders))
+    agg_time, _ = best_of(lambda: [engine.aggregate(d) for d in ('day', 'customer', 'product_group', 'payment_method')])
+
+    # Kiểm tra hai cách cho cùng kết quả
+    for row in day_rows:
+        assert abs(row['revenue'] - by_day.get(row['key'], 0)) < 1e-6
+    for row in customer_rows:
+        assert abs(row['paid_revenue'] - by_customer[row['key']]['paid_revenue']) < 1e-6
+
+    print(f"Vòng lặp Python:             {loop_time * 1000:9.1f} ms")
+    print(f"NumPy (nạp mảng + gom nhóm): {vec_time * 1000:9.1f} ms  (x{loop_time / vec_time:.1f})")
+    print(f"NumPy (chỉ gom nhóm):        {agg_time * 1000:9.1f} ms  (x{loop_time / agg_time:.1f})")
+
+
+if __name__ == '__main__':
+    main()
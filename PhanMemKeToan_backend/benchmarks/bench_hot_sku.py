@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Benchmark: đơn hàng dồn vào một sản phẩm bán chạy, có và không chia shard tồn kho
+
+Mỗi client tạo đơn hàng trên cùng một ma_sp theo các bước trừ kho của
+create_order: thêm dòng orders, trừ kho có điều kiện và ghi sổ kho (stock.take_many),
+rồi giữ transaction thêm độ_trễ_ms (phần việc còn lại trước khi commit) và commit.
+Chạy hai lượt: tồn kho trên dòng products (mọi đơn xếp hàng chờ khóa dòng đó) và
+tồn kho chia vào stock_shards (mỗi đơn khóa một shard). In ra số đơn/giây, số đơn
+bị từ chối vì hết hàng và kiểm tra không bán vượt tồn kho.
+
+create_order còn cập nhật dòng daily_sales_summary (ngày, ma_sp) ngay trước commit;
+dòng này cũng nóng khi mọi đơn cùng ngày, nên benchmark đo riêng phần tồn kho.
+
+Chạy: python benchmarks/bench_hot_sku.py [số_client] [số_đơn_mỗi_client] [số_shard] [độ_trễ_ms]
+Dùng database trong DATABASE_URL (nên là PostgreSQL; SQLite tuần tự hóa mọi
+thao tác ghi và bỏ qua FOR UPDATE nên không phản ánh đúng tranh chấp). Dữ liệu
+benchmark (mã bắt đầu bằng BENCH-HOT) được xóa sau khi chạy.
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.database import SessionLocal, engine, Base
+from app.models import Order, Product, StockMovement
+from app import stock, stock_ledger, stock_shards
+
+PRODUCT_CODE = 'BENCH-HOT'
+ORDER_PREFIX = 'BENCH-HOT-'
+CUSTOMER = 'Khách hàng benchmark'
+ORDER_DATE = date(2000, 1, 1)
+
+
+def reset(initial_stock, shards):
+    db = SessionLocal()
+    try:
+        cleanup(db)
+        product = Product(ma_sp=PRODUCT_CODE, ten_sp='Sản phẩm benchmark', so_luong=initial_stock, gia_chung=1000,
+                          trang_thai='Còn hàng')
+        db.add(product)
+        db.flush()
+        if shards:
+            stock_shards.enable(db, product.id, shards)
+        db.commit()
+    finally:
+        db.close()
+
+
+def cleanup(db):
+    db.query(Order).filter(Order.ma_don_hang.like(f'{ORDER_PREFIX}%')).delete(synchronize_session=False)
+    product_ids = [product_id for (product_id,) in db.query(Product.id).filter(Product.ma_sp == PRODUCT_CODE)]
+    db.query(StockMovement).filter(StockMovement.product_id.in_(product_ids)).delete(synchronize_session=False)
+    for product_id in product_ids:
+        stock_shards.disable(db, product_id)
+    db.query(Product).filter(Product.ma_sp == PRODUCT_CODE).delete(synchronize_session=False)
+    db.commit()
+
+
+def place_order(code, work_seconds):
+    """Một đơn hàng 1 sản phẩm: thêm đơn, trừ kho + ghi sổ, giữ transaction work_seconds rồi commit"""
+    db = SessionLocal()
+    try:
+        order = Order(ma_don_hang=code, thong_tin_kh=CUSTOMER, sp_banggia=PRODUCT_CODE, ngay_tao=ORDER_DATE,
+                      so_luong=1, tong_tien=1000, trang_thai='Hoàn thành')
+        db.add(order)
+        db.flush()
+        stock.take_many(db, {PRODUCT_CODE: 1}, (stock_ledger.SOURCE_ORDER, order.id))
+        if work_seconds:
+            time.sleep(work_seconds)
+        db.commit()
+        return True
+    except stock.InsufficientStock:
+        db.rollback()
+        return False
+    finally:
+        db.close()
+
+
+def client(client_id, orders_per_client, work_seconds):
+    accepted = rejected = errors = 0
+    for i in range(orders_per_client):
+        try:
+            if place_order(f'{ORDER_PREFIX}{client_id}-{i}', work_seconds):
+                accepted += 1
+            else:
+                rejected += 1
+        except Exception:
+            errors += 1
+    return accepted, rejected, errors
+
+
+def run(name, shards, clients, orders_per_client, initial_stock, work_seconds):
+    reset(initial_stock, shards)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda c: client(c, orders_per_client, work_seconds), range(clients)))
+    elapsed = time.perf_counter() - t0
+
+    accepted, rejected, errors = (sum(r[i] for r in results) for i in range(3))
+    db = SessionLocal()
+    try:
+        product_id = db.query(Product.id).filter(Product.ma_sp == PRODUCT_CODE).scalar()
+        final_stock = stock_shards.totals(db, [product_id]).get(product_id) if shards else \
+            db.query(Product.so_luong).filter(Product.id == product_id).scalar()
+        stored = db.query(Order).filter(Order.ma_don_hang.like(f'{ORDER_PREFIX}%')).count()
+        cleanup(db)
+    finally:
+        db.close()
+    oversell = max(stored - initial_stock, 0)
+    lost_updates = (initial_stock - stored) - final_stock
+    total = clients * orders_per_client
+    print(f"{name:<20} {total / elapsed:9.1f} đơn/s  nhận {accepted:5d}  từ chối {rejected:5d}  lỗi {errors:3d}  "
+          f"tồn cuối {final_stock:5d}  oversell {oversell:4d}  lệch kho {lost_updates:4d}")
+    return total / elapsed, oversell, lost_updates
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    orders_per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    shards = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    work_seconds = (float(sys.argv[4]) if len(sys.argv) > 4 else 5) / 1000
+    # Đủ hàng cho gần hết các đơn: đo thông lượng, lượt cuối kiểm tra đường gom shard khi sắp hết hàng
+    initial_stock = clients * orders_per_client * 9 // 10
+    Base.metadata.create_all(bind=engine)
+    print(f"🔥 {clients} client x {orders_per_client} đơn trên {PRODUCT_CODE}, tồn kho {initial_stock}, "
+          f"{shards} shard, giữ transaction {work_seconds * 1000:.0f}ms, database {engine.url.get_backend_name()}")
+
+    single, _, _ = run('Một dòng products', 0, clients, orders_per_client, initial_stock, work_seconds)
+    sharded, oversell, lost_updates = run(f'{shards} shard', shards, clients, orders_per_client, initial_stock,
+                                          work_seconds)
+    print(f"⚡ Chia shard: x{sharded / single:.2f} thông lượng")
+    assert oversell == 0 and lost_updates == 0, "Chia shard bán vượt tồn kho!"
+
+
+if __name__ == '__main__':
+    main()
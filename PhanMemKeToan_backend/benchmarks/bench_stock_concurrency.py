@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Benchmark: tạo đơn hàng đồng thời trên cùng một sản phẩm
+
+So sánh cách cũ (đọc tồn kho, kiểm tra trong Python, commit đơn hàng rồi commit
+trừ kho lần hai) với create_order hiện tại (UPDATE có điều kiện trong cùng
+transaction). In ra số đơn/giây và số lượng bán vượt tồn kho (oversell).
+
+Chạy: python benchmarks/bench_stock_concurrency.py [số_client] [số_đơn_mỗi_client] [tồn_kho]
+Dùng database trong DATABASE_URL (nên là PostgreSQL; SQLite tuần tự hóa mọi
+thao tác ghi nên không phản ánh đúng tranh chấp). Dữ liệu benchmark (sản phẩm
+và đơn hàng có mã bắt đầu bằng BENCH-STOCK) được xóa sau khi chạy.
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException
+from app.database import SessionLocal, engine, Base
+from app.models import Order, Product
+from app.schemas_fastapi import OrderCreate
+from app.api_fastapi.orders import create_order
+from app import sales_rollup
+
+PRODUCT_CODE = 'BENCH-STOCK'
+ORDER_PREFIX = 'BENCH-STOCK-'
+CUSTOMER = 'Khách hàng benchmark'
+ORDER_DATE = date(2000, 1, 1)
+
+
+def reset(initial_stock):
+    db = SessionLocal()
+    try:
+        cleanup(db)
+        db.add(Product(ma_sp=PRODUCT_CODE, ten_sp='Sản phẩm benchmark', so_luong=initial_stock, gia_chung=1000, trang_thai='Còn hàng'))
+        db.commit()
+    finally:
+        db.close()
+
+
+def cleanup(db):
+    orders = Order.ma_don_hang.like(f'{ORDER_PREFIX}%')
+    sales_rollup.apply_orders(db, orders, -1)
+    db.query(Order).filter(orders).delete(synchronize_session=False)
+    db.query(Product).filter(Product.ma_sp == PRODUCT_CODE).delete(synchronize_session=False)
+    db.commit()
+
+
+def legacy_order(db, code, quantity):
+    """Luồng cũ: kiểm tra tồn kho trong Python, commit đơn hàng, rồi commit trừ kho riêng"""
+    product = db.query(Product).filter(Product.ma_sp == PRODUCT_CODE).first()
+    if int(product.so_luong or 0) < quantity:
+        return False
+    db.add(Order(ma_don_hang=code, thong_tin_kh=CUSTOMER, sp_banggia=PRODUCT_CODE, ngay_tao=ORDER_DATE,
+                 so_luong=quantity, tong_tien=1000 * quantity, trang_thai='Hoàn thành'))
+    db.commit()
+    new_qty = max(int(product.so_luong or 0) - quantity, 0)
+    product.so_luong = new_qty
+    product.trang_thai = 'Còn hàng' if new_qty > 0 else 'Hết hàng'
+    db.commit()
+    return True
+
+
+def current_order(db, code, quantity):
+    """Luồng hiện tại: gọi thẳng create_order (một transaction, trừ kho có điều kiện)"""
+    payload = OrderCreate(ma_don_hang=code, thong_tin_kh=CUSTOMER, sp_banggia=PRODUCT_CODE, ngay_tao=ORDER_DATE,
+                          so_luong=quantity, tong_tien=0, trang_thai='Hoàn thành')
+    try:
+        create_order(payload, db)
+        return True
+    except HTTPException as e:
+        if e.status_code == 400:
+            return False
+        raise
+
+
+def client(place_order, client_id, orders_per_client):
+    accepted = rejected = errors = 0
+    for i in range(orders_per_client):
+        db = SessionLocal()
+        try:
+            if place_order(db, f'{ORDER_PREFIX}{client_id}-{i}', 1):
+                accepted += 1
+            else:
+                rejected += 1
+        except Exception:
+            db.rollback()
+            errors += 1
+        finally:
+            db.close()
+    return accepted, rejected, errors
+
+
+def run(name, place_order, clients, orders_per_client, initial_stock):
+    reset(initial_stock)
+    t0 = time.perf_counter()
+    # create_order in log debug cho từng đơn; bỏ qua để không ảnh hưởng thời gian đo
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            results = list(pool.map(lambda c: client(place_order, c, orders_per_client), range(clients)))
+    elapsed = time.perf_counter() - t0
+
+    accepted, rejected, errors = (sum(r[i] for r in results) for i in range(3))
+    db = SessionLocal()
+    try:
+        final_stock = db.query(Product.so_luong).filter(Product.ma_sp == PRODUCT_CODE).scalar()
+        stored = db.query(Order).filter(Order.ma_don_hang.like(f'{ORDER_PREFIX}%')).count()
+        cleanup(db)
+    finally:
+        db.close()
+    oversell = max(stored - initial_stock, 0)
+    # Tồn kho cuối phải bằng tồn kho ban đầu trừ số đơn đã lưu (mất cập nhật nếu khác)
+    lost_updates = (initial_stock - stored) - final_stock
+    total = clients * orders_per_client
+    print(f"{name:<24} {total / elapsed:9.1f} đơn/s  nhận {accepted:5d}  từ chối {rejected:5d}  lỗi {errors:3d}  "
+          f"tồn cuối {final_stock:5d}  oversell {oversell:4d}  lệch kho {lost_updates:4d}")
+    return oversell, lost_updates
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    orders_per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    initial_stock = int(sys.argv[3]) if len(sys.argv) > 3 else clients * orders_per_client // 2
+    Base.metadata.create_all(bind=engine)
+    print(f"🧵 {clients} client x {orders_per_client} đơn (mỗi đơn 1 sản phẩm), tồn kho ban đầu {initial_stock}, "
+          f"database {engine.url.get_backend_name()}")
+
+    run('Cũ (kiểm tra + 2 commit)', legacy_order, clients, orders_per_client, initial_stock)
+    oversell, lost_updates = run('UPDATE có điều kiện', current_order, clients, orders_per_client, initial_stock)
+    assert oversell == 0 and lost_updates == 0, "create_order bán vượt tồn kho!"
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,9 @@ This script initializes the database schema and creates initial data.
 """
 
 import os
+import re
 import sys
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 
 # Add the current directory to Python path
@@ -39,6 +40,45 @@ def setup_database():
         Base.metadata.create_all(bind=engine)
         print("✅ Database tables created successfully!")
         
+        # create_all does not add new columns to tables that already exist
+        print("🧱 Adding missing columns...")
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE invoices ADD COLUMN IF NOT EXISTS da_thanh_toan FLOAT DEFAULT 0"))
+            conn.execute(text("ALTER TABLE products ADD COLUMN IF NOT EXISTS so_shard INTEGER DEFAULT 0"))
+            conn.execute(text("ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP"))
+            conn.execute(text("ALTER TABLE reports ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP"))
+            for table in ('orders', 'invoices', 'payments'):
+                conn.execute(text(
+                    f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS account_id INTEGER "
+                    "REFERENCES accounts(id) ON DELETE SET NULL"
+                ))
+            conn.execute(text(
+                "ALTER TABLE debts ADD COLUMN IF NOT EXISTS account_id INTEGER "
+                "REFERENCES accounts(id) ON DELETE CASCADE"
+            ))
+        print("✅ Columns up to date!")
+        
+        # debts.customer_name becomes unique: merge duplicate rows first (amounts are
+        # recomputed from invoices below), then drop the old non-unique index
+        with engine.begin() as conn:
+            conn.execute(text(
+                "DELETE FROM debts d USING debts keep "
+                "WHERE d.customer_name = keep.customer_name AND d.id > keep.id "
+                "AND d.account_id IS NULL AND keep.account_id IS NULL"
+            ))
+            conn.execute(text("DROP INDEX IF EXISTS ix_debts_customer_name"))
+            # debts is now unique per account_id, or per customer_name only for rows without an account
+            conn.execute(text("DROP INDEX IF EXISTS uq_debts_customer_name"))
+            # Covered by ix_invoices_nguoi_mua_ngay_hd (nguoi_mua, ngay_hd) INCLUDE (tong_tien, da_thanh_toan)
+            conn.execute(text("DROP INDEX IF EXISTS ix_invoices_nguoi_mua_tong_tien"))
+        
+        # create_all does not add new indexes to tables that already exist
+        print("📇 Creating missing indexes...")
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+        print("✅ Indexes up to date!")
+        
         # Create session
         SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
         db = SessionLocal()
@@ -126,6 +166,58 @@ def setup_database():
             db.commit()
             print("✅ Sample accounts created")
         
+        # Backfill invoices.da_thanh_toan from the legacy status strings
+        unbackfilled = (Invoice.da_thanh_toan.is_(None)) | (Invoice.da_thanh_toan == 0)
+        paid = db.query(Invoice).filter(unbackfilled, Invoice.trang_thai == 'Đã thanh toán').update(
+            {Invoice.da_thanh_toan: Invoice.tong_tien}, synchronize_session=False
+        )
+        # Partial payments were stored as "Đã thanh toán X VND"
+        from app.payments import PARTIAL_STATUS
+        partial = db.query(Invoice).filter(unbackfilled, Invoice.trang_thai.like('Đã thanh toán % VND')).all()
+        for invoice in partial:
+            match = re.fullmatch(r'Đã thanh toán ([\d,]+) VND', invoice.trang_thai or '')
+            if match:
+                invoice.da_thanh_toan = min(float(match.group(1).replace(',', '')), invoice.tong_tien or 0)
+                invoice.trang_thai = PARTIAL_STATUS
+        db.commit()
+        if paid or partial:
+            print(f"✅ Paid amounts backfilled ({paid} paid, {len(partial)} partial invoices)")
+        
+        # Recompute the debts table from invoices (repairs rows merged above)
+        from app import debts
+        debts.recompute_all(db)
+        db.commit()
+        print("✅ Debts recomputed from invoices")
+        
+        # Document number series continue from the highest invoice/order numbers in use
+        from app import document_numbers
+        for series in document_numbers.DEFAULTS:
+            document_numbers.ensure_series(db, series)
+        db.commit()
+        print("✅ Document number series ready")
+        
+        # Start the stock ledger from the current quantities of products without movements
+        from app import stock_ledger
+        opened = stock_ledger.open_balances(db)
+        db.commit()
+        if opened:
+            print(f"✅ Stock ledger opened for {opened} products")
+        
+        # Link existing orders/invoices to customer accounts (batched; rebuilds the rollup if anything changed)
+        print("🔗 Linking orders/invoices to customer accounts...")
+        from app import customers
+        linked = customers.backfill(db)
+        print(f"✅ Customer accounts linked ({linked['orders']} orders, {linked['invoices']} invoices, "
+              f"{linked['payments']} payments)")
+        
+        # Build the daily sales rollup for databases created before it existed
+        if db.query(DailySalesSummary).count() == 0 and db.query(Invoice).count() + db.query(Order).count() > 0:
+            print("📊 Building daily sales rollup...")
+            from app import sales_rollup
+            sales_rollup.rebuild(db)
+            db.commit()
+            print("✅ Daily sales rollup built")
+        
         db.close()
         
         print("🎉 Database setup completed successfully!")
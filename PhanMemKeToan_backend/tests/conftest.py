@@ -0,0 +1,89 @@
+"""
+Test fixtures for PhanMemKeToan backend
+
+Ứng dụng chạy trên PostgreSQL; các test dùng một file SQLite tạm để chạy không cần
+server database. Các hàm PostgreSQL mà truy vấn dùng (date_trunc, greatest, least)
+được đăng ký cho SQLite, CAST(... AS DATE) được bỏ qua (SQLite lưu ngày dạng chuỗi
+ISO). SQLite bỏ qua FOR UPDATE nên các test chỉ kiểm tra kết quả, không kiểm tra
+tranh chấp khóa.
+"""
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+_db_file = os.path.join(tempfile.mkdtemp(prefix='pmkt-tests-'), 'test.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_db_file}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy import event, Date
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.elements import Cast
+from fastapi.testclient import TestClient
+
+from app.database import engine, Base, SessionLocal
+
+
+def _date_trunc(unit, value):
+    day = date.fromisoformat(str(value)[:10])
+    if unit == 'week':
+        day -= timedelta(days=day.weekday())
+    elif unit == 'month':
+        day = day.replace(day=1)
+    elif unit == 'quarter':
+        day = day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+    elif unit == 'year':
+        day = day.replace(month=1, day=1)
+    return day.isoformat()
+
+
+@event.listens_for(engine, 'connect')
+def _register_functions(dbapi_connection, connection_record):
+    dbapi_connection.create_function('date_trunc', 2, _date_trunc)
+    dbapi_connection.create_function('greatest', 2, max)
+    dbapi_connection.create_function('least', 2, min)
+
+
+@compiles(Cast, 'sqlite')
+def _cast(element, compiler, **kw):
+    if isinstance(element.type, Date):
+        return compiler.process(element.clause, **kw)
+    return compiler.visit_cast(element, **kw)
+
+
+# Import sau khi đăng ký hàm: app.main mở kết nối khi được import
+from app import models  # noqa: E402,F401 (đăng ký các bảng vào Base.metadata)
+from app import document_numbers  # noqa: E402
+from app.catalog import catalog_cache  # noqa: E402
+from app.report_cache import report_cache  # noqa: E402
+from app.main import app  # noqa: E402
+
+
+Base.metadata.create_all(bind=engine)
+
+
+@pytest.fixture(autouse=True)
+def _fresh_database():
+    """Mỗi test bắt đầu với database trống và cache rỗng"""
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    report_cache.clear()
+    catalog_cache.clear()
+    document_numbers._blocks.clear()
+    yield
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def client():
+    return TestClient(app)
@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from app import idempotency
+from app.models import IdempotencyKey, Order, Product
+
+ORDER = {
+    'ma_don_hang': 'O1', 'thong_tin_kh': 'kh', 'sp_banggia': 'A', 'ngay_tao': '2026-01-01',
+    'so_luong': 3, 'tong_tien': 0, 'trang_thai': 'Hoàn thành',
+}
+
+
+def _product(db, so_luong=10):
+    db.add(Product(ma_sp='A', ten_sp='a', so_luong=so_luong, gia_chung=10))
+    db.commit()
+
+
+def _stock(db):
+    db.expire_all()
+    return db.query(Product.so_luong).filter(Product.ma_sp == 'A').scalar()
+
+
+def test_replay_returns_stored_response_without_running_again(client, db):
+    _product(db)
+    headers = {'Idempotency-Key': 'order-1'}
+
+    first = client.post('/api/orders/', json=ORDER, headers=headers)
+    second = client.post('/api/orders/', json=ORDER, headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json()
+    assert first.headers.get(idempotency.REPLAYED_HEADER) is None
+    assert second.headers.get(idempotency.REPLAYED_HEADER) == 'true'
+    assert db.query(Order).count() == 1
+    assert _stock(db) == 7
+
+
+def test_same_key_with_different_body_is_rejected(client, db):
+    _product(db)
+    headers = {'Idempotency-Key': 'order-1'}
+    client.post('/api/orders/', json=ORDER, headers=headers)
+
+    response = client.post('/api/orders/', json={**ORDER, 'so_luong': 4}, headers=headers)
+
+    assert response.status_code == 422
+    assert db.query(Order).count() == 1
+    assert _stock(db) == 7
+
+
+def test_client_errors_are_replayed(client, db):
+    _product(db)
+    headers = {'Idempotency-Key': 'too-many'}
+
+    first = client.post('/api/orders/', json={**ORDER, 'so_luong': 99}, headers=headers)
+    second = client.post('/api/orders/', json={**ORDER, 'so_luong': 99}, headers=headers)
+
+    assert first.status_code == second.status_code == 400
+    assert second.headers.get(idempotency.REPLAYED_HEADER) == 'true'
+
+
+def test_requests_without_key_are_not_deduplicated(client, db):
+    _product(db)
+
+    client.post('/api/orders/', json=ORDER)
+    response = client.post('/api/orders/', json=ORDER)
+
+    assert response.status_code == 400  # mã đơn hàng đã tồn tại
+    assert db.query(Order).count() == 1
+
+
+def test_key_in_progress_returns_conflict(client, db):
+    _product(db)
+    key = idempotency._sha256(b'order-1')
+    body = client.build_request('POST', '/api/orders/', json=ORDER).content
+    assert idempotency.claim(key, idempotency.fingerprint('POST', '/api/orders/', b'', body)) is not None
+
+    response = client.post('/api/orders/', json=ORDER, headers={'Idempotency-Key': 'order-1'})
+
+    assert response.status_code == 409
+    assert db.query(Order).count() == 0
+
+
+def test_lost_request_is_taken_over_after_lease_expires(client, db):
+    _product(db)
+    key = idempotency._sha256(b'order-1')
+    body = client.build_request('POST', '/api/orders/', json=ORDER).content
+    stale_claim = idempotency.claim(key, idempotency.fingerprint('POST', '/api/orders/', b'', body))
+    # Process giữ chỗ đã chết trước khi lưu phản hồi
+    db.execute(update(IdempotencyKey).values(lease_expires_at=datetime.now() - timedelta(seconds=1)))
+    db.commit()
+
+    response = client.post('/api/orders/', json=ORDER, headers={'Idempotency-Key': 'order-1'})
+    assert response.status_code == 200
+
+    # Lần giữ chỗ cũ không ghi đè phản hồi của lần thực hiện mới
+    idempotency.store(key, stale_claim, 500, 'application/json', b'{}')
+    replay = client.post('/api/orders/', json=ORDER, headers={'Idempotency-Key': 'order-1'})
+    assert replay.headers.get(idempotency.REPLAYED_HEADER) == 'true'
+    assert replay.json() == response.json()
+    assert _stock(db) == 7
+
+
+def test_expired_key_can_be_reused(client, db):
+    _product(db)
+    headers = {'Idempotency-Key': 'order-1'}
+    client.post('/api/orders/', json=ORDER, headers=headers)
+    db.execute(update(IdempotencyKey).values(expires_at=datetime.now() - timedelta(seconds=1)))
+    db.commit()
+
+    response = client.post('/api/orders/', json={**ORDER, 'ma_don_hang': 'O2'}, headers=headers)
+
+    assert response.status_code == 200
+    assert response.headers.get(idempotency.REPLAYED_HEADER) is None
+    assert db.query(Order).count() == 2
+
+
+def test_read_endpoints_are_not_stored(client, db):
+    headers = {'Idempotency-Key': 'search-1'}
+
+    first = client.post('/api/invoices/search', json={}, headers=headers)
+    second = client.post('/api/invoices/search', json={'invoiceNumber': 'x'}, headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert second.headers.get(idempotency.REPLAYED_HEADER) is None
+    assert db.query(IdempotencyKey).count() == 0
+
+
+def test_order_item_updates_are_covered(client, db):
+    _product(db)
+    order_id = client.post('/api/orders/', json=ORDER).json()['id']
+    headers = {'Idempotency-Key': 'items-1'}
+    body = {'items': [{'ma_sp': 'A', 'so_luong': 1}]}
+
+    client.put(f'/api/orders/{order_id}/items', json=body, headers=headers)
+    replay = client.put(f'/api/orders/{order_id}/items', json=body, headers=headers)
+
+    assert replay.headers.get(idempotency.REPLAYED_HEADER) == 'true'
+    assert _stock(db) == 9
@@ -0,0 +1,61 @@
+from app.models import OrderItem, Product
+
+ORDER = {
+    'ma_don_hang': 'DH1', 'thong_tin_kh': 'kh', 'sp_banggia': 'A', 'ngay_tao': '2026-01-01',
+    'so_luong': 2, 'tong_tien': 0, 'trang_thai': 'Hoàn thành',
+}
+
+
+def _products(client):
+    client.post('/api/products/', json={'ma_sp': 'A', 'ten_sp': 'A', 'so_luong': 10, 'gia_chung': 100})
+    client.post('/api/products/', json={'ma_sp': 'B', 'ten_sp': 'B', 'so_luong': 5, 'gia_chung': 50})
+
+
+def _stock(db):
+    db.expire_all()
+    return {p.ma_sp: p.so_luong for p in db.query(Product)}
+
+
+def test_single_line_order_becomes_multi_line_through_items_endpoint(client, db):
+    _products(client)
+    order_id = client.post('/api/orders/', json=ORDER).json()['id']
+    assert _stock(db) == {'A': 8, 'B': 5}
+
+    response = client.put(f'/api/orders/{order_id}/items', json={'items': [
+        {'ma_sp': 'A', 'so_luong': 1}, {'ma_sp': 'B', 'so_luong': 2},
+    ]})
+
+    assert response.status_code == 200, response.text
+    assert response.json()['tong_tien'] == 200
+    assert _stock(db) == {'A': 9, 'B': 3}
+
+    client.delete(f'/api/orders/{order_id}')
+    assert _stock(db) == {'A': 10, 'B': 5}
+    assert db.query(OrderItem).count() == 0
+
+
+def test_loose_item_endpoint_is_gone(client, db):
+    _products(client)
+    order_id = client.post('/api/orders/', json=ORDER).json()['id']
+
+    response = client.post('/api/orders/items', json={'order_id': order_id, 'product_id': 2, 'so_luong': 1})
+
+    assert response.status_code in (404, 405)
+    assert db.query(OrderItem).count() == 0
+
+
+def test_manual_code_in_series_format_is_rejected(client, db):
+    _products(client)
+
+    manual = client.post('/api/orders/', json={**ORDER, 'ma_don_hang': 'DH-000005'})
+    bulk = client.post('/api/orders/bulk', json={'orders': [{**ORDER, 'ma_don_hang': 'DH-000006'}], 'allow_partial': True})
+    invoice = client.post('/api/invoices/', json={
+        'so_hd': 'HĐ-0001', 'ngay_hd': '2026-01-01', 'nguoi_mua': 'kh', 'tong_tien': 10, 'loai_hd': 'ban',
+    })
+
+    assert manual.status_code == invoice.status_code == 400
+    assert bulk.json()['errors'][0]['ma_don_hang'] == 'DH-000006'
+    # Các số đó vẫn chỉ được cấp tự động
+    auto = [client.post('/api/orders/', json={**ORDER, 'ma_don_hang': ''}).json()['ma_don_hang'] for _ in range(2)]
+    assert auto == ['DH-000001', 'DH-000002']
+    assert client.post('/api/orders/', json={**ORDER, 'ma_don_hang': 'DH-A5'}).status_code == 200
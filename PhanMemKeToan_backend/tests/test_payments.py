@@ -0,0 +1,188 @@
+from sqlalchemy import func
+
+from app import debts
+from app.models import Debt, Invoice, Payment, PaymentAllocation
+
+
+def _invoice(client, so_hd, ngay_hd, tong_tien, trang_thai='Chưa thanh toán', nguoi_mua='A'):
+    response = client.post('/api/invoices/', json={
+        'so_hd': so_hd, 'ngay_hd': ngay_hd, 'nguoi_mua': nguoi_mua, 'tong_tien': tong_tien,
+        'loai_hd': 'ban', 'trang_thai': trang_thai,
+    })
+    assert response.status_code == 200, response.text
+    return response.json()['id']
+
+
+def _paid(db):
+    db.expire_all()
+    return {i.so_hd: (i.da_thanh_toan, i.trang_thai) for i in db.query(Invoice)}
+
+
+def _debt(db):
+    db.expire_all()
+    debt = db.query(Debt).one()
+    return float(debt.total_debt), float(debt.paid_amount), float(debt.remaining_debt)
+
+
+def _debt_matches_recompute(db):
+    """Dòng debts cập nhật theo chênh lệch khớp với tính lại từ hóa đơn"""
+    expected = _debt(db)
+    debts.recompute_all(db)
+    db.commit()
+    return _debt(db) == expected
+
+
+def test_payment_allocates_oldest_invoice_first(client, db):
+    _invoice(client, 'H1', '2025-01-03', 100)
+    _invoice(client, 'H2', '2025-01-01', 200)
+    _invoice(client, 'H3', '2025-01-02', 300)
+
+    response = client.post('/api/payments/', json={'customer_name': 'A', 'so_tien': 250})
+
+    assert response.status_code == 200, response.text
+    data = response.json()['data']
+    assert data['allocated_amount'] == 250
+    assert data['unallocated_amount'] == 0
+    assert _paid(db) == {
+        'H2': (200, 'Đã thanh toán'),
+        'H3': (50, 'Thanh toán một phần'),
+        'H1': (0, 'Chưa thanh toán'),
+    }
+    assert _debt(db) == (600, 250, 350)
+
+
+def test_payment_surplus_is_kept_unallocated(client, db):
+    _invoice(client, 'H1', '2025-01-01', 100)
+    _invoice(client, 'H2', '2025-01-02', 200)
+
+    data = client.post('/api/payments/', json={'customer_name': 'A', 'so_tien': 500}).json()['data']
+
+    assert data['allocated_amount'] == 300
+    assert data['unallocated_amount'] == 200
+    assert _paid(db) == {'H1': (100, 'Đã thanh toán'), 'H2': (200, 'Đã thanh toán')}
+    assert _debt(db) == (300, 300, 0)
+
+
+def test_negative_payment_reverses_newest_invoice_first(client, db):
+    _invoice(client, 'H1', '2025-01-01', 100)
+    _invoice(client, 'H2', '2025-01-02', 200)
+    client.post('/api/payments/', json={'customer_name': 'A', 'so_tien': 300})
+
+    client.post('/api/payments/', json={'customer_name': 'A', 'so_tien': -150})
+
+    assert _paid(db) == {'H1': (100, 'Đã thanh toán'), 'H2': (50, 'Thanh toán một phần')}
+    assert _debt(db) == (300, 150, 150)
+
+
+def test_payment_status_records_only_the_increase(client, db):
+    _invoice(client, 'H1', '2025-01-01', 100)
+    _invoice(client, 'H2', '2025-01-02', 200)
+    _invoice(client, 'H3', '2025-01-03', 50, trang_thai='Đã thanh toán')
+
+    first = client.put('/api/reports/payment-status', json={'customer_name': 'A', 'paid_amount': 170})
+    repeat = client.put('/api/reports/payment-status', json={'customer_name': 'A', 'paid_amount': 170})
+
+    assert first.json()['data']['paid_amount'] == 170
+    assert repeat.json()['data']['paid_amount'] == 170
+    # H3 đã thanh toán trực tiếp (50): chỉ phần tăng thêm 120 được ghi thành khoản thanh toán
+    assert [p.so_tien for p in db.query(Payment)] == [120]
+    assert _paid(db)['H1'] == (100, 'Đã thanh toán')
+    assert _paid(db)['H2'] == (20, 'Thanh toán một phần')
+
+
+def test_payment_status_does_not_replay_surplus(client, db):
+    _invoice(client, 'H1', '2025-01-01', 100)
+
+    client.put('/api/reports/payment-status', json={'customer_name': 'A', 'paid_amount': 400})
+    client.put('/api/reports/payment-status', json={'customer_name': 'A', 'paid_amount': 400})
+    client.put('/api/reports/payment-status', json={'customer_name': 'A', 'paid_amount': 450})
+
+    assert [p.so_tien for p in db.query(Payment).order_by(Payment.id)] == [400, 50]
+    assert _debt(db) == (100, 100, 0)
+
+
+def test_payment_without_invoices_is_rejected(client):
+    response = client.post('/api/payments/', json={'customer_name': 'B', 'so_tien': 10})
+
+    assert response.status_code == 404
+
+
+def _allocations(db):
+    """[(so_hd, tổng phân bổ)] của các hóa đơn có phân bổ"""
+    db.expire_all()
+    rows = (
+        db.query(Invoice.so_hd, func.sum(PaymentAllocation.so_tien))
+        .join(PaymentAllocation, PaymentAllocation.invoice_id == Invoice.id)
+        .group_by(Invoice.so_hd)
+        .order_by(Invoice.so_hd)
+    )
+    return [(so_hd, total) for so_hd, total in rows if total]
+
+
+def test_lowering_invoice_total_moves_overpayment_to_next_invoice(client, db):
+    first = _invoice(client, 'H1', '2025-01-01', 100)
+    _invoice(client, 'H2', '2025-01-02', 200)
+    client.post('/api/payments/', json={'customer_name': 'A', 'so_tien': 150})
+
+    client.put(f'/api/invoices/{first}', json={'tong_tien': 60})
+
+    assert _allocations(db) == [('H1', 60), ('H2', 90)]
+    assert _paid(db) == {'H1': (60, 'Đã thanh toán'), 'H2': (90, 'Thanh toán một phần')}
+    assert _debt(db) == (260, 150, 110)
+    assert _debt_matches_recompute(db)
+
+
+def test_unpaid_status_is_recomputed_from_allocations(client, db):
+    first = _invoice(client, 'H1', '2025-01-01', 100)
+    client.post('/api/payments/', json={'customer_name': 'A', 'so_tien': 40})
+
+    client.put(f'/api/invoices/{first}', json={'trang_thai': 'Đã thanh toán'})
+    assert _paid(db) == {'H1': (100, 'Đã thanh toán')}
+
+    # Bỏ đánh dấu đã thanh toán: số đã trả về lại phần được phân bổ từ payments
+    client.put(f'/api/invoices/{first}', json={'trang_thai': 'Chưa thanh toán'})
+    assert _paid(db) == {'H1': (40, 'Thanh toán một phần')}
+    assert _debt(db) == (100, 40, 60)
+    assert _debt_matches_recompute(db)
+
+
+def test_surplus_released_by_edit_stays_on_payment_when_nothing_is_owed(client, db):
+    first = _invoice(client, 'H1', '2025-01-01', 100)
+    client.post('/api/payments/', json={'customer_name': 'A', 'so_tien': 100})
+
+    client.put(f'/api/invoices/{first}', json={'tong_tien': 30})
+    assert _allocations(db) == [('H1', 30)]
+
+    # Hóa đơn mới nhận phần thanh toán thừa khi sửa/xóa hóa đơn khác
+    second = _invoice(client, 'H2', '2025-01-02', 50)
+    client.delete(f'/api/invoices/{second}')
+    third = _invoice(client, 'H3', '2025-01-03', 50)
+    client.put(f'/api/invoices/{third}', json={'tong_tien': 80})
+
+    assert _allocations(db) == [('H1', 30), ('H3', 70)]
+    assert _paid(db)['H3'] == (70, 'Thanh toán một phần')
+
+
+def test_deleting_invoice_returns_its_allocation_to_fifo(client, db):
+    first = _invoice(client, 'H1', '2025-01-01', 100)
+    _invoice(client, 'H2', '2025-01-02', 200)
+    client.post('/api/payments/', json={'customer_name': 'A', 'so_tien': 100})
+
+    client.delete(f'/api/invoices/{first}')
+
+    assert _allocations(db) == [('H2', 100)]
+    assert _debt(db) == (200, 100, 100)
+
+
+def test_unknown_account_id_is_rejected(client, db):
+    _invoice(client, 'H1', '2025-01-01', 100)
+
+    payment = client.post('/api/payments/', json={'customer_name': 'A', 'so_tien': 10, 'account_id': 999})
+    invoice = client.post('/api/invoices/', json={
+        'so_hd': 'H2', 'ngay_hd': '2025-01-02', 'nguoi_mua': 'A', 'tong_tien': 10, 'account_id': 999,
+    })
+
+    assert payment.status_code == invoice.status_code == 422
+    assert 'account_id=999' in payment.json()['detail']
+    assert db.query(Payment).count() == 0
+    assert db.query(Invoice).count() == 1
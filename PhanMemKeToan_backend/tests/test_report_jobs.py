@@ -0,0 +1,62 @@
+import json
+from datetime import date, datetime, timedelta
+
+from app import report_jobs
+from app.models import Report
+
+
+def _job(db, trang_thai=report_jobs.JOB_PENDING, lease_expires_at=None):
+    report = Report(ten_bao_cao='r', loai_bao_cao='revenue', tu_ngay=date(2026, 1, 1), den_ngay=date(2026, 1, 31),
+                    du_lieu=json.dumps({'params': {}}), trang_thai=trang_thai, lease_expires_at=lease_expires_at)
+    db.add(report)
+    db.commit()
+    return report.id
+
+
+def _builder(calls):
+    def build(db, report, params):
+        calls.append(report.id)
+        return {'rows': []}, {'tong_doanh_thu': 5}
+    return build
+
+
+def test_resume_skips_jobs_running_under_a_live_lease(db, monkeypatch):
+    now = datetime.now()
+    pending = _job(db)
+    live = _job(db, report_jobs.JOB_RUNNING, now + timedelta(minutes=5))
+    expired = _job(db, report_jobs.JOB_RUNNING, now - timedelta(seconds=1))
+    _job(db, report_jobs.JOB_COMPLETED)
+    submitted = []
+    monkeypatch.setattr(report_jobs, 'submit', lambda report_id, builder: submitted.append(report_id))
+
+    assert report_jobs.resume_pending(None) == 2
+    assert sorted(submitted) == sorted([pending, expired])
+    assert live not in submitted
+
+
+def test_job_runs_once_when_queued_twice(db):
+    report_id = _job(db)
+    calls = []
+
+    report_jobs._run(report_id, _builder(calls))
+    report_jobs._run(report_id, _builder(calls))
+
+    assert calls == [report_id]
+    db.expire_all()
+    report = db.get(Report, report_id)
+    assert report.trang_thai == report_jobs.JOB_COMPLETED
+    assert report.tong_doanh_thu == 5
+    assert report.lease_expires_at is None
+
+
+def test_worker_that_lost_its_lease_does_not_overwrite_result(db):
+    report_id = _job(db)
+    stale_lease = report_jobs._claim(db, report_id)
+    db.get(Report, report_id).lease_expires_at = datetime.now() - timedelta(seconds=1)
+    db.commit()
+
+    report_jobs._run(report_id, _builder([]))
+
+    assert report_jobs._finish(db, report_id, stale_lease, {'trang_thai': report_jobs.JOB_FAILED}) is False
+    db.expire_all()
+    assert db.get(Report, report_id).trang_thai == report_jobs.JOB_COMPLETED
@@ -0,0 +1,42 @@
+from app.models import Account
+
+
+def _invoice(client, so_hd, ngay_hd, tong_tien, nguoi_mua='A'):
+    response = client.post('/api/invoices/', json={
+        'so_hd': so_hd, 'ngay_hd': ngay_hd, 'nguoi_mua': nguoi_mua, 'tong_tien': tong_tien,
+        'loai_hd': 'ban', 'trang_thai': 'Chưa thanh toán',
+    })
+    assert response.status_code == 200, response.text
+
+
+def test_debt_by_date_only_counts_invoices_in_range(client):
+    _invoice(client, 'H1', '2025-12-20', 100)
+    _invoice(client, 'H2', '2026-01-10', 200)
+    _invoice(client, 'H3', '2026-02-05', 400)
+
+    response = client.get('/api/reports/debt-by-date', params={'from_date': '2026-01-01', 'to_date': '2026-01-31'})
+
+    assert response.status_code == 200, response.text
+    assert [(row['customer_name'], row['total_debt']) for row in response.json()['data']] == [('A', 200)]
+
+
+def test_debt_by_date_rejects_reversed_range(client):
+    response = client.get('/api/reports/debt-by-date', params={'from_date': '2026-02-01', 'to_date': '2026-01-01'})
+
+    assert response.status_code == 400
+
+
+def test_debt_aging_filters_by_exact_customer_or_account(client, db):
+    account = Account(ten_tk='Anh')
+    db.add(account)
+    db.commit()
+    _invoice(client, 'H1', '2026-01-10', 100, nguoi_mua='An')
+    _invoice(client, 'H2', '2026-01-10', 200, nguoi_mua='Anh')
+
+    def customers(**params):
+        response = client.get('/api/reports/debt-aging', params={'as_of': '2026-01-31', **params})
+        assert response.status_code == 200, response.text
+        return [(row['customer_name'], row['total_outstanding']) for row in response.json()['data']]
+
+    assert customers(customer='An') == [('An', 100)]
+    assert customers(account_id=account.id) == [('Anh', 200)]
@@ -0,0 +1,101 @@
+from app import sales_rollup
+from app.models import DailySalesSummary
+
+COLUMNS = sales_rollup.INVOICE_COLUMNS + sales_rollup.ORDER_COLUMNS
+
+
+def _snapshot(db):
+    """{(ngày, mã SP): các cột tổng hợp} của các dòng khác 0"""
+    db.expire_all()
+    rows = {
+        (row.ngay.isoformat(), row.ma_sp): tuple(round(float(getattr(row, c) or 0), 6) for c in COLUMNS)
+        for row in db.query(DailySalesSummary)
+    }
+    return {key: values for key, values in rows.items() if any(values)}
+
+
+def _assert_matches_rebuild(db):
+    incremental = _snapshot(db)
+    sales_rollup.rebuild(db)
+    db.commit()
+    assert incremental == _snapshot(db)
+    return incremental
+
+
+def _setup_catalog(client):
+    client.post('/api/products/', json={'ma_sp': 'SP1', 'ten_sp': 'Bàn', 'so_luong': 100, 'gia_chung': 10})
+    client.post('/api/products/', json={'ma_sp': 'SP2', 'ten_sp': 'Ghế', 'so_luong': 100, 'gia_chung': 4})
+
+
+def _order(client, code, sp, so_luong, ngay_tao='2024-01-01', customer='A', **extra):
+    response = client.post('/api/orders/', json={
+        'ma_don_hang': code, 'thong_tin_kh': customer, 'sp_banggia': sp, 'so_luong': so_luong,
+        'ngay_tao': ngay_tao, 'tong_tien': 0, 'trang_thai': 'Hoàn thành', **extra,
+    })
+    assert response.status_code == 200, response.text
+    return response.json()['id']
+
+
+def _invoice(client, so_hd, tong_tien, ngay_hd='2024-01-01', customer='A', trang_thai='Chưa thanh toán'):
+    response = client.post('/api/invoices/', json={
+        'so_hd': so_hd, 'ngay_hd': ngay_hd, 'nguoi_mua': customer, 'tong_tien': tong_tien,
+        'loai_hd': 'ban', 'trang_thai': trang_thai,
+    })
+    assert response.status_code == 200, response.text
+    return response.json()['id']
+
+
+def test_order_create_update_delete_keeps_rollup_in_step(client, db):
+    _setup_catalog(client)
+    first = _order(client, 'DH1', 'SP1', 2)
+    second = _order(client, 'DH2', 'SP2', 3, ngay_tao='2024-01-02')
+
+    assert _assert_matches_rebuild(db) == {
+        ('2024-01-01', 'SP1'): (0, 0, 0, 0, 1, 2, 20),
+        ('2024-01-02', 'SP2'): (0, 0, 0, 0, 1, 3, 12),
+    }
+
+    client.put(f'/api/orders/{first}', json={'sp_banggia': 'SP2', 'ngay_tao': '2024-01-02'})
+    _assert_matches_rebuild(db)
+    client.put(f'/api/orders/{second}', json={'trang_thai': 'Đã hủy'})
+    _assert_matches_rebuild(db)
+    client.put(f'/api/orders/{second}', json={'trang_thai': 'Hoàn thành', 'so_luong': 1})
+    _assert_matches_rebuild(db)
+    client.delete(f'/api/orders/{first}')
+
+    assert _assert_matches_rebuild(db) == {('2024-01-02', 'SP2'): (0, 0, 0, 0, 1, 1, 4)}
+
+
+def test_invoice_update_and_delete_keep_rollup_in_step(client, db):
+    _setup_catalog(client)
+    _order(client, 'DH1', 'SP1', 1, customer='A')
+    _order(client, 'DH2', 'SP2', 1, customer='B')
+    invoice = _invoice(client, 'HĐ1', 100, customer='A')
+    other = _invoice(client, 'HĐ2', 40, customer='B', trang_thai='Đã thanh toán')
+
+    assert _assert_matches_rebuild(db)[('2024-01-01', 'SP1')][:4] == (100, 0, 1, 1)
+
+    client.put(f'/api/invoices/{invoice}', json={'tong_tien': 80, 'trang_thai': 'Đã thanh toán'})
+    _assert_matches_rebuild(db)
+    # Đổi người mua: doanh thu chuyển sang sản phẩm trong đơn hàng của người mua mới
+    client.put(f'/api/invoices/{invoice}', json={'nguoi_mua': 'B', 'ngay_hd': '2024-01-03'})
+    snapshot = _assert_matches_rebuild(db)
+    assert snapshot[('2024-01-03', 'SP2')][:4] == (80, 80, 1, 1)
+    client.delete(f'/api/invoices/{other}')
+    client.delete(f'/api/invoices/{invoice}')
+
+    assert all(values[:4] == (0, 0, 0, 0) for values in _assert_matches_rebuild(db).values())
+
+
+def test_first_order_of_customer_takes_over_invoice_attribution(client, db):
+    _setup_catalog(client)
+    _invoice(client, 'HĐ1', 50, customer='C')
+    assert ('2024-01-01', '') in _assert_matches_rebuild(db)
+
+    order = _order(client, 'DH1', 'SP1', 1, customer='C')
+    snapshot = _assert_matches_rebuild(db)
+    assert ('2024-01-01', '') not in snapshot
+    assert snapshot[('2024-01-01', 'SP1')][:4] == (50, 0, 1, 1)
+
+    client.delete(f'/api/orders/{order}')
+    assert ('2024-01-01', '') in _assert_matches_rebuild(db)
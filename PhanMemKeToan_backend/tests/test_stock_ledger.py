@@ -0,0 +1,122 @@
+from datetime import datetime
+
+import pytest
+
+from app import stock_ledger
+from app.models import Product, StockCheckpoint, StockMovement
+
+DATES = ['2025-12-31', '2026-01-01', '2026-01-14', '2026-01-31', '2026-02-01', '2026-02-28', '2026-12-31']
+EXPECTED = {
+    '2025-12-31': {'A': 0, 'B': 0},
+    '2026-01-01': {'A': 10, 'B': 5},
+    '2026-01-14': {'A': 10, 'B': 5},
+    '2026-01-31': {'A': 7, 'B': 5},
+    '2026-02-01': {'A': 5, 'B': 5},
+    '2026-02-28': {'A': 5, 'B': 9},
+    '2026-12-31': {'A': 12, 'B': 9},
+}
+
+
+@pytest.fixture
+def ledger(db):
+    """Hai sản phẩm với các movement từ tháng 1 tới tháng 3/2026; trả về {ma_sp: product_id}"""
+    a = Product(ma_sp='A', ten_sp='A', so_luong=12)
+    b = Product(ma_sp='B', ten_sp='B', so_luong=9, nhom_sp='g')
+    db.add_all([a, b])
+    db.flush()
+    for product, delta, created_at in [
+        (a, 10, '2026-01-01 08:00'),
+        (b, 5, '2026-01-01 09:00'),
+        (a, -3, '2026-01-15 10:00'),
+        (a, -2, '2026-02-01 00:00'),
+        (b, 4, '2026-02-10 12:00'),
+        (a, 7, '2026-03-01 12:00'),
+    ]:
+        db.add(StockMovement(product_id=product.id, delta=delta, source_type=stock_ledger.SOURCE_PRODUCT,
+                             source_id=product.id, created_at=datetime.fromisoformat(created_at)))
+        db.flush()
+    db.commit()
+    return {'A': a.id, 'B': b.id}
+
+
+def _as_of(client, ngay, **params):
+    response = client.get('/api/stock/as-of', params={'ngay': ngay, **params})
+    assert response.status_code == 200, response.text
+    return {p['ma_sp']: p['so_luong'] for p in response.json()['products']}
+
+
+def _movement_ids(db):
+    return [m.id for m in db.query(StockMovement).order_by(StockMovement.id)]
+
+
+def test_stock_as_of_without_checkpoints(client, ledger):
+    assert {ngay: _as_of(client, ngay) for ngay in DATES} == EXPECTED
+
+
+def test_stock_as_of_starts_from_checkpoint_before_the_date(client, db, ledger):
+    ids = _movement_ids(db)
+    closed = datetime(2026, 1, 31, 23, 0)
+    db.add(StockCheckpoint(product_id=ledger['A'], movement_id=ids[2], balance=7, created_at=closed))
+    db.add(StockCheckpoint(product_id=ledger['B'], movement_id=ids[1], balance=5, created_at=closed))
+    db.commit()
+
+    assert {ngay: _as_of(client, ngay) for ngay in DATES} == EXPECTED
+
+
+def test_stock_as_of_uses_checkpoint_balance(client, db, ledger):
+    ids = _movement_ids(db)
+    # Checkpoint có số dư khác tổng movement: các ngày sau khi chốt phải đọc từ checkpoint
+    db.add(StockCheckpoint(product_id=ledger['A'], movement_id=ids[2], balance=100,
+                           created_at=datetime(2026, 1, 31, 23, 0)))
+    db.commit()
+
+    assert _as_of(client, '2026-01-14')['A'] == 10
+    assert _as_of(client, '2026-02-01')['A'] == 98
+    assert _as_of(client, '2026-12-31')['A'] == 105
+
+
+def test_checkpoint_matches_ledger_and_keeps_history(client, db, ledger):
+    assert stock_ledger.checkpoint(db) == 2
+    db.commit()
+
+    balances = {row.product_id: row.balance for row in db.query(StockCheckpoint)}
+    assert balances == {ledger['A']: 12, ledger['B']: 9}
+    assert stock_ledger.checkpoint(db) == 0
+    # Checkpoint được chốt hôm nay: các ngày trước đó vẫn tính từ movement
+    assert {ngay: _as_of(client, ngay) for ngay in DATES} == EXPECTED
+    assert stock_ledger.audit(db) == (2, [])
+
+
+def test_stock_as_of_filters_by_product_group(client, ledger):
+    assert _as_of(client, '2026-02-28', nhom_sp='g') == {'B': 9}
+
+
+def test_stock_as_of_rejects_bad_date(client):
+    assert client.get('/api/stock/as-of', params={'ngay': 'x'}).status_code == 422
+
+
+def test_rebuild_restores_drifted_quantity(client, db, ledger):
+    db.query(Product).filter(Product.id == ledger['A']).update({'so_luong': 50})
+    db.commit()
+
+    response = client.post('/api/stock/rebuild')
+
+    assert response.json()['updated'] == 1
+    assert response.json()['skipped'] == []
+    db.expire_all()
+    assert db.get(Product, ledger['A']).so_luong == 12
+    assert stock_ledger.audit(db) == (2, [])
+
+
+def test_rebuild_skips_product_whose_checkpoint_disagrees_with_movements(client, db, ledger):
+    ids = _movement_ids(db)
+    db.add(StockCheckpoint(product_id=ledger['A'], movement_id=ids[2], balance=100,
+                           created_at=datetime(2026, 1, 31, 23, 0)))
+    db.commit()
+
+    response = client.post('/api/stock/rebuild')
+
+    assert response.json()['updated'] == 0
+    assert [(row['ma_sp'], row['ledger'], row['movements']) for row in response.json()['skipped']] == [('A', 105, 12)]
+    db.expire_all()
+    assert db.get(Product, ledger['A']).so_luong == 12
@@ -0,0 +1,111 @@
+from app import stock_shards
+from app.models import Product, StockShard
+
+
+def _product(db, so_luong, shards=0):
+    product = Product(ma_sp='HOT', ten_sp='Hàng bán chạy', so_luong=so_luong, gia_chung=1, trang_thai='Còn hàng')
+    db.add(product)
+    db.flush()
+    if shards:
+        stock_shards.enable(db, product.id, shards)
+    db.commit()
+    return product.id
+
+
+def _shards(db):
+    db.expire_all()
+    return [row.so_luong for row in db.query(StockShard).order_by(StockShard.shard)]
+
+
+def test_enable_spreads_stock_evenly(db):
+    product_id = _product(db, 10, shards=4)
+
+    assert _shards(db) == [3, 3, 2, 2]
+    assert stock_shards.totals(db, [product_id]) == {product_id: 10}
+
+
+def test_take_from_a_single_shard(db):
+    product_id = _product(db, 10, shards=4)
+
+    assert stock_shards.take(db, product_id, 2)
+    db.commit()
+
+    assert sorted(_shards(db)) in ([0, 2, 3, 3], [1, 2, 2, 3])
+    assert stock_shards.totals(db, [product_id]) == {product_id: 8}
+
+
+def test_take_splits_across_shards_when_none_has_enough(db):
+    product_id = _product(db, 10, shards=4)
+
+    assert stock_shards.take(db, product_id, 7)
+    db.commit()
+
+    assert sum(_shards(db)) == 3
+    assert min(_shards(db)) >= 0
+
+
+def test_take_more_than_total_changes_nothing(db):
+    product_id = _product(db, 10, shards=4)
+
+    assert not stock_shards.take(db, product_id, 11)
+    db.commit()
+
+    assert _shards(db) == [3, 3, 2, 2]
+
+
+def test_take_exact_total_empties_every_shard(db):
+    product_id = _product(db, 5, shards=2)
+
+    assert stock_shards.take(db, product_id, 5)
+    assert not stock_shards.take(db, product_id, 1)
+    db.commit()
+
+    assert _shards(db) == [0, 0]
+
+
+def test_give_back_adds_to_one_shard(db):
+    product_id = _product(db, 10, shards=4)
+    stock_shards.take(db, product_id, 7)
+
+    stock_shards.give_back(db, product_id, 5)
+    db.commit()
+
+    assert sum(_shards(db)) == 8
+
+
+def test_give_back_without_shard_rows_keeps_the_stock(db):
+    product_id = _product(db, 4)
+
+    stock_shards.give_back(db, product_id, 3)
+    db.commit()
+
+    db.expire_all()
+    product = db.query(Product).get(product_id)
+    assert (product.so_luong, product.trang_thai) == (7, 'Còn hàng')
+
+
+def test_product_endpoints_read_live_shard_stock(client, db):
+    product_id = _product(db, 6, shards=3)
+    stock_shards.take(db, product_id, 2)
+    db.commit()
+
+    assert client.get(f'/api/products/{product_id}').json()['so_luong'] == 4
+    listed = {p['ma_sp']: p for p in client.get('/api/products/').json()['products']}
+    assert listed['HOT']['so_luong'] == 4
+
+    stock_shards.take(db, product_id, 4)
+    db.commit()
+    assert client.get(f'/api/products/{product_id}').json()['trang_thai'] == 'Hết hàng'
+
+
+def test_disable_merges_shards_back_into_product(db):
+    product_id = _product(db, 10, shards=4)
+    stock_shards.take(db, product_id, 3)
+
+    assert stock_shards.disable(db, product_id) == 7
+    db.commit()
+
+    db.expire_all()
+    product = db.query(Product).get(product_id)
+    assert (product.so_luong, product.so_shard) == (7, 0)
+    assert _shards(db) == []